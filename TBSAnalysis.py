@@ -6,8 +6,10 @@ Download TBS data from: https://doi.org/10.5439/1827703
 
 # import packages
 from dataHandling import POPSDataRetrival, dataGroupings, dataCompletenessVisualization
+from siteMetadata import site_metadata
 
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from datetime import datetime, timedelta
 import numpy as np
 import pandas as pd
@@ -16,6 +18,7 @@ from brokenaxes import brokenaxes
 import os
 import re
 import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 import warnings
 
@@ -34,6 +37,11 @@ plt.rcParams.update({
 })
 
 
+# dn bins of the TBS POPS
+tbs_bins = ['dn_150_170','dn_170_195','dn_195_220','dn_220_260','dn_260_335',
+            'dn_335_510','dn_510_705', 'dn_705_1380', 'dn_1380_1760', 'dn_1760_2550',
+            'dn_2550_3615']
+tbs_bin_edges = [150, 170, 195, 220, 260, 335, 510, 705, 1380, 1760, 2550, 3615]
 
 
 
@@ -76,25 +84,139 @@ def get_all_filenames():
     return matching_files
 
 
+def get_flight_window(filename):
+    """
+    Reads only the time, altitude, and qc variables of a TBS file to find the
+    date and the start and end time of the cleaned flight.
+
+    Parameters:
+    - filename: full name of .nc file
+
+    Returns: dict of filename, date ('yyyymmdd'), start_time, and end_time
+    """
+
+    path_to_file = os.path.join('./TBS_data', filename)
+    with xr.open_dataset(path_to_file) as dataset:
+        times = dataset['time'].values[_tbs_keep_mask(dataset)]
+
+    return {'filename': filename, 'date': re.search(r'\d{8}', filename).group(), 'start_time': pd.Timestamp(times[0]), 'end_time': pd.Timestamp(times[-1])}
+
+def collect_flight_windows(filenames):
+    """
+    Collects the date and time window of every flight before any SAIL-Net data are loaded.
+
+    Parameters:
+    - filenames: list of TBS filenames
+
+    Returns: df with one row per flight and columns filename, date, start_time, end_time
+    """
+
+    return pd.DataFrame([get_flight_window(filename) for filename in filenames])
+
+def _load_site_day(site, day, windows, grouping_option):
+    """
+    Loads and bin groups one day of SAIL-Net data for one site and keeps only the data inside the given windows.
+    """
+
+    df = POPSDataRetrival()._load_file(site, day, subsample=None)
+    if grouping_option is not None:
+        df = dataGroupings().bin_groupings(df, grouping_option=grouping_option)
+
+    keep = np.zeros(len(df), dtype=bool)
+    for start_time, end_time in windows:
+        keep |= ((df['DateTime'] > start_time) & (df['DateTime'] < end_time)).to_numpy()
+
+    return df[keep]
+
+def load_site_data_for_flights(flight_windows, sites, grouping_option=2, max_workers=None):
+    """
+    Loads the SAIL-Net data needed for all flights at once. Each (site, day) file is loaded
+    and bin grouped only one time, in parallel, no matter how many flights use it,
+    and only the data inside that day's flight windows are kept.
+
+    Parameters:
+    - flight_windows: df returned by collect_flight_windows
+    - sites: list of sites
+    - grouping_option: option passed to dataGroupings.bin_groupings, defaults to 2,
+        None keeps the 16 bins b0-b15
+    - max_workers: number of processes, defaults to None for the number of cores
+
+    Returns: dict of (site, day) -> df, used by get_flight_site_data
+    """
+
+    # windows needed on each day, flights crossing midnight need both days
+    day_windows = {}
+    for flight in flight_windows.itertuples():
+        for day in pd.date_range(flight.start_time.floor('D'), flight.end_time.floor('D'), freq='D'):
+            day_windows.setdefault(day.strftime('%Y%m%d'), []).append((flight.start_time, flight.end_time))
+
+    jobs = [(site, day, windows) for site in sites for day, windows in sorted(day_windows.items())]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_load_site_day, *zip(*jobs), itertools.repeat(grouping_option))
+        site_cache = {(site, day): df for (site, day, windows), df in zip(jobs, results)}
+
+    return site_cache
+
+def get_flight_site_data(site_cache, sites, start_time, end_time):
+    """
+    Serves the SAIL-Net data for one flight from the shared cache.
+
+    Parameters:
+    - site_cache: dict returned by load_site_data_for_flights
+    - sites: list of sites
+    - start_time: start of the flight
+    - end_time: end of the flight
+
+    Returns: dict of site data during the flight
+    """
+
+    days = [day.strftime('%Y%m%d') for day in pd.date_range(start_time.floor('D'), end_time.floor('D'), freq='D')]
+
+    grouped_data = {}
+    for site in sites:
+        df = pd.concat([site_cache[(site, day)] for day in days])
+        grouped_data[site] = df[(df['DateTime'] > start_time) & (df['DateTime'] < end_time)]
+
+    return grouped_data
+
 def load_tbs_data(filename):
     """
     Given filename, loads the .nc TBS file and converts to a df.
 
+    Only the time, altitude, qc, and dn bin variables are read, and only for the times
+    that pass the cleaning in _clean_tbs_data.
+
     Parameters:
     - filename: full name of .nc file to load
     """
     print('loading tbs data')
     path_to_dir = './TBS_data'
     path_to_file = os.path.join(path_to_dir, filename)
-    dataset = xr.open_dataset(path_to_file)
+    with xr.open_dataset(path_to_file) as dataset:
+        dataset = dataset[['alt', 'qc_total_concentration'] + tbs_bins]
+        dataset = dataset.isel(time=np.flatnonzero(_tbs_keep_mask(dataset)))
 
-    # convert to pandas df
-    df = dataset.to_dataframe()
-    df = df.reset_index(level='num_pops')
+        # convert to pandas df
+        df = dataset.to_dataframe()
+    if 'num_pops' in df.index.names:
+        df = df.reset_index(level='num_pops')
 
 
     return df
 
+def _tbs_keep_mask(dataset):
+    """
+    Same cleaning as _clean_tbs_data applied to the arrays of the xarray dataset.
+
+    Returns: bool array, True for times to keep
+    """
+
+    qc = dataset['qc_total_concentration'].values
+    alt = dataset['alt'].values
+
+    return (qc == 0) & (alt != -9999) & (alt <= 3800) & (alt >= 2600)
+
 def process_tbs(df):
     """
     Given TBD df, does all cleaning, organizing, and plotting.
@@ -148,46 +270,25 @@ def _altitude_time_bin_tbs(df):
 
     print('time and altitude binning tbs data')
 
-    # Define altitude bins and time window
-    altitude_bins = np.arange(df['alt'].min(), df['alt'].max() + 5, 5)
-    print('done making altitude bins')
-    time_window = pd.Timedelta(minutes=5)
-    print('made time window')
-
-    # Convert 'Time' column to datetime if it's not already
-    df['time'] = pd.to_datetime(df['time'])
-
-    #print(len(altitude_bins))
-
-    
-
-    df['alt_bins'] = pd.cut(df['alt'], altitude_bins)
-
-    print('doing groupby')
-
-    # Group by altitude bins and time windows
-    groups = df.groupby(['alt_bins', pd.Grouper(key='time', freq=time_window)])
-
-    print('done with groupings')
-
-    # Create a new DataFrame to store the averaged data
     headers = ['time', 'alt', 'dn_150_170','dn_170_195',
                 'dn_195_220','dn_220_260','dn_260_335', 'dn_335_510',
                 'dn_510_705', 'dn_705_1380', 'dn_1380_1760', 'dn_1760_2550', 
                 'dn_2550_3615']
-    averaged_df = pd.DataFrame(columns=headers)
 
+    # Convert 'Time' column to datetime if it's not already
+    df['time'] = pd.to_datetime(df['time'])
 
-    for name, group in groups:
-        data = {}
-        # create new data to add a new row
-        for name in headers:
-            data[name] = group[name].mean()
-        # Create a Series with scalar values and an index
-        new_row = pd.Series(data, index=headers)
-    
-        # Convert the Series to a DataFrame and append it
-        averaged_df = averaged_df.append(new_row, ignore_index=True)
+    # integer altitude bin codes: 5 m bins starting at the lowest altitude and closed on the right
+    # (same as pd.cut), so the lowest point is not in a bin
+    alt_codes = np.ceil((df['alt'] - df['alt'].min())/5).astype(int) - 1
+
+    # 5 minute time bucket codes
+    time_codes = df['time'].dt.floor('5min')
+
+    # one grouped mean over all columns, only non-empty bins are kept
+    in_bin = (alt_codes >= 0).to_numpy()
+    averaged_df = df.loc[in_bin, headers].groupby([alt_codes[in_bin].rename('alt_bin'), time_codes[in_bin].rename('time_bin')], sort=False).mean()
+    averaged_df = averaged_df.reset_index(drop=True)
 
     # add in column of sum of 170 and higher
     averaged_df['dn_170_3615'] = averaged_df[['dn_170_195',
@@ -200,7 +301,119 @@ def _altitude_time_bin_tbs(df):
 
     return averaged_df
 
-def compute_error(tbs_data, data_dict, day):
+def build_time_index(df, columns):
+    """
+    Builds a sorted time index over a site's data so that windowed means
+    can be looked up with searchsorted instead of scanning the whole df.
+
+    Parameters:
+    - df: df of site data with a 'DateTime' column
+    - columns: list of columns to average
+
+    Returns: dict of the sorted times (ns since epoch) and the prefix sums of the values and valid counts
+    """
+
+    times = pd.to_datetime(df['DateTime']).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    order = np.argsort(times, kind='stable')
+    values = df[columns].to_numpy(dtype=float)[order]
+    valid = ~np.isnan(values)
+
+    zeros = np.zeros((1, len(columns)))
+    time_index = {
+        'times': times[order],
+        'columns': list(columns),
+        'sums': np.vstack([zeros, np.cumsum(np.where(valid, values, 0), axis=0)]),
+        'counts': np.vstack([zeros, np.cumsum(valid, axis=0)])
+    }
+
+    return time_index
+
+def windowed_means(time_index, times, half_window=timedelta(seconds=30)):
+    """
+    Averages the indexed site data over the open window (t - half_window, t + half_window)
+    around each of the given times. Nans are ignored.
+
+    Parameters:
+    - time_index: dict returned by build_time_index
+    - times: series or array of times to average around
+    - half_window: half the width of the window, defaults to 30 seconds
+
+    Returns: df of the means with one row per time, nan if the window has no valid data
+    """
+
+    times = pd.to_datetime(pd.Series(times)).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    half_window = pd.Timedelta(half_window).value
+
+    # first and one past the last sample strictly inside each window
+    left = np.searchsorted(time_index['times'], times - half_window, side='right')
+    right = np.searchsorted(time_index['times'], times + half_window, side='left')
+
+    sums = time_index['sums'][right] - time_index['sums'][left]
+    counts = time_index['counts'][right] - time_index['counts'][left]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums/counts, np.nan)
+
+    return pd.DataFrame(means, columns=time_index['columns'])
+
+def build_altitude_index(df):
+    """
+    Sorts the altitudes of a (binned) flight once so the points near any altitude
+    can be found with binary searches.
+
+    Parameters:
+    - df: df of TBS data with an 'alt' column
+
+    Returns: dict with the sorted altitudes and the positions of the rows in df
+    """
+
+    alts = df['alt'].to_numpy(dtype=float)
+    order = np.argsort(alts, kind='stable')
+
+    return {'alts': alts[order], 'order': order}
+
+def match_altitudes(altitude_index, elevations, tolerance=2.5):
+    """
+    Finds the flight points within +/- tolerance of each elevation, for all elevations at once.
+
+    Parameters:
+    - altitude_index: dict from build_altitude_index
+    - elevations: dict of elevation (m) for each site
+    - tolerance: maximum altitude difference (m), inclusive, defaults to 2.5
+
+    Returns: dict of row positions (in time order) for each site
+    """
+
+    sites = list(elevations.keys())
+    targets = np.array([elevations[site] for site in sites], dtype=float)
+
+    lower = np.searchsorted(altitude_index['alts'], targets - tolerance, side='left')
+    upper = np.searchsorted(altitude_index['alts'], targets + tolerance, side='right')
+
+    return {site: np.sort(altitude_index['order'][start:end]) for site, start, end in zip(sites, lower, upper)}
+
+def plot_colored_line(ax, x, y, cmap):
+    """
+    Draws a line whose color changes point by point as a single LineCollection,
+    segment i (from point i to i+1) gets color cmap(i).
+
+    Parameters:
+    - ax: axes to draw on
+    - x, y: coordinates of the points
+    - cmap: colormap with (at least) one color per point, i.e. plt.get_cmap('viridis', len(x))
+
+    Returns: the LineCollection
+    """
+
+    points = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    segments = np.stack([points[:-1], points[1:]], axis=1)
+
+    line = LineCollection(segments, colors=cmap(np.arange(len(segments))), linewidths=plt.rcParams['lines.linewidth'])
+    ax.add_collection(line)
+    ax.autoscale_view()
+
+    return line
+
+def compute_error(tbs_data, data_dict, day, half_window=timedelta(seconds=30), plot_path=None):
     """
     Computes the error berween site concentrations and TBS concentrations only if 170nm + bins are shared.
 
@@ -208,18 +421,13 @@ def compute_error(tbs_data, data_dict, day):
     - tbs_data: df of tbs data
     - data_dict: dict of the site data
     - day: date of the flight in the form 'yyyymmdd'
+    - half_window: site data are averaged over +/- half_window around each TBS point, defaults to 30 seconds
+    - plot_path: file to save Figure 13 to, defaults to None which shows the figure
 
     Returns: dict of average error for the flight
     """
 
-    elevations = {
-    'pumphouse':2770,
-    'gothic':2915,
-    'cbmid':3138,
-    'irwin':3177,
-    'snodgrass':3330,
-    'cbtop':3468
-    }
+    elevations = site_metadata['tbs_elevation'].to_dict()
 
     bins = ['dn_150_170','dn_170_195','dn_195_220','dn_220_260','dn_260_335', 
             'dn_335_510','dn_510_705', 'dn_705_1380', 'dn_1380_1760', 'dn_1760_2550', 
@@ -238,20 +446,14 @@ def compute_error(tbs_data, data_dict, day):
 
     # Plot a line that changes colors over time
     fig, ax = plt.subplots(figsize=(3, 2.75), dpi=300)
-    for i in range(len(time) - 1):
-        plt.plot(dn_170_3615[i:i+2], alt[i:i+2], color=cmap(i))
+    plot_colored_line(ax, dn_170_3615, alt, cmap)
     # Create a color bar and format the time labels as HH:MM
     colorbar = plt.colorbar(plt.cm.ScalarMappable(cmap=cmap), ax=ax, label='Time (UTC)')
 
-    # get the time part of the timestamp
-    # Convert the timestamp string to a datetime object
-    times = []
-    for t in time:
-        times.append(t.strftime("%H:%M"))
-
     # Set custom tick locations and labels on the colorbar
+    # only the labelled timestamps are formatted as HH:MM
     step = 25
-    tick_values = times[::step]
+    tick_values = [t.strftime("%H:%M") for t in time[::step]]
     # map ticks to value between 0 and 1
     normalized_ticks = np.linspace(0,1,len(time))
     ticks = normalized_ticks[::step]
@@ -266,76 +468,48 @@ def compute_error(tbs_data, data_dict, day):
     # for each site, find where the flight passes through the site altitude
     percent_errors = {}
     absolute_errors = {}
+    star_concentrations = []
+    star_elevations = []
+    star_indices = []
+    site_matches = match_altitudes(build_altitude_index(tbs_data), elevations)
     for site, elevation in elevations.items():
         #print(day, site)
-        percent_errors[site] = []
-        absolute_errors[site] = []
-        filtered_tbs = tbs_data[np.abs(tbs_data['alt'] - elevation) <= 2.5]
+        filtered_tbs = tbs_data.iloc[site_matches[site]]
         #print(site, filtered_tbs)
-        
-        
-        for index, row in filtered_tbs.iterrows():
-            tbs_hist = []
-            site_hist = []
-
-            # get the timeframe to average over for the site (+/- 30 seconds)
-            tbs_time = row['time']
-            tbs_start = tbs_time - timedelta(seconds=30)
-            tbs_end = tbs_time + timedelta(seconds=30)
-
-            # select that part of the df
-            site_df = data_dict[site].copy()
-            df = site_df[(site_df['DateTime'] > tbs_start) & (site_df['DateTime'] < tbs_end)]
-
-            # # sum bins 170+
-            # df['dn_170_3615'] = df[['dn_170_195',
-            #     'dn_195_220','dn_220_260','dn_260_335', 'dn_335_510',
-            #     'dn_510_705', 'dn_705_1380', 'dn_1380_1760', 'dn_1760_2550', 
-            #     'dn_2550_3615']].sum(axis=1, skipna=False) # if there is a nan, whole sum is nan
-            
-            #print(df)
-            
-            # if make_plots:
-            #     # get the bin data
-            #     for bin in bins:
-            #         tbs_hist.append(row[bin])
-            #         site_hist.append(df[bin].mean())
-
-            #     # plot the distributions
-            #     plt.plot(bin_index, tbs_hist, marker='o', label='TBS')
-            #     plt.plot(bin_index, site_hist, marker='^', label=site)
-            #     plt.legend()
-            #     plt.title(tbs_time)
-            #     plt.show()
-            
-            # compute error for 170+ sized particles and plot with flight data
-            site_avg = df['dn_170_3400'].mean()
-
-            # compute % error = abs(site-flight)/flight
-            error = round(((site_avg - row['dn_170_3615'])/row['dn_170_3615'])*100, 2)
-            # append if error not nan
-            if not np.isnan(error):
-                percent_errors[site].append(abs(error))
-
-            #compute absolute error abs(site-flight)
-            error = round(abs(site_avg - row['dn_170_3615']),2)
-            #print('abs error', error)
-            if not np.isnan(error):
-                absolute_errors[site].append(abs(error))
-
-            
-            #"""
-            # FIG 13 cont
-            plt.plot(site_avg, elevation, marker='*', markerfacecolor=cmap(index), markeredgecolor='black' ,markersize=7) # plot marker of concentration next to line
-            # plt.text(site_avg+0.5, elevation, str(error), color=cmap(index), fontsize=15) # plot error values
-            #plt.text(np.min(dn_170_3615)+0.1, elevation, site, fontsize=8) # plot site names
-            #"""
+
+        # average the site data over the time window around every matched point at once
+        site_index = build_time_index(data_dict[site], ['dn_170_3400'])
+        site_avgs = windowed_means(site_index, filtered_tbs['time'], half_window=half_window)['dn_170_3400'].to_numpy()
+        tbs_concentrations = filtered_tbs['dn_170_3615'].to_numpy()
+
+        # compute % error = abs(site-flight)/flight, only keep errors that are not nan
+        errors = np.round(((site_avgs - tbs_concentrations)/tbs_concentrations)*100, 2)
+        percent_errors[site] = list(np.abs(errors[~np.isnan(errors)]))
+
+        #compute absolute error abs(site-flight)
+        errors = np.round(np.abs(site_avgs - tbs_concentrations), 2)
+        absolute_errors[site] = list(errors[~np.isnan(errors)])
+
+        #"""
+        # FIG 13 cont: collect markers of concentration next to line, drawn all at once below
+        star_concentrations.extend(site_avgs)
+        star_elevations.extend([elevation]*len(site_avgs))
+        star_indices.extend(filtered_tbs.index)
+        # plt.text(site_avg+0.5, elevation, str(error), color=cmap(index), fontsize=15) # plot error values
+        #plt.text(np.min(dn_170_3615)+0.1, elevation, site, fontsize=8) # plot site names
+        #"""
     #"""
+    if star_indices:
+        ax.scatter(star_concentrations, star_elevations, marker='*', c=cmap(np.array(star_indices)), edgecolors='black', linewidths=plt.rcParams['lines.markeredgewidth'], s=7**2, zorder=3)
     plt.xlabel('Concentration (cm$^{-3}$)')
     plt.ylabel('Altitude (m)')
     plt.title(day)
     plt.tight_layout()
-    plt.show()
+    if plot_path is None:
+        plt.show()
+    else:
+        fig.savefig(plot_path)
+        plt.close(fig)
     #"""
     
     
@@ -355,175 +529,484 @@ def compute_error(tbs_data, data_dict, day):
     return avg_percent_errors, avg_absolute_errors, percent_errors, absolute_errors
 
 
-### body ###
+def compute_size_resolved_error(tbs_data, data_dict, half_window=timedelta(seconds=30)):
+    """
+    Compares the TBS and SAIL-Net size distributions bin by bin at every point where the
+    flight passes a site.
 
-sites = ['pumphouse', 'gothic', 'cbmid', 'irwin', 'snodgrass', 'cbtop']
+    The site data (b0-b15) are averaged around each matched point and rebinned onto the TBS
+    bins with one matrix multiply (dataGroupings.rebin). The POPS bins end at about 3380 nm,
+    so the last TBS bin (2550-3615 nm) is only partly covered.
 
+    Parameters:
+    - tbs_data: df of TBS data, output of process_tbs
+    - data_dict: dict of site data with the 16 bins b0-b15, i.e. from load_site_data_for_flights with grouping_option=None
+    - half_window: site data are averaged over +/- half_window around each TBS point, defaults to 30 seconds
 
-# proceed with analysis for all data
-filenames = get_all_filenames()
+    Returns: tidy df with one row per (site, point, bin) and columns site, time, alt, bin,
+    site_concentration, tbs_concentration, percent_error, and absolute_error
+    """
 
-headers = ['date'] + sites
-# date df for storing errors
-avg_percent_errors_df = pd.DataFrame(columns=headers)
-median_percent_errors_df = pd.DataFrame(columns=headers)
-avg_absolute_errors_df = pd.DataFrame(columns=headers)
-median_absolute_errors_df = pd.DataFrame(columns=headers)
+    groupings = dataGroupings()
+    pops_bins = ['b' + str(i) for i in range(16)]
+    elevations = site_metadata['tbs_elevation'].to_dict()
+    site_matches = match_altitudes(build_altitude_index(tbs_data), elevations)
+
+    errors = []
+    for site in elevations:
+        filtered_tbs = tbs_data.iloc[site_matches[site]]
+        if len(filtered_tbs) == 0:
+            continue
+
+        # (points, 16 bins) of site means, rebinned to (points, 11 TBS bins)
+        site_index = build_time_index(data_dict[site], pops_bins)
+        site_avgs = windowed_means(site_index, filtered_tbs['time'], half_window=half_window).to_numpy()
+        site_concentrations = groupings.rebin(site_avgs, groupings.pops_bin_edges, tbs_bin_edges)
+        tbs_concentrations = filtered_tbs[tbs_bins].to_numpy(dtype=float)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            percent_errors = np.abs((site_concentrations - tbs_concentrations)/tbs_concentrations)*100
+
+        errors.append(pd.DataFrame({
+            'site': site,
+            'time': np.repeat(filtered_tbs['time'].to_numpy(), len(tbs_bins)),
+            'alt': np.repeat(filtered_tbs['alt'].to_numpy(), len(tbs_bins)),
+            'bin': np.tile(tbs_bins, len(filtered_tbs)),
+            'site_concentration': site_concentrations.ravel(),
+            'tbs_concentration': tbs_concentrations.ravel(),
+            'percent_error': percent_errors.ravel(),
+            'absolute_error': np.abs(site_concentrations - tbs_concentrations).ravel()
+        }))
+
+    columns = ['site', 'time', 'alt', 'bin', 'site_concentration', 'tbs_concentration', 'percent_error', 'absolute_error']
+    return pd.concat(errors, ignore_index=True) if errors else pd.DataFrame(columns=columns)
+
+def _process_flight(tbs_filename, grouped_data, plot_dir):
+    """
+    Worker for run_flight_comparisons: loads, bins and compares one flight,
+    saving its Figure 13 plot to plot_dir.
+    """
 
-daily_percent_errors_dict = {}
-daily_absolute_errors_dict = {}
+    # render without a display in the worker
+    plt.switch_backend('Agg')
 
-# analyze one by one
-for tbs_filename in filenames:
-    print(tbs_filename)
-    # pull out identifying data
-    site_code = tbs_filename.split('.')[1][-2:]
     yyyymmdd = re.search(r'\d{8}', tbs_filename).group()
 
     # load & clean tbs data
     tbs_data = load_tbs_data(tbs_filename)
     tbs_data, start_time, end_time = process_tbs(tbs_data)
 
-    # load SAIL-Net data for given date (this is slow, maybe fix later)
-    dr = POPSDataRetrival()
-    groupings = dataGroupings()
-    data_dict = dr.create_datasets(sites=sites, start_date=yyyymmdd, end_date=yyyymmdd, subsample=None)
+    plot_path = os.path.join(plot_dir, os.path.splitext(tbs_filename)[0] + '.png')
 
-    grouped_data = {}
-    for site, df in data_dict.items():
-        df = groupings.bin_groupings(df, grouping_option=2)
-        df = df[(df['DateTime'] > start_time) & (df['DateTime'] < end_time)]
-        grouped_data[site] = df
-    
-    # compute error
-    avg_percent_errors, average_absolute_errors, daily_percent_errors, daily_absolute_errors = compute_error(tbs_data, grouped_data, day=yyyymmdd)
-    
-    # append averages to df
-    avg_percent_errors_df = avg_percent_errors_df.append(avg_percent_errors, ignore_index=True)
-    avg_absolute_errors_df = avg_absolute_errors_df.append(average_absolute_errors, ignore_index=True)
+    return compute_error(tbs_data, grouped_data, day=yyyymmdd, plot_path=plot_path)
 
-    # append daily values to a dict if there is data for 3 or more sites
-    num_sites = sum(1 for value in daily_percent_errors.values() if value)
-    if num_sites > 2:
-        daily_percent_errors_dict[yyyymmdd] = list(itertools.chain(*daily_percent_errors.values()))
-    num_sites = sum(1 for value in daily_absolute_errors.values() if value)
-    if num_sites > 2:
-        daily_absolute_errors_dict[yyyymmdd] = list(itertools.chain(*daily_absolute_errors.values()))
 
+def run_flight_comparisons(filenames, sites, plot_dir='./TBS_figures', grouping_option=2, max_workers=None):
+    """
+    Compares every flight to the SAIL-Net sites, one flight per worker process.
+
+    The SAIL-Net data for all flights are loaded once and each worker is sent only the data
+    for its flight. Results are merged in the order of the sorted filenames, so the output does
+    not depend on the number of workers.
+
+    Inputs:
+    - filenames: list of TBS filenames
+    - sites: list of sites
+    - plot_dir: directory the Figure 13 plot of each flight is saved to, defaults to './TBS_figures'
+    - grouping_option: option passed to dataGroupings.bin_groupings, defaults to 2
+    - max_workers: number of processes, defaults to None which uses the number of cores
+
+    Returns:
+    - avg_percent_errors_df: df of average percent error of each site (columns) for each flight (rows)
+    - avg_absolute_errors_df: df of average absolute error of each site (columns) for each flight (rows)
+    - daily_percent_errors_dict: dict of all percent errors of each day with data for 3 or more sites
+    - daily_absolute_errors_dict: dict of all absolute errors of each day with data for 3 or more sites
+    """
 
+    filenames = sorted(filenames)
+    os.makedirs(plot_dir, exist_ok=True)
 
+    # load the SAIL-Net data for all flights once, in parallel
+    flight_windows = collect_flight_windows(filenames)
+    site_cache = load_site_data_for_flights(flight_windows, sites, grouping_option=grouping_option, max_workers=max_workers)
+    flight_data = [get_flight_site_data(site_cache, sites, window['start_time'], window['end_time'])
+                   for window in flight_windows.to_dict('records')]
 
-# convert dates to datetimes
-avg_percent_errors_df['date']= pd.to_datetime(avg_percent_errors_df['date'])
-avg_absolute_errors_df['date']= pd.to_datetime(avg_absolute_errors_df['date'])
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_process_flight, filenames, flight_data, itertools.repeat(plot_dir)))
 
+    headers = ['date'] + sites
+    avg_percent_errors_df = pd.DataFrame([result[0] for result in results], columns=headers)
+    avg_absolute_errors_df = pd.DataFrame([result[1] for result in results], columns=headers)
 
+    # keep all values of a day if there is data for 3 or more sites
+    daily_percent_errors_dict = {}
+    daily_absolute_errors_dict = {}
+    for tbs_filename, (_, _, daily_percent_errors, daily_absolute_errors) in zip(filenames, results):
+        yyyymmdd = re.search(r'\d{8}', tbs_filename).group()
+        num_sites = sum(1 for value in daily_percent_errors.values() if value)
+        if num_sites > 2:
+            daily_percent_errors_dict[yyyymmdd] = list(itertools.chain(*daily_percent_errors.values()))
+        num_sites = sum(1 for value in daily_absolute_errors.values() if value)
+        if num_sites > 2:
+            daily_absolute_errors_dict[yyyymmdd] = list(itertools.chain(*daily_absolute_errors.values()))
 
-# group by dates and compute median for that site for that day
-#daily_site_mean = avg_errors_df.groupby('date').mean()
-daily_site_median_percent = avg_percent_errors_df.groupby('date').median()
-daily_site_median_absolute = avg_absolute_errors_df.groupby('date').median()
+    return avg_percent_errors_df, avg_absolute_errors_df, daily_percent_errors_dict, daily_absolute_errors_dict
 
 
-# colorblind colors
-colors = ['#377eb8', '#ff7f00', '#4daf4a',
-        '#f781bf', '#a65628', '#984ea3',
-        '#999999', '#e41a1c', '#dede00']
+class profileStore:
+    """
+    Class for binning every TBS flight onto one shared altitude x time of day grid,
+    so flights can be stacked and compared without re-processing the raw files.
 
+    Only the grid cells a flight passes through are stored: the flight, altitude bin,
+    and time bin of each cell and the mean of each variable in it.
+    """
 
-# average site medians across that date
-row_means_percent = daily_site_median_percent.mean(axis=1)
-# compute median of sites medians across that date
-row_medians_percent = daily_site_median_percent.median(axis=1)
+    def __init__(self, alt_min=2600, alt_max=3800, alt_step=5, time_step='5min', variables=tuple(tbs_bins) + ('dn_170_3615',)):
+        """
+        Inputs:
+        - alt_min, alt_max: altitude range of the grid (m), defaults to the range kept by _clean_tbs_data
+        - alt_step: altitude bin size (m), defaults to 5, bins are closed on the right (same as _altitude_time_bin_tbs)
+            except the lowest, which also holds alt_min
+        - time_step: time bin size on the time of day (UTC), defaults to '5min'
+        - variables: variables to store, defaults to the dn bins and the sum of 170 nm and higher
+        """
+        self.alt_min = alt_min
+        self.alt_max = alt_max
+        self.alt_step = alt_step
+        self.time_step = pd.Timedelta(time_step)
+        self.variables = list(variables)
+
+        self.alt_edges = np.arange(alt_min, alt_max + alt_step, alt_step)
+        self.n_alt = len(self.alt_edges) - 1
+        self.n_time = int(pd.Timedelta(days=1)/self.time_step)
+
+        self.flights = pd.DataFrame(columns=['filename', 'date', 'season', 'start_time', 'end_time'])
+        self.flight = np.zeros(0, dtype=np.int32)
+        self.alt_bin = np.zeros(0, dtype=np.int16)
+        self.time_bin = np.zeros(0, dtype=np.int16)
+        self.values = np.zeros((0, len(self.variables)), dtype=np.float32)
+
+        self.seasons = np.array([None, 'Winter', 'Winter', 'Spring', 'Spring', 'Spring', 'Summer',
+                                 'Summer', 'Summer', 'Fall', 'Fall', 'Fall', 'Winter'], dtype=object)
+
+    def build(self, filenames, max_workers=None):
+        """
+        Bins all flights onto the grid, one flight per worker process.
+
+        Inputs:
+        - filenames: list of TBS filenames
+        - max_workers: number of processes, defaults to None which uses the number of cores
+
+        Returns: self
+        """
+
+        filenames = sorted(filenames)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(self._grid_flight, filenames))
+
+        flights = []
+        for number, (flight, cells) in enumerate(results):
+            flights.append(flight)
+            self.flight = np.concatenate([self.flight, np.full(len(cells['alt_bin']), len(self.flights) + number, dtype=np.int32)])
+            self.alt_bin = np.concatenate([self.alt_bin, cells['alt_bin']])
+            self.time_bin = np.concatenate([self.time_bin, cells['time_bin']])
+            self.values = np.vstack([self.values, cells['values']])
+        self.flights = pd.DataFrame(self.flights.to_dict('records') + flights, columns=self.flights.columns)
+
+        return self
+
+    def save(self, path):
+        """
+        Saves the store to a compressed .npz file.
+
+        Inputs:
+        - path: file to save to
+        """
+
+        np.savez_compressed(path,
+            alt_min=self.alt_min, alt_max=self.alt_max, alt_step=self.alt_step,
+            time_step=self.time_step.value, variables=np.array(self.variables),
+            filenames=self.flights['filename'].to_numpy(dtype=str),
+            start_times=self.flights['start_time'].to_numpy(dtype='datetime64[ns]'),
+            end_times=self.flights['end_time'].to_numpy(dtype='datetime64[ns]'),
+            flight=self.flight, alt_bin=self.alt_bin, time_bin=self.time_bin, values=self.values)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a store saved with save.
+
+        Inputs:
+        - path: .npz file
+
+        Returns: profileStore
+        """
+
+        with np.load(path) as file:
+            store = cls(alt_min=file['alt_min'].item(), alt_max=file['alt_max'].item(), alt_step=file['alt_step'].item(),
+                        time_step=pd.Timedelta(file['time_step'].item()), variables=list(file['variables']))
+            store.flights = pd.DataFrame([store._flight_info(filename, start_time, end_time)
+                                          for filename, start_time, end_time in zip(file['filenames'], file['start_times'], file['end_times'])],
+                                         columns=store.flights.columns)
+            store.flight = file['flight']
+            store.alt_bin = file['alt_bin']
+            store.time_bin = file['time_bin']
+            store.values = file['values']
+
+        return store
+
+    def grid(self, variable):
+        """
+        Returns the (flight, altitude, time of day) array of a variable, nan where a flight has no data.
+
+        Inputs:
+        - variable: name of the variable
+        """
+
+        grid = np.full((len(self.flights), self.n_alt, self.n_time), np.nan, dtype=np.float32)
+        grid[self.flight, self.alt_bin, self.time_bin] = self.values[:, self.variables.index(variable)]
+        return grid
+
+    def flight_profiles(self, variable):
+        """
+        Returns the (flight, altitude) array of a variable averaged over the time bins of each flight.
+
+        Inputs:
+        - variable: name of the variable
+        """
+
+        values = self.values[:, self.variables.index(variable)].astype(float)
+        valid = ~np.isnan(values)
+        cells = self.flight[valid].astype(np.int64)*self.n_alt + self.alt_bin[valid]
+        size = len(self.flights)*self.n_alt
+
+        sums = np.bincount(cells, weights=values[valid], minlength=size)
+        counts = np.bincount(cells, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums/counts).reshape(len(self.flights), self.n_alt)
+
+    def mean_profile_by_season(self, variable):
+        """
+        Mean profile of each season, each flight weighted equally.
+
+        Inputs:
+        - variable: name of the variable
+
+        Returns: df of altitude bin midpoints (rows) by season (columns)
+        """
+
+        profiles = self.flight_profiles(variable)
+        seasons = self.flights['season'].to_numpy()
+
+        mean_profiles = pd.DataFrame(index=pd.Index(self._alt_midpoints(), name='alt'))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            for season in ['Spring', 'Summer', 'Fall', 'Winter']:
+                if np.any(seasons == season):
+                    mean_profiles[season] = np.nanmean(profiles[seasons == season], axis=0)
+
+        return mean_profiles
+
+    def percentile_envelope(self, variable, percentiles=(5, 25, 50, 75, 95), season=None):
+        """
+        Percentiles of the flight profiles at each altitude.
+
+        Inputs:
+        - variable: name of the variable
+        - percentiles: list of percentiles between 0 and 100, defaults to (5, 25, 50, 75, 95)
+        - season: only use flights of this season, defaults to None for all flights
+
+        Returns: df of altitude bin midpoints (rows) by percentile (columns), i.e. 'p5' for 5
+        """
+
+        profiles = self.flight_profiles(variable)
+        if season is not None:
+            profiles = profiles[self.flights['season'].to_numpy() == season]
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            envelope = np.nanpercentile(profiles, percentiles, axis=0)
+
+        return pd.DataFrame(envelope.T, index=pd.Index(self._alt_midpoints(), name='alt'),
+                            columns=[f'p{p:g}' for p in percentiles])
+
+    def _alt_midpoints(self):
+        return (self.alt_edges[:-1] + self.alt_edges[1:])/2
+
+    def _flight_info(self, filename, start_time, end_time):
+        date = re.search(r'\d{8}', str(filename)).group()
+        return {'filename': str(filename), 'date': date, 'season': self.seasons[int(date[4:6])],
+                'start_time': pd.Timestamp(start_time), 'end_time': pd.Timestamp(end_time)}
+
+    def _grid_flight(self, filename):
+        """
+        Loads, cleans, and bins one flight onto the grid.
+
+        Returns: dict of flight info, dict of alt_bin, time_bin, and values of each non-empty cell
+        """
+
+        df = load_tbs_data(filename)
+        df, start_time, end_time = _clean_tbs_data(df)
+
+        # the sum of 170 nm and higher is taken over the cell means (same order as _altitude_time_bin_tbs)
+        columns = [variable for variable in self.variables if variable != 'dn_170_3615']
+        if 'dn_170_3615' in self.variables:
+            columns += [bin for bin in tbs_bins[1:] if bin not in columns]
+
+        times = pd.to_datetime(df['time'])
+        alt = df['alt'].to_numpy()
+        # bins are closed on the right, except that alt_min (kept by _clean_tbs_data) goes in the lowest bin
+        alt_codes = np.where(alt == self.alt_min, 0, np.ceil((alt - self.alt_min)/self.alt_step).astype(int) - 1)
+        time_codes = ((times - times.dt.floor('D'))//self.time_step).to_numpy()
+        in_grid = (alt_codes >= 0) & (alt_codes < self.n_alt)
+
+        # one grouped mean per cell over all variables
+        cells = alt_codes[in_grid]*self.n_time + time_codes[in_grid]
+        codes, uniques = pd.factorize(cells, sort=True)
+        values = df[columns].to_numpy(dtype=float)[in_grid]
+        valid = ~np.isnan(values)
+        sums = np.zeros((len(uniques), len(columns)))
+        counts = np.zeros((len(uniques), len(columns)))
+        np.add.at(sums, codes, np.where(valid, values, 0))
+        np.add.at(counts, codes, valid)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = pd.DataFrame(sums/counts, columns=columns)
+        if 'dn_170_3615' in self.variables:
+            means['dn_170_3615'] = means[tbs_bins[1:]].sum(axis=1)
+
+        return self._flight_info(filename, start_time, end_time), {
+            'alt_bin': (uniques // self.n_time).astype(np.int16),
+            'time_bin': (uniques % self.n_time).astype(np.int16),
+            'values': means[self.variables].to_numpy(dtype=np.float32)
+        }
 
-row_means_absolute = daily_site_median_absolute.mean(axis=1)
-row_medians_absolute = daily_site_median_absolute.median(axis=1)
 
+### body ###
 
+if __name__ == '__main__':
 
-# plot means
-# clear any remaining plot data
-plt.clf()
+    sites = ['pumphouse', 'gothic', 'cbmid', 'irwin', 'snodgrass', 'cbtop']
 
-# fig, ax = plt.subplots(nrows=2, sharex=True, figsize=(6,3), dpi=300)
-# ax[0].plot(row_means_percent, marker='o', linestyle='None', color='#377eb8', label='Mean Error')
-# ax[0].plot(row_medians_percent, marker='^', linestyle='None', color='#ff7f00', label='Median Error')
-# ax[0].set_ylabel('Percent Error')
 
-# ax[1].plot(row_means_absolute, marker='o', linestyle='None', color='#377eb8', label='Mean Error')
-# ax[1].plot(row_medians_absolute, marker='^', linestyle='None', color='#ff7f00', label='Median Error')
-# ax[1].set_ylabel('Absolute Error')
-# ax[1].set_xlabel('UTC')
-# plt.legend()
-# #plt.show()
+    # proceed with analysis for all data
+    filenames = get_all_filenames()
 
-# # group the means and medians by month
-# print(daily_percent_errors_dict)
-# print(daily_absolute_errors_dict)
+    # compare all flights, one flight per process
+    avg_percent_errors_df, avg_absolute_errors_df, daily_percent_errors_dict, daily_absolute_errors_dict = run_flight_comparisons(filenames, sites)
 
+    # convert dates to datetimes
+    avg_percent_errors_df['date']= pd.to_datetime(avg_percent_errors_df['date'])
+    avg_absolute_errors_df['date']= pd.to_datetime(avg_absolute_errors_df['date'])
 
-colors_dict = {
-    '202205': '#ff7f00',
-    '202207': '#377eb8',
-    '202301': '#a65628',
-    '202304': '#4daf4a',
-    '202305': '#f781bf',
-    '202306': '#984ea3'
-}
 
-cols_dict = {
-    '202205': 0,
-    '202207': 1,
-    '202301': 2,
-    '202304': 3,
-    '202305': 4,
-    '202306': 5
-}
 
-# sort the dicts chronologically
-daily_percent_errors_dict = dict(sorted(daily_percent_errors_dict.items(), key=lambda x: x[0]))
-daily_absolute_errors_dict = dict(sorted(daily_absolute_errors_dict.items(), key=lambda x: x[0]))
+    # group by dates and compute median for that site for that day
+    #daily_site_mean = avg_errors_df.groupby('date').mean()
+    daily_site_median_percent = avg_percent_errors_df.groupby('date').median()
+    daily_site_median_absolute = avg_absolute_errors_df.groupby('date').median()
 
-# compute the average percent error for each day
-median_daily_percent_error = []
-for errors in daily_percent_errors_dict.values():
-    median_daily_percent_error.append(np.median(errors))
 
-print(median_daily_percent_error)
+    # colorblind colors
+    colors = ['#377eb8', '#ff7f00', '#4daf4a',
+            '#f781bf', '#a65628', '#984ea3',
+            '#999999', '#e41a1c', '#dede00']
 
-# FIG 14
-fig, ax = plt.subplots(figsize=(6.6, 2.75), dpi=300)
 
-for i, day in enumerate(daily_absolute_errors_dict.keys()):
+    # average site medians across that date
+    row_means_percent = daily_site_median_percent.mean(axis=1)
+    # compute median of sites medians across that date
+    row_medians_percent = daily_site_median_percent.median(axis=1)
 
-    color = colors_dict[day[0:6]]
+    row_means_absolute = daily_site_median_absolute.mean(axis=1)
+    row_medians_absolute = daily_site_median_absolute.median(axis=1)
 
-    # output the median of the absolute difference and the range
-    median = np.median(daily_absolute_errors_dict[day])
-    daily_range = np.max(daily_absolute_errors_dict[day]) - np.min(daily_absolute_errors_dict[day])
-    print(f"{day}: median: {median}, range: {daily_range}")
-    
 
 
-    # plot absolute errors on bottom plot
-    ax.boxplot(daily_absolute_errors_dict[day], positions=[i], showfliers=False, whis=(5,95),
-                    boxprops={'color':color},
-                    whiskerprops={'color': color},
-                    capprops={'color': color},
-                    medianprops={'color': color}
-                    ) 
-ax.set_ylabel('Absolute Difference (cm$^{-3}$)')
+    # plot means
+    # clear any remaining plot data
+    plt.clf()
 
-# label x-axis with dates
-ax.set_xticks(range(len(daily_absolute_errors_dict.keys())))
-ax.set_xticklabels(daily_absolute_errors_dict.keys(), rotation=60)
+    # fig, ax = plt.subplots(nrows=2, sharex=True, figsize=(6,3), dpi=300)
+    # ax[0].plot(row_means_percent, marker='o', linestyle='None', color='#377eb8', label='Mean Error')
+    # ax[0].plot(row_medians_percent, marker='^', linestyle='None', color='#ff7f00', label='Median Error')
+    # ax[0].set_ylabel('Percent Error')
 
-ax2 = ax.twinx()
+    # ax[1].plot(row_means_absolute, marker='o', linestyle='None', color='#377eb8', label='Mean Error')
+    # ax[1].plot(row_medians_absolute, marker='^', linestyle='None', color='#ff7f00', label='Median Error')
+    # ax[1].set_ylabel('Absolute Error')
+    # ax[1].set_xlabel('UTC')
+    # plt.legend()
+    # #plt.show()
 
-ax2.plot(median_daily_percent_error, color='gray', alpha=0.6, marker='.')
-ax2.set_ylabel('Median Percent Error (%)', color='gray')
-# set axis to be gray
-ax2.tick_params(axis='y', labelcolor='gray')
-    
-plt.tight_layout()
-plt.show()
+    # # group the means and medians by month
+    # print(daily_percent_errors_dict)
+    # print(daily_absolute_errors_dict)
+
+
+    colors_dict = {
+        '202205': '#ff7f00',
+        '202207': '#377eb8',
+        '202301': '#a65628',
+        '202304': '#4daf4a',
+        '202305': '#f781bf',
+        '202306': '#984ea3'
+    }
+
+    cols_dict = {
+        '202205': 0,
+        '202207': 1,
+        '202301': 2,
+        '202304': 3,
+        '202305': 4,
+        '202306': 5
+    }
+
+    # sort the dicts chronologically
+    daily_percent_errors_dict = dict(sorted(daily_percent_errors_dict.items(), key=lambda x: x[0]))
+    daily_absolute_errors_dict = dict(sorted(daily_absolute_errors_dict.items(), key=lambda x: x[0]))
+
+    # compute the average percent error for each day
+    median_daily_percent_error = []
+    for errors in daily_percent_errors_dict.values():
+        median_daily_percent_error.append(np.median(errors))
+
+    print(median_daily_percent_error)
+
+    # FIG 14
+    fig, ax = plt.subplots(figsize=(6.6, 2.75), dpi=300)
+
+    for i, day in enumerate(daily_absolute_errors_dict.keys()):
+
+        color = colors_dict[day[0:6]]
+
+        # output the median of the absolute difference and the range
+        median = np.median(daily_absolute_errors_dict[day])
+        daily_range = np.max(daily_absolute_errors_dict[day]) - np.min(daily_absolute_errors_dict[day])
+        print(f"{day}: median: {median}, range: {daily_range}")
+
+
+
+        # plot absolute errors on bottom plot
+        ax.boxplot(daily_absolute_errors_dict[day], positions=[i], showfliers=False, whis=(5,95),
+                        boxprops={'color':color},
+                        whiskerprops={'color': color},
+                        capprops={'color': color},
+                        medianprops={'color': color}
+                        ) 
+    ax.set_ylabel('Absolute Difference (cm$^{-3}$)')
+
+    # label x-axis with dates
+    ax.set_xticks(range(len(daily_absolute_errors_dict.keys())))
+    ax.set_xticklabels(daily_absolute_errors_dict.keys(), rotation=60)
+
+    ax2 = ax.twinx()
+
+    ax2.plot(median_daily_percent_error, color='gray', alpha=0.6, marker='.')
+    ax2.set_ylabel('Median Percent Error (%)', color='gray')
+    # set axis to be gray
+    ax2.tick_params(axis='y', labelcolor='gray')
+
+    plt.tight_layout()
+    plt.show()
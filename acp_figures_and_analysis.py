@@ -8,7 +8,7 @@ https://doi.org/10.5439/2203692
 """
 
 # import packages
-from dataHandling import POPSDataRetrival, dataGroupings, dataCompletenessVisualization
+from dataHandling import POPSDataRetrival, dataGroupings, dataCompletenessVisualization, exclusionCalendar
 from networkMeanAnalysis import basicVisualization, temporalAnalysis
 from spatialAnalysis import timeseriesVisualization, spatialVariability, networkDesign
 
@@ -93,23 +93,10 @@ network.plot_representation_boxes()
 
 # FIGURE 8: diurnal cycles avg monthly without wildfire smoke in June 2022
 
-# set up date range and sites for analysis
-start_date = '20211010' # 20211010
-end_date = '20230722'
-
-sites = ['pumphouse', 'gothic', 'cbmid', 'irwin', 'snodgrass', 'cbtop']
-
-# load data
-dr = POPSDataRetrival()
-remove_dates=['20220613', '20220614', '20220615']
-data_dict = dr.create_datasets(sites=sites, start_date=start_date, end_date=end_date, subsample=12, remove_dates=remove_dates)
-
-# time bin data
-grouping = dataGroupings()
-time_grouped_dict_1H = {}   # group data by hours # group data by 1 day intervals
-
-for site in sites:
-    time_grouped_dict_1H[site] = grouping.temporal_grouping(data_dict[site], averaging_frequency='1H')
+# remove the smoke from the hourly data computed above instead of reloading
+exclusions = exclusionCalendar()
+exclusions.add_dates(['20220613', '20220614', '20220615'])
+time_grouped_dict_1H = exclusions.apply(time_grouped_dict_1H)
 
 # group bins 
 bin_grouped_dict_1H = {}
@@ -0,0 +1,166 @@
+"""
+Computes the completeness of the POPS data without plotting.
+
+Works at any resolution, from the native 5 second data to daily averages, by placing each
+valid sample on a regular time grid and run-length encoding the gaps.
+"""
+
+# import packages
+import numpy as np
+import pandas as pd
+
+
+# start and end dates of each site's deployment during SAIL
+deployment_dates = {
+    'cbtop': ['20220613', '20230722'],
+    'cbmid': ['20211029', '20230603'],
+    'irwin': ['20211001', '20230722'],
+    'gothic': ['20211029', '20230722'],
+    'pumphouse': ['20211029', '20230722'],
+    'snodgrass':['20211001', '20230722']
+}
+
+
+def infer_cadence(dict_of_data, bin_name):
+    """
+    Estimates the time between samples as the median spacing of the valid (non-nan) samples of all sites.
+
+    Only valid samples are used since missing days are filled with nan rows 1 second apart.
+
+    Inputs:
+    - dict_of_data: dict of site data
+    - bin_name: name of the bin used to decide if a sample is valid
+
+    Returns: pd.Timedelta, 1 day if no site has two valid samples
+    """
+
+    spacings = []
+    for df in dict_of_data.values():
+        times = pd.to_datetime(df['DateTime'][df[bin_name].notna()]).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        spacings.append(np.diff(np.unique(times)))
+
+    spacings = np.concatenate(spacings) if spacings else np.array([], dtype=np.int64)
+    if len(spacings) == 0:
+        return pd.Timedelta(days=1)
+
+    return pd.Timedelta(int(np.median(spacings)), unit='ns')
+
+
+class dataCompleteness:
+    """
+    Class for computing the fraction of valid samples of each site, per site, day, and month,
+    and the time intervals of all gaps.
+    """
+
+    def __init__(self, cadence='5s', deployment_dates=deployment_dates):
+        """
+        Inputs:
+        - cadence: expected time between samples, i.e. '5s' for native data, '1min' for data
+            subsampled with subsample=12, or '1D' for daily averages, defaults to '5s'
+        - deployment_dates: dict of [start, end] dates in form 'yyyymmdd' for each site,
+            only time within the deployment (including the whole end day) is counted
+        """
+        self.cadence = pd.Timedelta(cadence)
+        self.deployment_dates = deployment_dates
+
+    def compute(self, dict_of_data, bin_name, return_grid=False):
+        """
+        Computes the completeness of each site for the given bin.
+
+        A time slot (of length cadence) is valid if it holds at least one non-nan value.
+        Slots outside the site's deployment or outside the loaded data are not counted.
+        The dfs are only read, never modified or copied.
+
+        Inputs:
+        - dict_of_data: dict of site data
+        - bin_name: name of the bin used to decide if a sample is valid
+        - return_grid: (bool) also return the slot grid, defaults to False
+
+        Returns: dict of dfs
+        - 'sites': valid slots, expected slots, and percent complete of each site
+        - 'daily': percent complete of each day (rows) for each site (columns)
+        - 'monthly': percent complete of each month (rows) for each site (columns)
+        - 'gaps': site, start, end, and duration of every gap
+        - 'grid' (if return_grid): slot times (rows) by site (columns), 1 if valid, 0 if missing, nan if not counted
+        """
+
+        cadence = self.cadence.value
+        day = pd.Timedelta(days=1).value
+
+        # find the time range of each site in ns since epoch
+        times = {}
+        windows = {}
+        for site, df in dict_of_data.items():
+            times[site] = pd.to_datetime(df['DateTime']).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+            start = times[site].min()
+            end = times[site].max() + cadence
+            if site in self.deployment_dates:
+                start = max(start, pd.to_datetime(self.deployment_dates[site][0], format='%Y%m%d').value)
+                end = min(end, pd.to_datetime(self.deployment_dates[site][1], format='%Y%m%d').value + day)
+            windows[site] = (start, max(start, end))
+
+        # common slot grid for all sites
+        origin = min(start for start, end in windows.values())
+        origin -= origin % cadence
+        n_slots = int(-(-(max(end for start, end in windows.values()) - origin) // cadence))
+        slot_times = origin + np.arange(n_slots, dtype=np.int64)*cadence
+
+        site_rows = []
+        gaps = []
+        daily = {}
+        monthly = {}
+        grid = {}
+        for site, df in dict_of_data.items():
+            start, end = windows[site]
+            first = (start - origin) // cadence
+            last = -(-(end - origin) // cadence)
+
+            # mark slots with at least one valid sample
+            valid = df[bin_name].notna().to_numpy()
+            slots = (times[site][valid] - origin) // cadence
+            slots = slots[(slots >= first) & (slots < last)]
+            slot_valid = np.zeros(last - first, dtype=bool)
+            slot_valid[slots - first] = True
+
+            n_valid = np.count_nonzero(slot_valid)
+            n_expected = len(slot_valid)
+            site_rows.append({'site': site, 'valid': n_valid, 'expected': n_expected,
+                              'percent': 100*n_valid/n_expected if n_expected > 0 else np.nan})
+
+            # run-length encode the gaps: edges where the slot validity changes
+            edges = np.flatnonzero(np.diff(np.concatenate([[1], slot_valid.astype(np.int8), [1]])))
+            gaps.append(pd.DataFrame({
+                'site': site,
+                'start': pd.to_datetime(slot_times[first + edges[::2]]),
+                'end': pd.to_datetime(origin + (first + edges[1::2])*cadence)
+            }))
+
+            # daily and monthly coverage
+            first_day = slot_times[first] - slot_times[first] % day if last > first else origin
+            day_codes = (slot_times[first:last] - first_day) // day
+            daily_counts = pd.DataFrame({
+                'valid': np.bincount(day_codes, weights=slot_valid),
+                'expected': np.bincount(day_codes)
+            }, index=pd.to_datetime(first_day + np.arange(day_codes.max() + 1 if len(day_codes) else 0, dtype=np.int64)*day))
+            daily[site] = 100*daily_counts['valid']/daily_counts['expected']
+            monthly_counts = daily_counts.groupby(daily_counts.index.to_period('M')).sum()
+            monthly[site] = 100*monthly_counts['valid']/monthly_counts['expected']
+
+            if return_grid:
+                site_grid = np.full(n_slots, np.nan)
+                site_grid[first:last] = slot_valid
+                grid[site] = site_grid
+
+        gaps = pd.concat(gaps, ignore_index=True)
+        gaps['duration'] = gaps['end'] - gaps['start']
+
+        completeness = {
+            'sites': pd.DataFrame(site_rows).set_index('site'),
+            'daily': pd.DataFrame(daily),
+            'monthly': pd.DataFrame(monthly),
+            'gaps': gaps
+        }
+        if return_grid:
+            completeness['grid'] = pd.DataFrame(grid, index=pd.to_datetime(slot_times))
+
+        return completeness
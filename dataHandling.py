@@ -12,6 +12,7 @@ import xarray as xr
 from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+from dataCompleteness import dataCompleteness, infer_cadence
 
 
 
@@ -49,11 +50,10 @@ class POPSDataRetrival:
 
         if remove_dates is not None:
             # remove listed dates 
-            try:
-                for day in remove_dates:
-                    dates.remove(day)
-            except:
+            remove_dates = set(remove_dates)
+            if not remove_dates.issubset(dates):
                 print('Error removing dates')
+            dates = [day for day in dates if day not in remove_dates]
         
         # make empty dict for data
         data_dict = {}
@@ -78,7 +78,32 @@ class POPSDataRetrival:
             data_dict[site] = all_data
         
         return data_dict
-    
+
+    def iterate_datasets(self, sites, start_date, end_date, subsample=None, remove_dates=None):
+        """
+        Loads the data one file at a time instead of concatenating everything,
+        so that full resolution data can be processed with bounded memory.
+
+        Input:
+        - sites: list of sites wanted in analysis
+        - start_date: start of date range in form 'yyyymmdd' (str)
+        - end_date: end of date range in form 'yyyymmdd' (str)
+        - subsample: number of gaps between 5 second samples, defaults to None
+        - remove_dates: list of dates in form 'yyyymmdd' to skip, defaults to None
+
+        Yields: site, day, df of the data for that site and day
+        """
+
+        dates = self._make_date_range(start_date, end_date)
+
+        if remove_dates is not None:
+            remove_dates = set(remove_dates)
+            dates = [day for day in dates if day not in remove_dates]
+
+        for site in sites:
+            for day in dates:
+                yield site, day, self._load_file(site, day, subsample)
+
 
     def _make_date_range(self, start_date, end_date):
 
@@ -191,9 +216,21 @@ class dataGroupings:
     """
 
     def __init__(self):
-        pass
-
-    def temporal_grouping(self, df, averaging_frequency):
+        # width (log10) and midpoint (nm) of the 16 POPS bins b0-b15, corrected using the updated NOAA Mie table
+        self.dlogdp = [0.03645458169, 0.03940255269, 0.04033092159, 0.03849895488,
+                    0.03655010672, 0.04559350564, 0.08261548653, 0.141566381,
+                    0.080507337, 0.1008071129, 0.1428650493, 0.1559862,
+                    0.112588743, 0.118781921, 0.1130751916, 0.0867054262]
+        self.diameter_midpoints = [149, 163, 178, 195, 213, 234, 272, 355, 455, 562, 749,
+                            1059, 1431, 1870, 2440, 3062]
+
+        # bin edges (nm): each bin spans midpoint*10^(+/- dlogdp/2), neighboring edges
+        # that don't quite meet are joined at their geometric mean
+        lower = np.log10(self.diameter_midpoints) - np.array(self.dlogdp)/2
+        upper = np.log10(self.diameter_midpoints) + np.array(self.dlogdp)/2
+        self.pops_bin_edges = 10**np.concatenate([[lower[0]], (upper[:-1] + lower[1:])/2, [upper[-1]]])
+
+    def temporal_grouping(self, df, averaging_frequency, include_counts=False):
         """
         Bins data temporally by averaging over time intervals.
         
@@ -201,6 +238,8 @@ class dataGroupings:
         - df: df of data
         - averaging_frequency: frequency to average over
             in form 'nMin', 'nH', or 'nD' where n is an integer
+        - include_counts: (bool) add a 'count' column with the number of samples (with b0 data)
+            in each interval, i.e. to weight the averages, default False
         
         Returns: df of time binned data
         """
@@ -225,6 +264,9 @@ class dataGroupings:
         for bin in bins:
             binned_avg = df.groupby('time_bin')[bin].mean().tolist()
             new_df[bin] = binned_avg
+
+        if include_counts:
+            new_df['count'] = df.groupby('time_bin')['b0'].count().tolist()
         
 
         return new_df
@@ -274,10 +316,61 @@ class dataGroupings:
             grouped_df['DateTime'] = df['DateTime']
             grouped_df['submircon'] = df[['b' + str(i) for i in range(11)]].sum(axis=1, skipna=False)
             grouped_df['supermicron'] = df[['b' + str(i) for i in range(11, 16)]].sum(axis=1, skipna=False)
+
+        # keep the sample counts from temporal_grouping
+        if 'count' in df.columns:
+            grouped_df['count'] = df['count']
         
 
         return grouped_df
     
+    def size_rebinning_matrix(self, from_edges, to_edges):
+        """
+        Builds the matrix that moves concentrations from one set of size bins to another,
+        assuming particles are spread uniformly in log(diameter) within each bin.
+
+        Entry (i, j) is the fraction of from-bin i that overlaps to-bin j in log space,
+        so the part of a from-bin outside all to-bins is dropped.
+
+        Inputs:
+        - from_edges: bin edges (nm) of the data, length number of bins + 1
+        - to_edges: bin edges (nm) to rebin to, length number of bins + 1
+
+        Returns: array of shape (number of from-bins, number of to-bins)
+        """
+
+        from_edges = np.log10(np.asarray(from_edges, dtype=float))
+        to_edges = np.log10(np.asarray(to_edges, dtype=float))
+
+        # overlap of every pair of bins at once
+        overlap = (np.minimum(from_edges[1:, None], to_edges[None, 1:])
+                   - np.maximum(from_edges[:-1, None], to_edges[None, :-1])).clip(min=0)
+
+        return overlap/np.diff(from_edges)[:, None]
+
+    def rebin(self, values, from_edges, to_edges):
+        """
+        Rebins concentrations with one matrix multiply.
+
+        If a from-bin is nan, every to-bin it contributes to is nan (same as bin_groupings).
+
+        Inputs:
+        - values: array (or df) of concentrations with the from-bins along the last axis
+        - from_edges: bin edges (nm) of the data
+        - to_edges: bin edges (nm) to rebin to
+
+        Returns: array with the to-bins along the last axis
+        """
+
+        weights = self.size_rebinning_matrix(from_edges, to_edges)
+        values = np.asarray(values, dtype=float)
+        missing = np.isnan(values)
+
+        rebinned = np.where(missing, 0, values) @ weights
+        rebinned[(missing.astype(float) @ (weights > 0)) > 0] = np.nan
+
+        return rebinned
+
     def network_mean(self, dict_of_data):
         """
         Averages over all dfs in the dict to get a network mean, equal to the average of the sites at time t.
@@ -317,82 +410,243 @@ class dataGroupings:
 
         return network_mean_df
 
+    def stack_sites(self, dict_of_data, bin_names):
+        """
+        Stacks the site dfs into one (site, time, bin) array for vectorized analysis across sites.
 
-class dataCompletenessVisualization:
+        Rows are matched on the df index (same as assigning each site to a column of one df),
+        so the dfs should cover the same times, i.e. from the same create_datasets and grouping calls.
+
+        Inputs:
+        - dict_of_data: dict of site data
+        - bin_names: list of bin names
+
+        Returns:
+        - sites: list of sites, in the order of the first axis
+        - datetimes: series of the 'DateTime' of each time
+        - values: array of shape (number of sites, number of times, number of bins)
+        """
+
+        sites = list(dict_of_data.keys())
+        first_df = dict_of_data[sites[0]]
+
+        datetimes = pd.to_datetime(first_df['DateTime']).reset_index(drop=True)
+        values = np.stack([df[bin_names].reindex(first_df.index).to_numpy(dtype=float) for df in dict_of_data.values()])
+
+        return sites, datetimes, values
+
+    def grouped_statistics(self, dict_of_data, bin_names, group_by, quantiles=(0.25, 0.75)):
+        """
+        Computes the mean, median, and any number of quantiles of each bin for every group
+        of every df in the dict in a single vectorized pass.
+
+        Each (df, group) is sorted only once for all bins, and every quantile is then read
+        from the sorted values, so requesting more quantiles only adds an index lookup each.
+        Quantiles are linearly interpolated (same as pandas' default) and nans are ignored.
+
+        Inputs:
+        - dict_of_data: dict of dfs, e.g. site data, network mean can be added under its own key
+        - bin_names: list of bin names to summarize
+        - group_by: list of columns to group by (must be in every df), e.g. ['Season', 'Hour']
+        - quantiles: list of quantiles between 0 and 1, defaults to (0.25, 0.75)
+
+        Returns: tidy df with one row per (key, group, bin) and columns
+        'site', the group_by columns, 'bin', 'count', 'mean', 'median', and 'q<percent>'
+        for each quantile, i.e. 'q25' for 0.25
+        """
+
+        labels = list(dict_of_data.keys())
+
+        # factorize the groups jointly so every df shares the same group codes
+        keys = pd.concat([df[group_by] for df in dict_of_data.values()], ignore_index=True)
+        group_codes, groups = pd.MultiIndex.from_frame(keys).factorize(sort=True)
+        n_groups = len(groups)
+
+        # stack all dfs into a single (rows, bins) array with one cell code per (df, group)
+        lengths = [len(df) for df in dict_of_data.values()]
+        site_codes = np.repeat(np.arange(len(labels)), lengths)
+        values = np.concatenate([df[bin_names].to_numpy(dtype=float) for df in dict_of_data.values()])
+
+        keep = group_codes >= 0
+        cells = site_codes[keep]*n_groups + group_codes[keep]
+        values = values[keep]
+        n_rows = len(values)
+
+        # rank each column once, then sort on (cell, rank) so values are ordered within each cell
+        # nans have the highest ranks so they end up at the end of their cell
+        global_order = np.argsort(values, axis=0, kind='stable')
+        ranks = np.empty_like(global_order)
+        np.put_along_axis(ranks, global_order, np.arange(n_rows)[:, None], axis=0)
+        cell_keys = cells[:, None].astype(np.int64)*n_rows + ranks
+        cell_keys.sort(axis=0)
+        sorted_values = np.take_along_axis(np.take_along_axis(values, global_order, axis=0), cell_keys % n_rows, axis=0)
+
+        # locate each non-empty cell in the sorted array
+        sizes = np.bincount(cells, minlength=len(labels)*n_groups)
+        present = np.flatnonzero(sizes)
+        starts = (np.cumsum(sizes) - sizes)[present]
+
+        valid = ~np.isnan(sorted_values)
+        counts = np.add.reduceat(valid.astype(int), starts, axis=0)
+        sums = np.add.reduceat(np.where(valid, sorted_values, 0), starts, axis=0)
+
+        stats = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats['mean'] = sums/counts
+
+        # every quantile is an interpolated lookup into the sorted cells
+        for name, q in [('median', 0.5)] + [(f'q{q*100:g}', q) for q in quantiles]:
+            position = q*(counts - 1)
+            lower = np.floor(position).clip(min=0).astype(int)
+            upper = np.ceil(position).clip(min=0).astype(int)
+            fraction = position - lower
+            bin_index = np.arange(len(bin_names))
+            lower_values = sorted_values[starts[:, None] + lower, bin_index]
+            upper_values = sorted_values[starts[:, None] + upper, bin_index]
+            result = lower_values + (upper_values - lower_values)*fraction
+            result[counts == 0] = np.nan
+            stats[name] = result
+
+        # organize into a tidy df
+        n_bins = len(bin_names)
+        tidy_df = pd.DataFrame({'site': np.repeat(np.array(labels, dtype=object)[present // n_groups], n_bins)})
+        group_values = groups[np.repeat(present % n_groups, n_bins)]
+        for level, column in enumerate(group_by):
+            tidy_df[column] = group_values.get_level_values(level)
+        tidy_df['bin'] = np.tile(bin_names, len(present))
+        tidy_df['count'] = counts.ravel()
+        for name, result in stats.items():
+            tidy_df[name] = result.ravel()
+
+        return tidy_df
+
+
+class exclusionCalendar:
     """
-    Class for plotting the completeness of data from the various sites.
+    This class is used to exclude time periods (i.e. wildfire smoke) from already loaded or
+    time grouped data, so that alternate scenarios only need a regrouping instead of reloading the data.
+
+    Exclusions can be whole days, arbitrary time intervals, and can apply to all or only some sites.
     """
 
     def __init__(self):
-        pass
+        # list of (start, end, sites) where start and end are ns since epoch and sites is None for all sites
+        self.intervals = []
 
-    def plot_total_completeness(self, dict_of_data, bin_name):
+    def add_dates(self, dates, sites=None):
         """
-        Given dict of data and column headers, plots bars epresenting where data is and isn't present. 
-        Also provides the % of total data recorded (data points that are not na / total possible data points)
+        Excludes whole days.
 
         Inputs:
-        - dict_of_data: a dict of the total POPS data
+        - dates: list of dates in form 'yyyymmdd'
+        - sites: list of sites the exclusion applies to, defaults to None for all sites
+        """
 
-        Returns:
-        - plot
+        for day in dates:
+            start = pd.to_datetime(day, format='%Y%m%d')
+            self.add_interval(start, start + pd.Timedelta(days=1), sites=sites)
+
+    def add_interval(self, start, end, sites=None):
+        """
+        Excludes the time interval [start, end).
+
+        Inputs:
+        - start: start of interval, anything accepted by pd.to_datetime
+        - end: end of interval, anything accepted by pd.to_datetime
+        - sites: list of sites the exclusion applies to, defaults to None for all sites
         """
 
-        # dict of start and end dates for SAIL
-        date_info = {
-            'cbtop': ['20220613', '20230722'],
-            'cbmid': ['20211029', '20230603'],
-            'irwin': ['20211001', '20230722'],
-            'gothic': ['20211029', '20230722'],
-            'pumphouse': ['20211029', '20230722'],
-            'snodgrass':['20211001', '20230722']
-        }
+        self.intervals.append((pd.to_datetime(start).value, pd.to_datetime(end).value, None if sites is None else set(sites)))
+
+    def mask(self, datetimes, site=None):
+        """
+        Computes which times are excluded.
+
+        Inputs:
+        - datetimes: series or array of times (UTC)
+        - site: name of the site, defaults to None which only uses exclusions for all sites
+
+        Returns: boolean array, True where the time is excluded
+        """
 
+        times = pd.to_datetime(pd.Series(datetimes)).to_numpy(dtype='datetime64[ns]').astype(np.int64)
 
-        # convert data to binary: 1 if value non nan, 0 otherwise
-        binary_lists = []
-        data_completeness = {}
-        site_list = []
+        intervals = sorted((start, end) for start, end, sites in self.intervals if sites is None or site in sites)
+        if not intervals:
+            return np.zeros(len(times), dtype=bool)
 
+        # merge overlapping intervals so that each time falls in at most one
+        merged = [list(intervals[0])]
+        for start, end in intervals[1:]:
+            if start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        starts, ends = np.array(merged).T
 
+        # find the last interval starting at or before each time
+        index = np.searchsorted(starts, times, side='right') - 1
+
+        return (index >= 0) & (times < ends[index.clip(min=0)])
+
+    def apply(self, dict_of_data, bin_names=None):
+        """
+        Sets excluded times to nan. Rows are kept so that all dfs stay the same length.
+
+        For time grouped data, a row is excluded if its time label is excluded,
+        so exclusions should line up with the grouping intervals (i.e. whole days for hourly data).
+
+        Inputs:
+        - dict_of_data: dict of site data
+        - bin_names: list of columns to mask, defaults to None for all columns except 'DateTime'
+
+        Returns: dict of masked copies of the dfs
+        """
+
+        masked_dict = {}
         for site, df in dict_of_data.items():
-            df['DateTime'] = pd.to_datetime(df['DateTime'])
+            columns = [column for column in df.columns if column != 'DateTime'] if bin_names is None else bin_names
+            df = df.copy()
+            df.loc[self.mask(df['DateTime'], site=site), columns] = np.nan
+            masked_dict[site] = df
 
-            # compute binary values in df
-            df['Binary'] = df[bin_name].notna().astype(int)
+        return masked_dict
 
-            # Convert start_date and end_date to datetime objects
-            start_date = pd.to_datetime(date_info[site][0], format='%Y%m%d')
-            end_date = pd.to_datetime(date_info[site][1], format='%Y%m%d')
 
-            # Create a mask to select values outside of the date range
-            mask = ~((df['DateTime'] >= start_date) & (df['DateTime'] <= end_date))
+class dataCompletenessVisualization:
+    """
+    Class for plotting the completeness of data from the various sites.
+    """
 
-            # Assign NaN to values outside of the date range
-            df.loc[mask, 'Binary'] = np.nan
+    def __init__(self):
+        pass
 
-            # compute list of binary data
-            binary_list = df['Binary'].tolist()
+    def plot_total_completeness(self, dict_of_data, bin_name, cadence=None):
+        """
+        Given dict of data and column headers, plots bars epresenting where data is and isn't present. 
+        Also provides the % of total data recorded (data points that are not na / total possible data points)
 
+        Works for averaged or full resolution data, see dataCompleteness for the computation.
 
-            # compute the percent of data present
-            count_ones = binary_list.count(1)
-            total = np.count_nonzero(~np.isnan(binary_list))
+        Inputs:
+        - dict_of_data: a dict of the total POPS data
+        - bin_name: name of bin used to decide if data are valid
+        - cadence: time between samples, i.e. '1D' or '5s', defaults to None which uses
+            the median spacing of the valid samples of all sites
 
-            try:
-                completeness_percent = (count_ones / total) * 100
-            except:
-                completeness_percent = np.nan
-            
+        Returns:
+        - plot
+        """
 
-            # add data to dicts
-            binary_lists.append(binary_list)
-            data_completeness[site] = completeness_percent
+        # compute completeness on the time grid of the data without modifying the dfs
+        if cadence is None:
+            cadence = infer_cadence(dict_of_data, bin_name)
+        completeness = dataCompleteness(cadence=cadence).compute(dict_of_data, bin_name, return_grid=True)
 
-            # append site list with name
-            site_list.append(site)
-        
-        times = df['DateTime'].tolist()
+        data_completeness = completeness['sites']['percent'].to_dict()
+        site_list = list(dict_of_data.keys())
+        binary_lists = completeness['grid'][site_list].T.to_numpy()
+        times = completeness['grid'].index
 
         # plot data
 
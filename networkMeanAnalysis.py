@@ -12,6 +12,8 @@ from matplotlib.lines import Line2D
 import matplotlib.colors as colors
 from scipy.stats import gaussian_kde
 import pytz
+from dataHandling import dataGroupings
+from rollingStatistics import rollingStatistics
 
 # Set the font size for different plot elements
 plt.rcParams.update({
@@ -41,19 +43,13 @@ class basicVisualization:
         #   0.137674163, 0.078941363, 0.09085512, 0.177187651, 0.137678593, 0.096164793, 0.112758467,
         #   0.107949615, 0.10986499]
         
-        # CORRECTED USING UPDATED NOAA MIE TABLE
-        self.dlogdp = [0.03645458169, 0.03940255269, 0.04033092159, 0.03849895488,
-                    0.03655010672, 0.04559350564, 0.08261548653, 0.141566381,
-                    0.080507337, 0.1008071129, 0.1428650493, 0.1559862,
-                    0.112588743, 0.118781921, 0.1130751916, 0.0867054262]
-        
-
-        
         # self.diameter_midpoints = [149, 163, 178, 195, 213, 234, 272, 322, 422, 561, 748,
         #                     1054, 1358, 1802, 2440, 3062]
-        
-        self.diameter_midpoints = [149, 163, 178, 195, 213, 234, 272, 355, 455, 562, 749,
-                            1059, 1431, 1870, 2440, 3062]
+
+        # CORRECTED USING UPDATED NOAA MIE TABLE, defined once in dataGroupings
+        groupings = dataGroupings()
+        self.dlogdp = groupings.dlogdp
+        self.diameter_midpoints = groupings.diameter_midpoints
         
         # colorblind friendly colors
         # self.colors = ['#377eb8', '#ff7f00', '#4daf4a',
@@ -78,7 +74,7 @@ class basicVisualization:
 
 
         if rolling is not None:
-            timeseries_df = df.rolling(window=rolling, min_periods=1).mean()
+            timeseries_df = rollingStatistics(window=rolling, min_periods=1).mean(df.drop(columns=['DateTime']))
             timeseries_df['DateTime'] = df['DateTime']
         else:
             timeseries_df = df
@@ -275,13 +271,9 @@ class temporalAnalysis:
         # self.diameter_midpoints = [149, 163, 178, 195, 213, 234, 272, 322, 422, 561, 748,
         #                     1054, 1358, 1802, 2440, 3062]
 
-        self.dlogdp = [0.03645458169, 0.03940255269, 0.04033092159, 0.03849895488,
-                    0.03655010672, 0.04559350564, 0.08261548653, 0.141566381,
-                    0.080507337, 0.1008071129, 0.1428650493, 0.1559862,
-                    0.112588743, 0.118781921, 0.1130751916, 0.0867054262]
-        
-        self.diameter_midpoints = [149, 163, 178, 195, 213, 234, 272, 355, 455, 562, 749,
-                            1059, 1431, 1870, 2440, 3062]
+        groupings = dataGroupings()
+        self.dlogdp = groupings.dlogdp
+        self.diameter_midpoints = groupings.diameter_midpoints
         
         # colorblind friendly colors
         # self.colors = ['#377eb8', '#ff7f00', '#4daf4a',
@@ -703,115 +695,46 @@ class temporalAnalysis:
             df['DatetIme'] = df['DateTime'].dt.tz_localize('UTC').dt.tz_convert(colorado_tz)
             site_dict[site] = df
         
-        # group data by season
-        network_data['Season'] = network_data['DateTime'].dt.month.apply(self._sort_season)
-        # group by time
-        network_data['Hour'] = network_data['DateTime'].dt.time
-
-        # averages
-        network_averages = network_data.groupby(['Season', 'Hour']).mean().reset_index()
-        network_averages['Hour'] = network_averages['Hour'].apply(lambda x: x.strftime('%H'))
-        network_q1 = network_data.groupby(['Season', 'Hour']).quantile(0.25).reset_index()
-        network_q1['Hour'] = network_q1['Hour'].apply(lambda x: x.strftime('%H'))
-        network_q3 = network_data.groupby(['Season', 'Hour']).quantile(0.75).reset_index()
-        network_q3['Hour'] = network_q3['Hour'].apply(lambda x: x.strftime('%H'))
-        
-        seasonal_averages_dict = {}
-        seasonal_q1_dict = {}
-        seasonal_q3_dict = {}
+        # group data by season and hour
         for site, df in site_dict.items():
             df['Season'] = df['DateTime'].dt.month.apply(self._sort_season)
-            df['Hour'] = df['DateTime'].dt.time
-            seasonal_averages_dict[site] = df.groupby(['Season', 'Hour']).mean().reset_index()
-            seasonal_q1_dict[site] = df.groupby(['Season', 'Hour']).quantile(0.25).reset_index()
-            seasonal_q3_dict[site] = df.groupby(['Season', 'Hour']).quantile(0.75).reset_index()
-        
+            df['Hour'] = df['DateTime'].dt.strftime('%H')
+
+        # averages and quantiles for all sites in one pass
+        seasonal_stats = dataGroupings().grouped_statistics(site_dict, bin_names=[bin_name], group_by=['Season', 'Hour'], quantiles=(0.25, 0.75))
+
         n_sites = len(site_dict.keys())
 
+        season_colors = {
+            'Spring': '#f781bf',
+            'Summer': '#4daf4a',
+            'Fall': '#ff7f00',
+            'Winter': "#377eb8"
+        }
+
         fig, axes = plt.subplots(ncols=4, nrows=n_sites, sharey=True, sharex=True, figsize=(6.6,1.2*n_sites), dpi=300)
 
         for i, site in enumerate(site_dict.keys()):
-            averages = seasonal_averages_dict[site]
-            q1 = seasonal_q1_dict[site]
-            q3 = seasonal_q3_dict[site]
-
-            # convert hours to strings
-            averages['Hour'] = averages['Hour'].apply(lambda x: x.strftime('%H'))
-            q1['Hour'] = q1['Hour'].apply(lambda x: x.strftime('%H'))
-            q3['Hour'] = q3['Hour'].apply(lambda x: x.strftime('%H'))
-
-            # spring
-            spring_avgs = averages[averages['Season'] == 'Spring']
-            spring_q1 = q1[q1['Season'] == 'Spring']
-            spring_q3 = q3[q3['Season'] == 'Spring']
-            network_spring = network_averages[network_averages['Season'] == 'Spring']
-            axes[i,0].plot(spring_avgs['Hour'], spring_avgs[bin_name], color='#f781bf')
-            # fill between q1 and q3
-            axes[i,0].fill_between(spring_q1['Hour'], spring_q1[bin_name], spring_q3[bin_name], color='#f781bf', alpha=0.3)
+            site_stats = seasonal_stats[seasonal_stats['site'] == site]
+
+            for j, (season, color) in enumerate(season_colors.items()):
+                season_stats = site_stats[site_stats['Season'] == season]
+                axes[i,j].plot(season_stats['Hour'], season_stats['mean'], color=color)
+                # fill between q1 and q3
+                axes[i,j].fill_between(season_stats['Hour'], season_stats['q25'], season_stats['q75'], color=color, alpha=0.3)
+
             axes[i,0].set_ylabel(f'{site} \n cm$^{-3}$')
             axes[i,0].set_xticks([0, 12, 23])
 
-            # summer
-            summer_avgs = averages[averages['Season'] == 'Summer']
-            summer_q1 = q1[q1['Season'] == 'Summer']
-            summer_q3 = q3[q3['Season'] == 'Summer']
-            axes[i,1].plot(summer_avgs['Hour'], summer_avgs[bin_name], color='#4daf4a')
-            # fill between q1 and q3
-            axes[i,1].fill_between(summer_q1['Hour'], summer_q1[bin_name], summer_q3[bin_name], color='#4daf4a', alpha=0.3)
-
-            # fall
-            fall_avgs = averages[averages['Season'] == 'Fall']
-            fall_q1 = q1[q1['Season'] == 'Fall']
-            fall_q3 = q3[q3['Season'] == 'Fall']
-            axes[i,2].plot(fall_avgs['Hour'], fall_avgs[bin_name], color='#ff7f00')
-            # fill between q1 and q3
-            axes[i,2].fill_between(fall_q1['Hour'], fall_q1[bin_name], fall_q3[bin_name], color='#ff7f00', alpha=0.3)
-            
-            # winter
-            winter_avgs = averages[averages['Season'] == 'Winter']
-            winter_q1 = q1[q1['Season'] == 'Winter']
-            winter_q3 = q3[q3['Season'] == 'Winter']
-            axes[i,3].plot(winter_avgs['Hour'], winter_avgs[bin_name], color="#377eb8")
-            # fill between q1 and q3
-            axes[i,3].fill_between(winter_q1['Hour'], winter_q1[bin_name], winter_q3[bin_name], color="#377eb8", alpha=0.3)
-     
-        # plot network mean in the last row
-        network_spring = network_averages[network_averages['Season'] == 'Spring']
-        network_summer = network_averages[network_averages['Season'] == 'Summer']
-        network_fall = network_averages[network_averages['Season'] == 'Fall']
-        network_winter = network_averages[network_averages['Season'] == 'Winter']
-
-        # quantiles
-        network_spring_q1 = network_q1[network_q1['Season'] == 'Spring']
-        network_summer_q1 = network_q1[network_q1['Season'] == 'Summer']
-        network_fall_q1 = network_q1[network_q1['Season'] == 'Fall']
-        network_winter_q1 = network_q1[network_q1['Season'] == 'Winter']
-        network_spring_q3 = network_q3[network_q3['Season'] == 'Spring']
-        network_summer_q3 = network_q3[network_q3['Season'] == 'Summer']
-        network_fall_q3 = network_q3[network_q3['Season'] == 'Fall']
-        network_winter_q3 = network_q3[network_q3['Season'] == 'Winter']
-
-        # # spring
-        # axes[-1,0].plot(network_spring['Hour'], network_spring[bin_name], color='#4daf4a')
-        # # fill between q1 and q3
-        # axes[-1,0].fill_between(network_spring_q1['Hour'], network_spring_q1[bin_name], network_spring_q3[bin_name], color='#4daf4a', alpha=0.3)
+        # # plot network mean in the last row (needs network_data added to the grouped_statistics call)
+        # network_stats = seasonal_stats[seasonal_stats['site'] == 'network']
+        # for j, (season, color) in enumerate(season_colors.items()):
+        #     network_season = network_stats[network_stats['Season'] == season]
+        #     axes[-1,j].plot(network_season['Hour'], network_season['mean'], color=color)
+        #     # fill between q1 and q3
+        #     axes[-1,j].fill_between(network_season['Hour'], network_season['q25'], network_season['q75'], color=color, alpha=0.3)
         # axes[-1,0].set_ylabel('Network Mean \n cm$^{-3}$')
 
-        # # summer
-        # axes[-1,1].plot(network_summer['Hour'], network_summer[bin_name], color='#4daf4a')
-        # # fill between q1 and q3
-        # axes[-1,1].fill_between(network_summer_q1['Hour'], network_summer_q1[bin_name], network_summer_q3[bin_name], color='#4daf4a', alpha=0.3)
-
-        # # fall
-        # axes[-1,2].plot(network_fall['Hour'], network_fall[bin_name], color='#ff7f00')
-        # # fill between q1 and q3
-        # axes[-1,2].fill_between(network_fall_q1['Hour'], network_fall_q1[bin_name], network_fall_q3[bin_name], color='#ff7f00', alpha=0.3)
-
-        # # winter
-        # axes[-1,3].plot(network_winter['Hour'], network_winter[bin_name], color="#377eb8")
-        # # fill between q1 and q3
-        # axes[-1,3].fill_between(network_winter_q1['Hour'], network_winter_q1[bin_name], network_winter_q3[bin_name], color="#377eb8", alpha=0.3)
-                                          
         # set season names
         axes[0,0].set_title("Spring")
         axes[0,1].set_title("Summer")
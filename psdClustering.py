@@ -0,0 +1,298 @@
+"""
+Streaming classification of POPS size distributions into regimes (i.e. background, smoke, new particle growth).
+
+Each time step's 16 bin spectrum is converted to dN/dlogDp, normalised by its total
+concentration and log transformed, so samples are grouped by the shape of the size
+distribution rather than by how many particles there are. The clusters are found with
+mini-batch k-means, which only keeps the cluster centers in memory, so millions of
+5 second samples can be streamed one file at a time.
+"""
+
+# import packages
+import numpy as np
+import pandas as pd
+from dataHandling import POPSDataRetrival, dataGroupings
+
+
+class psdClustering:
+    """
+    Mini-batch k-means (Sculley 2010) of the log normalised b0-b15 spectra.
+
+    Every center moves toward the samples assigned to it with a learning rate of
+    1/(number of samples it has seen), so the result is the same as averaging
+    but never needs more than one batch in memory. Since the learning rate decays, fit seeds
+    the centers from a reservoir sample of the whole date range and visits the site-days in a
+    shuffled order, so a regime that only appears later in the stream still gets its own cluster.
+    With the same seed the result is deterministic.
+    """
+
+    def __init__(self, n_clusters=4, batch_size=1024, init_size=None, n_init=3, min_value=1e-3, seed=0):
+        """
+        Inputs:
+        - n_clusters: number of regimes, defaults to 4
+        - batch_size: number of samples in each mini-batch, defaults to 1024
+        - init_size: number of samples used for the k-means++ initialisation,
+            defaults to None which uses 3*batch_size
+        - n_init: number of k-means++ initialisations tried on the init_size samples, the one with the
+            lowest sum of squared distances is kept, defaults to 3
+        - min_value: floor of the normalised dN/dlogDp before taking the log, so empty bins are finite, defaults to 1e-3
+        - seed: random seed
+        """
+        groupings = dataGroupings()
+        self.dlogdp = np.array(groupings.dlogdp)
+        self.diameter_midpoints = np.array(groupings.diameter_midpoints)
+        self.bin_names = ['b' + str(i) for i in range(len(self.dlogdp))]
+
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.init_size = 3*batch_size if init_size is None else init_size
+        self.n_init = n_init
+        self.min_value = min_value
+        self.rng = np.random.default_rng(seed)
+
+        self.centers = None
+        self.center_counts = np.zeros(n_clusters)
+        self._init_buffer = []
+
+        # running sums for the cluster mean PSDs
+        self._psd_sums = np.zeros((n_clusters, len(self.dlogdp)))
+        self._normalized_sums = np.zeros((n_clusters, len(self.dlogdp)))
+        self._psd_counts = np.zeros(n_clusters, dtype=np.int64)
+
+    def features(self, df):
+        """
+        Computes the clustering features of each time step.
+
+        Inputs:
+        - df: df of POPS data with columns b0-b15
+
+        Returns: (time, bin) array of log10 normalised dN/dlogDp, boolean array of the valid time steps
+            (all bins present and a positive total), dN/dlogDp array
+        """
+
+        dndlogdp = df[self.bin_names].to_numpy(dtype=float)/self.dlogdp
+        total = np.sum(dndlogdp*self.dlogdp, axis=1)
+        valid = ~np.isnan(dndlogdp).any(axis=1) & (total > 0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            normalized = dndlogdp/total[:, None]
+        features = np.log10(np.maximum(np.where(valid[:, None], normalized, 1), self.min_value))
+
+        return features, valid, dndlogdp
+
+    def partial_fit(self, df):
+        """
+        Updates the centers with the valid time steps of a df, in shuffled mini-batches.
+        If the centers have not been initialised (by fit), the first init_size samples
+        are held back for the initialisation.
+
+        Inputs:
+        - df: df of POPS data with columns b0-b15
+
+        Returns: self
+        """
+
+        features, valid, _ = self.features(df)
+        features = features[valid]
+
+        if self.centers is None:
+            self._init_buffer.append(features)
+            if sum(len(buffer) for buffer in self._init_buffer) < self.init_size:
+                return self
+            features = np.vstack(self._init_buffer)
+            self._init_buffer = []
+            self.centers = self._initialize(features[:self.init_size])
+
+        order = self.rng.permutation(len(features))
+        for start in range(0, len(order), self.batch_size):
+            self._update(features[order[start:start + self.batch_size]])
+
+        return self
+
+    def fit(self, sites, start_date, end_date, subsample=None, n_passes=1):
+        """
+        Streams the POPS files one day at a time: a first pass draws a reservoir sample of init_size
+        time steps from the whole date range for the k-means++ initialisation, then every pass feeds
+        the site-days through partial_fit in a shuffled order.
+
+        Inputs:
+        - sites: list of sites
+        - start_date: start of date range in form 'yyyymmdd' (str)
+        - end_date: end of date range in form 'yyyymmdd' (str)
+        - subsample: number of gaps between 5 second samples, defaults to None
+        - n_passes: number of passes over the data after the initialisation, defaults to 1
+
+        Returns: self
+        """
+
+        dates = pd.date_range(pd.to_datetime(start_date, format='%Y%m%d'), pd.to_datetime(end_date, format='%Y%m%d')).strftime('%Y%m%d')
+        site_days = [(site, day) for site in sites for day in dates]
+
+        if self.centers is None:
+            reservoir = self._reservoir_sample(self._iterate(site_days, subsample))
+            if len(reservoir) < self.n_clusters:
+                raise ValueError('Not enough valid samples for ' + str(self.n_clusters) + ' clusters')
+            self.centers = self._initialize(reservoir)
+
+        for _ in range(n_passes):
+            order = self.rng.permutation(len(site_days))
+            for df in self._iterate([site_days[i] for i in order], subsample):
+                self.partial_fit(df)
+
+        return self
+
+    def predict(self, df, accumulate=False):
+        """
+        Assigns each time step of a df to its nearest center.
+
+        Inputs:
+        - df: df of POPS data with columns 'DateTime' and b0-b15
+        - accumulate: (bool) add the time steps to the cluster mean PSDs (see cluster_psds), defaults to False
+
+        Returns: series of the cluster of each time step indexed by DateTime, -1 where the spectrum is not valid
+        """
+
+        if self.centers is None:
+            raise ValueError('Fit the clusters before predicting')
+
+        features, valid, dndlogdp = self.features(df)
+        labels = np.full(len(features), -1, dtype=np.int64)
+        labels[valid] = self._nearest(features[valid])
+
+        if accumulate:
+            assigned = labels[valid]
+            dndlogdp = dndlogdp[valid]
+            np.add.at(self._psd_sums, assigned, dndlogdp)
+            np.add.at(self._normalized_sums, assigned, dndlogdp/np.sum(dndlogdp*self.dlogdp, axis=1)[:, None])
+            self._psd_counts += np.bincount(assigned, minlength=self.n_clusters)
+
+        return pd.Series(labels, index=pd.DatetimeIndex(pd.to_datetime(df['DateTime']), name='DateTime'), name='cluster')
+
+    def assign(self, sites, start_date, end_date, subsample=None):
+        """
+        Streams the POPS files one day at a time and labels every time step.
+        The cluster mean PSDs are reset and then computed from the labelled time steps.
+
+        Inputs:
+        - sites: list of sites
+        - start_date: start of date range in form 'yyyymmdd' (str)
+        - end_date: end of date range in form 'yyyymmdd' (str)
+        - subsample: number of gaps between 5 second samples, defaults to None
+
+        Returns: dict of site -> series of cluster labels indexed by DateTime
+        """
+
+        self._psd_sums[:] = 0
+        self._normalized_sums[:] = 0
+        self._psd_counts[:] = 0
+
+        labels = {site: [] for site in sites}
+        for site, day, df in POPSDataRetrival().iterate_datasets(sites, start_date, end_date, subsample=subsample):
+            labels[site].append(self.predict(df, accumulate=True))
+
+        # smallest signed dtype that holds the labels and -1
+        dtype = np.min_scalar_type(-self.n_clusters)
+        return {site: pd.concat(series).astype(dtype) for site, series in labels.items() if series}
+
+    def cluster_psds(self, normalized=False):
+        """
+        Computes the mean PSD of every cluster from the time steps labelled by the last assign
+        (and any predict calls with accumulate=True since).
+
+        Inputs:
+        - normalized: (bool) return the mean normalised dN/dlogDp (integrates to 1) instead of
+            the mean dN/dlogDp in cm^-3, defaults to False
+
+        Returns: df with one row per cluster, one column per diameter midpoint (nm), and a 'count' column
+        """
+
+        sums = self._normalized_sums if normalized else self._psd_sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums/self._psd_counts[:, None]
+
+        psds = pd.DataFrame(means, index=pd.Index(range(self.n_clusters), name='cluster'), columns=self.diameter_midpoints)
+        psds['count'] = self._psd_counts
+
+        return psds
+
+    def _update(self, batch):
+        """
+        One mini-batch step: assign the batch, then move each center by the
+        per-center learning rate toward its samples.
+        """
+
+        labels = self._nearest(batch)
+        counts = np.bincount(labels, minlength=self.n_clusters)
+        sums = np.zeros_like(self.centers)
+        np.add.at(sums, labels, batch)
+
+        # same as stepping through the samples one at a time with rate 1/count
+        seen = counts > 0
+        self.center_counts[seen] += counts[seen]
+        self.centers[seen] += (sums[seen] - counts[seen, None]*self.centers[seen])/self.center_counts[seen, None]
+
+    def _distances(self, features, centers=None):
+        # squared distances to every center without building a (sample, center, bin) array
+        centers = self.centers if centers is None else centers
+        return np.sum(features**2, axis=1)[:, None] - 2*features @ centers.T + np.sum(centers**2, axis=1)
+
+    def _nearest(self, features):
+        return np.argmin(self._distances(features), axis=1)
+
+    def _iterate(self, site_days, subsample):
+        """
+        Yields the df of each (site, day) in the given order.
+        """
+
+        retrieval = POPSDataRetrival()
+        for site, day in site_days:
+            for _, _, df in retrieval.iterate_datasets([site], day, day, subsample=subsample):
+                yield df
+
+    def _reservoir_sample(self, dfs):
+        """
+        Uniform sample of init_size valid time steps from a stream of dfs: every sample gets a random
+        key and the init_size smallest keys are kept, so memory is bounded by init_size plus one df.
+        """
+
+        samples = np.zeros((0, len(self.dlogdp)))
+        keys = np.zeros(0)
+        for df in dfs:
+            features, valid, _ = self.features(df)
+            samples = np.vstack([samples, features[valid]])
+            keys = np.concatenate([keys, self.rng.random(np.count_nonzero(valid))])
+            if len(keys) > self.init_size:
+                keep = np.argpartition(keys, self.init_size)[:self.init_size]
+                samples, keys = samples[keep], keys[keep]
+
+        return samples[np.argsort(keys, kind='stable')]
+
+    def _initialize(self, features):
+        """
+        Best of n_init k-means++ initialisations (lowest sum of squared distances to the nearest center).
+        """
+
+        best_centers, best_inertia = None, np.inf
+        for _ in range(self.n_init):
+            centers = self._kmeans_plus_plus(features)
+            inertia = self._distances(features, centers).min(axis=1).sum()
+            if inertia < best_inertia:
+                best_centers, best_inertia = centers, inertia
+
+        return best_centers
+
+    def _kmeans_plus_plus(self, features):
+        """
+        k-means++ initialisation: each new center is drawn with probability
+        proportional to the squared distance to the nearest chosen center.
+        """
+
+        centers = [features[self.rng.integers(len(features))]]
+        distances = np.sum((features - centers[0])**2, axis=1)
+        for _ in range(1, self.n_clusters):
+            total = distances.sum()
+            index = self.rng.choice(len(features), p=distances/total) if total > 0 else self.rng.integers(len(features))
+            centers.append(features[index])
+            distances = np.minimum(distances, np.sum((features - features[index])**2, axis=1))
+
+        return np.array(centers)
@@ -0,0 +1,222 @@
+"""
+Streaming, mergeable quantile sketches for full resolution POPS data.
+
+Exact quantiles need every sample in memory. These sketches keep a fixed number of
+logarithmically spaced counters per key instead, so medians, IQRs and 5-95 % ranges
+can be computed from 5 second data over the whole campaign.
+"""
+
+# import packages
+import numpy as np
+import pandas as pd
+from dataHandling import POPSDataRetrival, dataGroupings
+
+
+class quantileSketch:
+    """
+    Relative error quantile sketch (DDSketch, Masson et al. 2019) kept for many keys at once,
+    e.g. one sketch per (site, season, hour, bin).
+
+    Error bound: for any quantile q, the returned value x' satisfies |x' - x| <= relative_accuracy * |x|,
+    where x is the exact q-quantile (lower rank convention) of the ingested data. This holds for
+    min_value <= |x| <= max_value; values smaller in magnitude than min_value are counted as 0 and values
+    larger than max_value are counted in the last bucket.
+
+    Memory is bounded by the number of keys times the number of buckets, independent of the number
+    of samples, and sketches built from different data (i.e. on parallel workers) are merged by adding counts.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-3, max_value=1e5, key_names=('site', 'Season', 'Hour', 'bin')):
+        """
+        Inputs:
+        - relative_accuracy: relative error bound of the returned quantiles, defaults to 0.01 (1 %)
+        - min_value: smallest magnitude resolved by the sketch, defaults to 1e-3
+        - max_value: largest magnitude resolved by the sketch, defaults to 1e5
+        - key_names: names of the parts of each key
+        """
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.key_names = list(key_names)
+
+        # bucket i holds values in (gamma^(i-1), gamma^i]
+        self.gamma = (1 + relative_accuracy)/(1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.offset = int(np.ceil(np.log(min_value)/self.log_gamma))
+        self.n_buckets = int(np.ceil(np.log(max_value)/self.log_gamma)) - self.offset + 1
+
+        # key -> row in the count arrays
+        self.keys = {}
+        self.positive = np.zeros((0, self.n_buckets), dtype=np.int32)
+        self.negative = np.zeros((0, self.n_buckets), dtype=np.int32)
+        self.zeros = np.zeros(0, dtype=np.int32)
+
+        self.seasons = np.array([None, 'Winter', 'Winter', 'Spring', 'Spring', 'Spring', 'Summer',
+                                 'Summer', 'Summer', 'Fall', 'Fall', 'Fall', 'Winter'], dtype=object)
+
+    def update(self, keys, values):
+        """
+        Adds values to the sketches of their keys. nans are ignored.
+
+        Inputs:
+        - keys: df with one column per key part (in the order of key_names) and one row per value
+        - values: array of values, same length as keys
+        """
+
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        if not valid.any():
+            return
+
+        codes, uniques = pd.MultiIndex.from_frame(keys[valid]).factorize()
+        values = values[valid]
+        rows = self._get_rows(list(uniques))
+
+        magnitude = np.abs(values)
+        is_zero = magnitude < self.min_value
+        buckets = np.ceil(np.log(np.where(is_zero, 1, magnitude))/self.log_gamma).astype(int) - self.offset
+        buckets = buckets.clip(0, self.n_buckets - 1)
+
+        # count all values of this update in one bincount per store
+        for store, select in [(self.positive, (values > 0) & ~is_zero), (self.negative, (values < 0) & ~is_zero)]:
+            flat = codes[select]*self.n_buckets + buckets[select]
+            store[rows] += np.bincount(flat, minlength=len(uniques)*self.n_buckets).reshape(len(uniques), self.n_buckets)
+        self.zeros[rows] += np.bincount(codes[is_zero], minlength=len(uniques))
+
+    def update_from_df(self, df, site, bin_names, timezone='MST'):
+        """
+        Adds a df of site data to the (site, season, hour, bin) sketches.
+
+        Inputs:
+        - df: df of POPS data with a 'DateTime' column in UTC
+        - site: name of the site
+        - bin_names: list of bin names to sketch
+        - timezone: timezone used for the season and hour, defaults to 'MST'
+        """
+
+        datetimes = pd.to_datetime(df['DateTime']).dt.tz_localize('UTC').dt.tz_convert(timezone)
+        keys = pd.DataFrame({
+            'site': site,
+            'Season': self.seasons[datetimes.dt.month.to_numpy()],
+            'Hour': datetimes.dt.strftime('%H').to_numpy(),
+        })
+
+        for bin in bin_names:
+            keys['bin'] = bin
+            self.update(keys, df[bin].to_numpy())
+
+    def ingest(self, sites, start_date, end_date, bin_names, grouping_option=None, subsample=None, timezone='MST'):
+        """
+        Streams the POPS files one day at a time into the sketches, so only one day
+        of full resolution data is ever in memory.
+
+        To run in parallel, ingest different sites or date ranges in separate workers and merge the results.
+
+        Inputs:
+        - sites: list of sites
+        - start_date: start of date range in form 'yyyymmdd' (str)
+        - end_date: end of date range in form 'yyyymmdd' (str)
+        - bin_names: list of bin names to sketch
+        - grouping_option: option passed to dataGroupings.bin_groupings, defaults to None for the 16 bins
+        - subsample: number of gaps between 5 second samples, defaults to None
+        - timezone: timezone used for the season and hour, defaults to 'MST'
+
+        Returns: self
+        """
+
+        groupings = dataGroupings()
+        for site, day, df in POPSDataRetrival().iterate_datasets(sites, start_date, end_date, subsample=subsample):
+            if grouping_option is not None:
+                df = groupings.bin_groupings(df, grouping_option)
+            self.update_from_df(df, site, bin_names, timezone=timezone)
+
+        return self
+
+    def merge(self, other):
+        """
+        Adds the counts of another sketch into this one.
+
+        Inputs:
+        - other: quantileSketch built with the same relative_accuracy, min_value and max_value
+
+        Returns: self
+        """
+
+        if (other.relative_accuracy, other.min_value, other.max_value) != (self.relative_accuracy, self.min_value, self.max_value):
+            raise ValueError('Can only merge sketches with the same relative_accuracy, min_value and max_value')
+
+        rows = self._get_rows(list(other.keys.keys()))
+        other_rows = list(other.keys.values())
+        self.positive[rows] += other.positive[other_rows]
+        self.negative[rows] += other.negative[other_rows]
+        self.zeros[rows] += other.zeros[other_rows]
+
+        return self
+
+    def quantiles(self, quantiles):
+        """
+        Estimates quantiles for every key.
+
+        Inputs:
+        - quantiles: list of quantiles between 0 and 1
+
+        Returns: df indexed by key with a 'count' column and one column per quantile, i.e. 'q25' for 0.25
+        """
+
+        # all buckets in increasing order: negative (largest magnitude first), zero, positive
+        counts = np.hstack([self.negative[:, ::-1], self.zeros[:, None], self.positive])
+        cumulative = np.cumsum(counts, axis=1)
+        total = cumulative[:, -1]
+
+        bucket_values = self._bucket_values()
+        representative = np.concatenate([-bucket_values[::-1], [0], bucket_values])
+
+        result = pd.DataFrame(index=pd.MultiIndex.from_tuples(list(self.keys.keys()), names=self.key_names))
+        result['count'] = total
+        for q in quantiles:
+            rank = q*(total - 1)
+            bucket = (cumulative > rank[:, None]).argmax(axis=1)
+            estimate = representative[bucket]
+            estimate[total == 0] = np.nan
+            result[f'q{q*100:g}'] = estimate
+
+        return result
+
+    def summary(self):
+        """
+        Computes the median, interquartile range, and 5-95 % range for every key.
+
+        Returns: df indexed by key with columns 'count', 'median', 'iqr' and 'middle_90'
+        """
+
+        quantiles = self.quantiles([0.05, 0.25, 0.5, 0.75, 0.95])
+
+        summary = pd.DataFrame(index=quantiles.index)
+        summary['count'] = quantiles['count']
+        summary['median'] = quantiles['q50']
+        summary['iqr'] = quantiles['q75'] - quantiles['q25']
+        summary['middle_90'] = quantiles['q95'] - quantiles['q5']
+
+        return summary
+
+    def _bucket_values(self):
+        """
+        Value returned for each positive bucket, within relative_accuracy of every value in the bucket.
+        """
+        indices = np.arange(self.n_buckets) + self.offset
+        return 2*self.gamma**indices/(self.gamma + 1)
+
+    def _get_rows(self, keys):
+        """
+        Returns the rows of the given keys, adding rows for keys not seen before.
+        """
+
+        new_keys = [key for key in keys if key not in self.keys]
+        if new_keys:
+            for key in new_keys:
+                self.keys[key] = len(self.keys)
+            self.positive = np.vstack([self.positive, np.zeros((len(new_keys), self.n_buckets), dtype=np.int32)])
+            self.negative = np.vstack([self.negative, np.zeros((len(new_keys), self.n_buckets), dtype=np.int32)])
+            self.zeros = np.concatenate([self.zeros, np.zeros(len(new_keys), dtype=np.int32)])
+
+        return np.array([self.keys[key] for key in keys], dtype=int)
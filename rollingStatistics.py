@@ -0,0 +1,530 @@
+"""
+Rolling window statistics over (time, bin) arrays for long, full resolution timeseries.
+
+All bins are processed at once and nans are skipped inside each window the same way as
+pandas' DataFrame.rolling(window, min_periods): a result is only returned where the window
+holds at least min_periods valid values. Windows are trailing (the value at t uses t-window+1 to t).
+
+Run this file directly to check the accuracy on level shifted data and benchmark against pandas.
+"""
+
+# import packages
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class rollingStatistics:
+    """
+    Class for rolling mean, std, min, max, median and median absolute deviation (MAD).
+
+    - mean and std use running sums around a local shift, O(1) per step
+    - min and max use the van Herk/Gil-Werman block algorithm, the vectorized equivalent of
+      a monotonic deque, O(1) per step
+    - median and MAD sort each window in bounded chunks for windows up to sort_window, where sorting is
+      faster, and read order statistics from a wavelet matrix for longer windows, O(log n) per step
+      for the median and O(log window log n) for MAD
+    """
+
+    # longest window that is sorted directly for median and MAD
+    sort_window = 256
+
+    def __init__(self, window, min_periods=None, chunk_size=2**22):
+        """
+        Inputs:
+        - window: number of values in each window (int)
+        - min_periods: minimum number of valid values needed for a result,
+            defaults to None which uses the window size (same as pandas)
+        - chunk_size: approximate number of elements held in memory at once for median and MAD
+            (each chunk of chunk_size // 16 rows stores one prefix count per row and bit of the rank)
+        """
+        self.window = window
+        self.min_periods = window if min_periods is None else min_periods
+        self.chunk_size = chunk_size
+
+    def count(self, data):
+        """
+        Returns the number of valid values in each window.
+
+        Inputs:
+        - data: df, series, or array with time along the first axis
+        """
+        values, wrap = self._prepare(data)
+        result = self._count(values).astype(float)
+        # same as pandas: nan only for the leading windows shorter than min_periods
+        result[:max(self.min_periods - 1, 0)] = np.nan
+        return wrap(result)
+
+    def mean(self, data):
+        """
+        Returns the rolling mean.
+
+        Inputs:
+        - data: df, series, or array with time along the first axis
+        """
+        values, wrap = self._prepare(data)
+        counts, sums, _, shifts = self._local_sums(values)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = shifts + sums/counts
+
+        return wrap(self._apply_min_periods(result, counts))
+
+    def std(self, data, ddof=1):
+        """
+        Returns the rolling standard deviation.
+
+        Inputs:
+        - data: df, series, or array with time along the first axis
+        - ddof: delta degrees of freedom, defaults to 1 (same as pandas)
+        """
+        values, wrap = self._prepare(data)
+        counts, sums, squares, _ = self._local_sums(values)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = (squares - sums**2/counts)/(counts - ddof)
+        variance[counts - ddof <= 0] = np.nan
+
+        return wrap(self._apply_min_periods(np.sqrt(variance.clip(min=0)), counts))
+
+    def max(self, data):
+        """
+        Returns the rolling maximum.
+
+        Inputs:
+        - data: df, series, or array with time along the first axis
+        """
+        values, wrap = self._prepare(data)
+        result = self._block_extreme(np.where(np.isnan(values), -np.inf, values), np.maximum)
+        return wrap(self._apply_min_periods(result, self._count(values)))
+
+    def min(self, data):
+        """
+        Returns the rolling minimum.
+
+        Inputs:
+        - data: df, series, or array with time along the first axis
+        """
+        values, wrap = self._prepare(data)
+        result = self._block_extreme(np.where(np.isnan(values), np.inf, values), np.minimum)
+        return wrap(self._apply_min_periods(result, self._count(values)))
+
+    def median(self, data):
+        """
+        Returns the rolling median.
+
+        Inputs:
+        - data: df, series, or array with time along the first axis
+        """
+        values, wrap = self._prepare(data)
+        result = self._order_statistics(values, mad=False)
+        return wrap(self._apply_min_periods(result, self._count(values)))
+
+    def mad(self, data):
+        """
+        Returns the rolling median absolute deviation, median(|x - median(x)|) of each window (unscaled).
+
+        Inputs:
+        - data: df, series, or array with time along the first axis
+        """
+        values, wrap = self._prepare(data)
+        result = self._order_statistics(values, mad=True)
+        return wrap(self._apply_min_periods(result, self._count(values)))
+
+    def _prepare(self, data):
+        """
+        Converts the input to a 2D float array and returns a function that converts
+        results back to the input type.
+        """
+
+        if isinstance(data, pd.DataFrame):
+            return data.to_numpy(dtype=float), lambda result: pd.DataFrame(result, index=data.index, columns=data.columns)
+        if isinstance(data, pd.Series):
+            return data.to_numpy(dtype=float)[:, None], lambda result: pd.Series(result[:, 0], index=data.index, name=data.name)
+
+        values = np.asarray(data, dtype=float)
+        if values.ndim == 1:
+            return values[:, None], lambda result: result[:, 0]
+        return values, lambda result: result
+
+    def _rolling_sum(self, values):
+        """
+        Trailing window sums using a running (cumulative) sum.
+        """
+        cumulative = np.cumsum(values, axis=0)
+        sums = cumulative.copy()
+        sums[self.window:] -= cumulative[:-self.window]
+        return sums
+
+    def _local_sums(self, values):
+        """
+        Trailing window sums and sums of squares, each taken around a local shift.
+
+        The (front padded) series is split into blocks of the window size and each block is centered
+        on its own mean. A window ending in block k is a prefix of block k plus a suffix of block k-1,
+        so its sums around block k's mean are built from the running sums within the two blocks
+        (the same split as the van Herk/Gil-Werman min and max). The rounding error is then bounded by
+        the spread of two neighbouring blocks instead of growing with the series length or the
+        distance to the global mean (i.e. after a level shift).
+
+        Returns: counts, sums, sums of squares, and the shift they are taken around, all (time, bin)
+        """
+
+        window = self.window
+        n_times, n_bins = values.shape
+
+        n_blocks = int(np.ceil((n_times + window - 1)/window))
+        padded = np.full((n_blocks*window, n_bins), np.nan)
+        padded[window - 1:window - 1 + n_times] = values
+        blocks = padded.reshape(n_blocks, window, n_bins)
+
+        valid = ~np.isnan(blocks)
+        prefix_counts = np.cumsum(valid, axis=1)
+        centered = np.where(valid, blocks, 0)
+        shift = centered.sum(axis=1)/np.maximum(prefix_counts[:, -1], 1)
+        centered -= shift[:, None]
+        centered *= valid
+
+        # running sums within each block and the remainder (suffix) of the previous block
+        prefix_sums = np.cumsum(centered, axis=1)
+        prefix_squares = np.cumsum(np.square(centered, out=centered), axis=1)
+        suffix_counts, suffix_sums, suffix_squares = [np.zeros_like(prefix) for prefix in [prefix_counts, prefix_sums, prefix_squares]]
+        np.subtract(prefix_counts[:-1, -1:], prefix_counts[:-1], out=suffix_counts[1:])
+        np.subtract(prefix_sums[:-1, -1:], prefix_sums[:-1], out=suffix_sums[1:])
+        np.subtract(prefix_squares[:-1, -1:], prefix_squares[:-1], out=suffix_squares[1:])
+
+        # move the previous block's part from its shift to this block's shift
+        difference = np.zeros_like(shift)
+        difference[1:] = shift[:-1] - shift[1:]
+        difference = difference[:, None]
+        squares = prefix_squares + suffix_squares + (2*suffix_sums + suffix_counts*difference)*difference
+        sums = prefix_sums + suffix_sums + suffix_counts*difference
+
+        counts = prefix_counts + suffix_counts
+
+        rows = slice(window - 1, window - 1 + n_times)
+        return (counts.reshape(-1, n_bins)[rows], sums.reshape(-1, n_bins)[rows],
+                squares.reshape(-1, n_bins)[rows], np.repeat(shift, window, axis=0)[rows])
+
+    def _count(self, values):
+        return self._rolling_sum((~np.isnan(values)).astype(np.int64))
+
+    def _apply_min_periods(self, result, counts):
+        result[(counts < max(self.min_periods, 1))] = np.nan
+        return result
+
+    def _block_extreme(self, values, function):
+        """
+        van Herk/Gil-Werman algorithm: split the (front padded) series into blocks of the window size,
+        take running extremes forwards and backwards within each block, and combine one value from each.
+        """
+
+        window = self.window
+        n_times, n_bins = values.shape
+        fill = -np.inf if function is np.maximum else np.inf
+
+        # pad in front for the partial windows at the start, and at the end to whole blocks
+        n_blocks = int(np.ceil((n_times + window - 1)/window))
+        padded = np.full((n_blocks*window, n_bins), fill)
+        padded[window - 1:window - 1 + n_times] = values
+        blocks = padded.reshape(n_blocks, window, n_bins)
+
+        prefix = function.accumulate(blocks, axis=1).reshape(-1, n_bins)
+        suffix = function.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(-1, n_bins)
+
+        return function(suffix[:n_times], prefix[window - 1:window - 1 + n_times])
+
+    def _sorted_windows(self, values, mad):
+        """
+        Median (or MAD) of each window, sorting the windows chunk by chunk to bound memory.
+        """
+
+        window = self.window
+        n_times, n_bins = values.shape
+        padded = np.vstack([np.full((window - 1, n_bins), np.nan), values])
+        result = np.empty((n_times, n_bins))
+
+        chunk = max(1, self.chunk_size // (window*n_bins))
+        for start in range(0, n_times, chunk):
+            end = min(start + chunk, n_times)
+            # (time, bin, window), nans sort to the end
+            windows = np.sort(sliding_window_view(padded[start:end + window - 1], window, axis=0), axis=-1)
+            medians = self._sorted_median(windows)
+            if mad:
+                deviations = np.sort(np.abs(windows - medians[..., None]), axis=-1)
+                medians = self._sorted_median(deviations)
+            result[start:end] = medians
+
+        return result
+
+    def _sorted_median(self, windows):
+        counts = np.sum(~np.isnan(windows), axis=-1)
+        lower = ((counts - 1) // 2).clip(min=0)
+        upper = (counts // 2).clip(min=0)
+        median = (np.take_along_axis(windows, lower[..., None], axis=-1) + np.take_along_axis(windows, upper[..., None], axis=-1))[..., 0]/2
+        median[counts == 0] = np.nan
+        return median
+
+    def _order_statistics(self, values, mad):
+        """
+        Median (or MAD) of each window, sorted directly for short windows and from a wavelet matrix otherwise.
+        """
+
+        if self.window <= self.sort_window:
+            return self._sorted_windows(values, mad)
+        return self._wavelet_windows(values, mad)
+
+    def _wavelet_windows(self, values, mad):
+        """
+        Median (or MAD) of each window from a wavelet matrix of each bin, built chunk by chunk to bound memory.
+
+        The wavelet matrix (Claude et al. 2012) stores the bits of every value's rank, level by level, with
+        prefix counts of the zeros. The k-th smallest value of any range is then found by walking down the
+        levels, O(log n) per window and vectorized over all windows of a chunk, independent of the window size.
+        """
+
+        window = self.window
+        n_times, n_bins = values.shape
+        padded = np.vstack([np.full((window - 1, n_bins), np.nan), values])
+        counts = self._count(values)
+        result = np.empty((n_times, n_bins))
+
+        chunk = max(window, self.chunk_size // 16)
+        for start in range(0, n_times, chunk):
+            end = min(start + chunk, n_times)
+            # windows of this chunk are [left, left + window) of the segment
+            left = np.arange(end - start)
+            right = left + window
+            for b in range(n_bins):
+                matrix = self._wavelet_matrix(padded[start:end + window - 1, b])
+                n_valid = counts[start:end, b]
+                medians = self._window_median(matrix, left, right, n_valid)
+                if mad:
+                    medians = self._window_mad(matrix, left, right, n_valid, medians)
+                result[start:end, b] = medians
+
+        return result
+
+    def _wavelet_matrix(self, values):
+        """
+        Builds the wavelet matrix of the ranks of a 1D array (nans get the largest ranks).
+
+        Returns: values sorted by rank, (level, n + 1) prefix counts of zero bits, number of zeros of each level
+        """
+
+        n = len(values)
+        order = np.argsort(values, kind='stable')
+        ranks = np.empty(n, dtype=np.int64)
+        ranks[order] = np.arange(n)
+
+        n_levels = max(1, n.bit_length())
+        zeros = np.zeros((n_levels, n + 1), dtype=np.int64)
+        n_zeros = np.zeros(n_levels, dtype=np.int64)
+        for level in range(n_levels):
+            is_zero = ((ranks >> (n_levels - 1 - level)) & 1) == 0
+            np.cumsum(is_zero, out=zeros[level, 1:])
+            n_zeros[level] = zeros[level, -1]
+            # stable partition: zeros first, then ones
+            ranks = np.concatenate([ranks[is_zero], ranks[~is_zero]])
+
+        return values[order], zeros, n_zeros
+
+    def _kth(self, matrix, left, right, k):
+        """
+        k-th smallest (0-based) value of each range [left, right) of the wavelet matrix.
+        """
+
+        sorted_values, zeros, n_zeros = matrix
+        rank = np.zeros(len(k), dtype=np.int64)
+        for level in range(len(n_zeros)):
+            zeros_left = zeros[level, left]
+            zeros_right = zeros[level, right]
+            n_left = zeros_right - zeros_left
+            go_right = k >= n_left
+            k = np.where(go_right, k - n_left, k)
+            left = np.where(go_right, n_zeros[level] + left - zeros_left, zeros_left)
+            right = np.where(go_right, n_zeros[level] + right - zeros_right, zeros_right)
+            rank = (rank << 1) | go_right
+
+        return sorted_values[rank]
+
+    def _count_below(self, matrix, left, right, threshold):
+        """
+        Number of values with rank below threshold in each range [left, right) of the wavelet matrix.
+        """
+
+        _, zeros, n_zeros = matrix
+        n_levels = len(n_zeros)
+        count = np.zeros(len(left), dtype=np.int64)
+        for level in range(n_levels):
+            zeros_left = zeros[level, left]
+            zeros_right = zeros[level, right]
+            bit = ((threshold >> (n_levels - 1 - level)) & 1) == 1
+            # ranks with a 0 where the threshold has a 1 are all below it
+            count += np.where(bit, zeros_right - zeros_left, 0)
+            left = np.where(bit, n_zeros[level] + left - zeros_left, zeros_left)
+            right = np.where(bit, n_zeros[level] + right - zeros_right, zeros_right)
+
+        return count
+
+    def _window_median(self, matrix, left, right, n_valid):
+        """
+        Median of the valid values of each window, the mean of the two middle values for an even count.
+        """
+
+        # nans have the largest ranks, so the first n_valid values of a window are its valid ones
+        lower = self._kth(matrix, left, right, ((n_valid - 1) // 2).clip(min=0))
+        upper = self._kth(matrix, left, right, n_valid // 2)
+        median = (lower + upper)/2
+        median[n_valid == 0] = np.nan
+        return median
+
+    def _window_mad(self, matrix, left, right, n_valid, medians):
+        """
+        Median of |x - median| of the valid values of each window.
+
+        The deviations above the median (ascending) and below it (ascending away from it) are two sorted
+        lists read from the wavelet matrix, so the k-th smallest deviation is the k-th of two sorted lists,
+        found by a binary search on how many are taken from the list above the median.
+        """
+
+        sorted_values, _, _ = matrix
+        has_data = n_valid > 0
+        left, right, n_valid, medians = left[has_data], right[has_data], n_valid[has_data], medians[has_data]
+
+        # valid values below the median: positions [0, n_below) of the window's sorted values
+        n_below = self._count_below(matrix, left, right, np.searchsorted(sorted_values, medians, side='left'))
+        n_above = n_valid - n_below
+
+        def above(i):
+            return self._kth(matrix, left[select], right[select], n_below[select] + i) - medians[select]
+
+        def below(i):
+            return medians[select] - self._kth(matrix, left[select], right[select], n_below[select] - 1 - i)
+
+        # (k + 1) smallest deviations: a from above and k + 1 - a from below
+        k = (n_valid - 1) // 2
+        low = np.maximum(0, k + 1 - n_below)
+        high = np.minimum(k + 1, n_above)
+        for _ in range(int(self.window).bit_length() + 1):
+            select = np.flatnonzero(low < high)
+            if len(select) == 0:
+                break
+            middle = (low[select] + high[select]) // 2
+            take_above = above(middle) < below(k[select] - middle)
+            low[select] = np.where(take_above, middle + 1, low[select])
+            high[select] = np.where(take_above, high[select], middle)
+
+        # k-th deviation: the larger of the last taken from each list
+        taken = low
+        kth = np.full(len(k), -np.inf)
+        select = np.flatnonzero(taken > 0)
+        kth[select] = above(taken[select] - 1)
+        select = np.flatnonzero(k + 1 - taken > 0)
+        kth[select] = np.maximum(kth[select], below(k[select] - taken[select]))
+
+        # (k + 1)-th deviation for even counts: the smaller of the next of each list
+        next_kth = np.full(len(k), np.inf)
+        select = np.flatnonzero(taken < n_above)
+        next_kth[select] = above(taken[select])
+        select = np.flatnonzero(k + 1 - taken < n_below)
+        next_kth[select] = np.minimum(next_kth[select], below(k[select] + 1 - taken[select]))
+
+        mad = np.full(len(has_data), np.nan)
+        mad[has_data] = np.where(n_valid % 2 == 0, (kth + next_kth)/2, kth)
+        return mad
+
+
+def benchmark(n_rows=10_000_000, n_bins=1, windows=(60, 720, 4320, 17280), min_periods=1, nan_fraction=0.05, seed=0):
+    """
+    Times each rolling statistic against pandas for each window size and prints the speed up and the
+    largest difference. pandas has no rolling MAD, so only its time is printed.
+
+    Inputs:
+    - n_rows: number of timesteps, defaults to 10 million
+    - n_bins: number of bins (columns), defaults to 1
+    - windows: window sizes, defaults to 5 minutes, 1 hour, 6 hours and 1 day of 5 second data
+    - min_periods: minimum number of valid values in a window, defaults to 1
+    - nan_fraction: fraction of values set to nan, defaults to 0.05
+    - seed: random seed
+    """
+
+    rng = np.random.default_rng(seed)
+    values = rng.lognormal(size=(n_rows, n_bins))
+    values[rng.random(values.shape) < nan_fraction] = np.nan
+    df = pd.DataFrame(values)
+
+    for window in windows:
+        print(f'window {window}:')
+        rolling = rollingStatistics(window, min_periods=min_periods)
+        pandas_rolling = df.rolling(window, min_periods=min_periods)
+
+        for name in ['count', 'mean', 'std', 'min', 'max', 'median']:
+            start = time.perf_counter()
+            result = getattr(rolling, name)(values)
+            engine_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            expected = getattr(pandas_rolling, name)().to_numpy()
+            pandas_time = time.perf_counter() - start
+
+            difference = np.nanmax(np.abs(result - expected))
+            print(f'  {name}: {engine_time:.2f} s vs pandas {pandas_time:.2f} s, max difference {difference:.2e}')
+
+        start = time.perf_counter()
+        rolling.mad(values)
+        print(f'  mad: {time.perf_counter() - start:.2f} s')
+
+
+def check_accuracy(n_rows=100_000, n_bins=2, window=60, min_periods=1, offset=1e6, step=1e4, nan_fraction=0.05, seed=0):
+    """
+    Checks the rolling mean and std of data with a large offset and a step change (the worst case
+    for running sums) against an exact two-pass computation of every window, and prints the largest
+    relative error of the engine and of pandas.
+
+    Inputs:
+    - n_rows: number of timesteps, defaults to 100 thousand
+    - n_bins: number of bins (columns), defaults to 2
+    - window: window size, defaults to 60
+    - min_periods: minimum number of valid values in a window, defaults to 1
+    - offset: level added to all values, defaults to 1e6
+    - step: level added to the second half of the values, defaults to 1e4
+    - nan_fraction: fraction of values set to nan, defaults to 0.05
+    - seed: random seed
+
+    Returns: dict of statistic -> largest relative error of the engine
+    """
+
+    rng = np.random.default_rng(seed)
+    values = offset + rng.normal(size=(n_rows, n_bins))
+    values[n_rows//2:] += step
+    values[rng.random(values.shape) < nan_fraction] = np.nan
+
+    # exact: every window separately, two pass
+    windows = sliding_window_view(np.vstack([np.full((window - 1, n_bins), np.nan), values]), window, axis=0)
+    counts = np.sum(~np.isnan(windows), axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        exact = {'mean': np.nanmean(windows, axis=-1), 'std': np.nanstd(windows, axis=-1, ddof=1)}
+    too_few = counts < max(min_periods, 1)
+    exact['mean'][too_few] = np.nan
+    exact['std'][too_few | (counts < 2)] = np.nan
+
+    rolling = rollingStatistics(window, min_periods=min_periods)
+    pandas_rolling = pd.DataFrame(values).rolling(window, min_periods=min_periods)
+
+    errors = {}
+    for name in ['mean', 'std']:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            errors[name] = np.nanmax(np.abs(getattr(rolling, name)(values) - exact[name])/np.abs(exact[name]))
+            pandas_error = np.nanmax(np.abs(getattr(pandas_rolling, name)().to_numpy() - exact[name])/np.abs(exact[name]))
+        print(f'{name}: max relative error {errors[name]:.2e} vs pandas {pandas_error:.2e}')
+
+    return errors
+
+
+if __name__ == '__main__':
+    check_accuracy()
+    benchmark()
@@ -0,0 +1,115 @@
+"""
+Location and elevation of each SAIL-Net site, shared by the spatial and TBS analyses,
+and the distances between sites.
+"""
+
+# import packages
+import numpy as np
+import pandas as pd
+from geopy.distance import geodesic
+
+
+# one row per site
+# - latitude, longitude: site coordinates in degrees
+# - elevation: site elevation (m) used for the spatial analysis
+# - tbs_elevation: altitude (m) at which TBS flights are compared to the site
+site_metadata = pd.DataFrame({
+    'site': ['pumphouse', 'gothic', 'cbmid', 'irwin', 'snodgrass', 'cbtop'],
+    'latitude': [38.92108, 38.95615, 38.89828, 38.88738, 38.92713, 38.88877],
+    'longitude': [-106.94949, -106.98582, -106.94312, -107.10870, -106.99050, -106.94501],
+    'elevation': [2765, 2918, 3137, 3177, 3333, 3482],
+    'tbs_elevation': [2770, 2915, 3138, 3177, 3330, 3468]
+}).set_index('site')
+
+
+class siteGeometry:
+    """
+    Class for the horizontal, vertical, and normalized euclidean distances between every pair of sites,
+    kept as (site, site) arrays and computed only once for each list of sites.
+    """
+
+    def __init__(self, locations=None, elevations=None):
+        """
+        Inputs:
+        - locations: dict of (latitude, longitude) of each site, defaults to site_metadata
+        - elevations: dict of elevation (m) of each site, defaults to site_metadata
+        """
+        if locations is None:
+            locations = {site: (row['latitude'], row['longitude']) for site, row in site_metadata.iterrows()}
+        if elevations is None:
+            elevations = site_metadata['elevation'].to_dict()
+
+        self.locations = locations
+        self.elevations = elevations
+        self._cache = {}
+
+    def distance_matrices(self, sites, method='geodesic'):
+        """
+        Returns the distance matrices of the given sites, computing them on the first call.
+
+        Horizontal distances are rounded to 0.01 km and elevation differences to 1 m. The euclidean
+        distance combines both after normalizing each by its largest value over all pairs.
+
+        Inputs:
+        - sites: list of sites, sets the order of the rows and columns
+        - method: 'geodesic' (geopy, one call per pair) or 'haversine' (great circle, vectorized,
+            within about 1 % of geodesic, for large networks), defaults to 'geodesic'
+
+        Returns: dict of
+        - 'horizontal', 'vertical', 'euclidean': arrays of shape (number of sites, number of sites)
+        - 'first', 'second': indices of each pair (i < j), in the order used for pair names 'siteA_siteB'
+        """
+
+        key = (tuple(sites), method)
+        if key not in self._cache:
+            self._cache[key] = self._compute(list(sites), method)
+        return self._cache[key]
+
+    def pair_distances(self, sites, distance_type, method='geodesic'):
+        """
+        Returns the distance of every pair of sites sorted from smallest to largest.
+
+        Inputs:
+        - sites: list of sites
+        - distance_type: 'horizontal', 'vertical', or 'euclidean'
+        - method: see distance_matrices
+
+        Returns: dict of 'siteA_siteB' -> distance
+        """
+
+        matrices = self.distance_matrices(sites, method=method)
+        first, second = matrices['first'], matrices['second']
+        distances = matrices[distance_type][first, second]
+        order = np.argsort(distances, kind='stable')
+
+        return {sites[first[i]] + '_' + sites[second[i]]: distances[i].item() for i in order}
+
+    def _compute(self, sites, method):
+        n_sites = len(sites)
+        first, second = np.triu_indices(n_sites, k=1)
+
+        coordinates = np.array([self.locations[site] for site in sites], dtype=float)
+        if method == 'geodesic':
+            pair_distances = np.array([geodesic(coordinates[i], coordinates[j]).kilometers for i, j in zip(first, second)])
+        elif method == 'haversine':
+            latitudes, longitudes = np.radians(coordinates[first, 0]), np.radians(coordinates[first, 1])
+            other_latitudes, other_longitudes = np.radians(coordinates[second, 0]), np.radians(coordinates[second, 1])
+            a = (np.sin((other_latitudes - latitudes)/2)**2
+                 + np.cos(latitudes)*np.cos(other_latitudes)*np.sin((other_longitudes - longitudes)/2)**2)
+            pair_distances = 2*6371.0088*np.arcsin(np.sqrt(a))
+        else:
+            raise ValueError("method must be 'geodesic' or 'haversine'")
+
+        horizontal = np.zeros((n_sites, n_sites))
+        horizontal[first, second] = np.round(pair_distances, 2)
+        horizontal += horizontal.T
+
+        elevations = np.array([self.elevations[site] for site in sites], dtype=float)
+        vertical = np.round(np.abs(elevations[:, None] - elevations[None, :]))
+
+        # normalize each distance by its largest value over all pairs
+        with np.errstate(invalid='ignore', divide='ignore'):
+            euclidean = np.sqrt((horizontal/horizontal[first, second].max(initial=0))**2
+                                + (vertical/vertical[first, second].max(initial=0))**2)
+
+        return {'horizontal': horizontal, 'vertical': vertical, 'euclidean': euclidean, 'first': first, 'second': second}
@@ -3,13 +3,19 @@ Used for all spatial analysis.
 """
 
 # Python packages
+import warnings
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
-from geopy.distance import geodesic
 import matplotlib.dates as mdates
 from scipy import stats
+from rollingStatistics import rollingStatistics
+from siteMetadata import site_metadata, siteGeometry
+from dataHandling import dataGroupings
 
 # Set the font size for different plot elements
 plt.rcParams.update({
@@ -147,27 +153,20 @@ class spatialVariability:
 
     def __init__(self):
         # elevation and location data
-        self.locations = {
-            'pumphouse':(38.92108, -106.94949),
-            'gothic':(38.95615, -106.98582),
-            'cbmid':(38.89828, -106.94312),
-            'irwin':(38.88738, -107.10870),
-            'snodgrass':(38.92713, -106.99050),
-            'cbtop':(38.88877, -106.94501)
-        }
+        self.locations = {site: (row['latitude'], row['longitude']) for site, row in site_metadata.iterrows()}
 
-        self.elevations = {
-            'pumphouse':2765,
-            'gothic':2918,
-            'cbmid':3137,
-            'irwin':3177,
-            'snodgrass':3333,
-            'cbtop':3482
-        }
+        self.elevations = site_metadata['elevation'].to_dict()
+
+        # distances between sites, computed once for each list of sites
+        self.geometry = siteGeometry(self.locations, self.elevations)
 
         self.years = [2021, 2022, 2023]
         self.months = [1,2,3,4,5,6,7,8,9,10,11,12]
 
+        # season of each month (index 1-12)
+        self.seasons = np.array([None, 'Winter', 'Winter', 'Spring', 'Spring', 'Spring', 'Summer',
+                                 'Summer', 'Summer', 'Fall', 'Fall', 'Fall', 'Winter'], dtype=object)
+
         # colorblind friendly colors
         # self.colors = ['#377eb8', '#ff7f00', '#4daf4a',
         #           '#f781bf', '#a65628', '#984ea3',
@@ -175,12 +174,68 @@ class spatialVariability:
 
         self.colors = plt.cm.viridis(np.linspace(0, 1, 6))
 
+    def variation_statistics(self, dict_of_data, bin_names, sum_headers=False):
+        """
+        Treats the site data at each time as a data set and computes, for all bins at once from a
+        (site, time, bin) array:
+        - scaled_cv: coefficient of variation after min-max scaling the sites at each time, (x-min)/(max-min)
+        - cv: coefficient of variation of the unscaled data
+        - range: maximum minus minimum of the sites
+
+        Sites without data at a time are skipped. The CV uses the sample std (ddof=1, same as pandas)
+        and is nan when fewer than 2 sites have data, or (scaled) when all sites are equal.
+
+        Inputs:
+        - dict_of_data: dictionary of site data
+        - bin_names: list of bin names
+        - sum_headers: (bool) sum the bins into a single 'sum' bin first (nan if any bin is nan), default False
+
+        Returns: dict of dfs with a DateTime index and one column per bin
+        - 'scaled_cv', 'cv', 'range': values at each time
+        - 'monthly_scaled_cv', 'monthly_cv', 'monthly_range': monthly means, labelled at the middle of the month
+        """
+
+        sites, datetimes, values = dataGroupings().stack_sites(dict_of_data, bin_names)
+        if sum_headers:
+            values = values.sum(axis=2, keepdims=True)
+            bin_names = ['sum']
+
+        valid = ~np.isnan(values)
+        counts = valid.sum(axis=0)
+        site_mins = np.where(valid, values, np.inf).min(axis=0)
+        site_maxs = np.where(valid, values, -np.inf).max(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ranges = np.where(counts > 0, site_maxs - site_mins, np.nan)
+            scaled = (values - site_mins)/ranges
+
+        statistics = {
+            'scaled_cv': self._site_cv(scaled),
+            'cv': self._site_cv(values),
+            'range': ranges
+        }
+
+        index = pd.DatetimeIndex(datetimes, name='DateTime')
+        months = index.to_period('M')
+        all_months = pd.period_range(months.min(), months.max(), freq='M')
+        variation = {}
+        for name, result in statistics.items():
+            variation[name] = pd.DataFrame(result, index=index, columns=bin_names)
+            # every month in the range, labelled 15 days before the end of the month
+            monthly = variation[name].groupby(months).mean().reindex(all_months)
+            monthly.index = monthly.index.to_timestamp(how='end').normalize() - pd.Timedelta(days=15)
+            monthly.index.name = 'DateTime'
+            variation['monthly_' + name] = monthly
+
+        return variation
+
     def coefficient_of_variation(self, dict_of_data, bin_names, rolling=None, sum_headers=True):
         """
         Treats the site data at time t as a data set and computes the coefficient of variation.
         Plots the timeseries of these computations to see how CV changes over time.
 
-        First normalizes the data using min-xav scaling.
+        Without sum_headers, the data are first normalized using min-max scaling and the monthly
+        average range is plotted below the CV. With sum_headers, the unscaled CV of the summed bins is plotted.
 
         Inputs:
         - dict_of_data: dictionary of site data
@@ -188,85 +243,45 @@ class spatialVariability:
         - rolling: default 'None' or put number of points to use in rolling mean
         - sum_headers: (bool) sums the bin name columns, default True
 
-        Outputs: single plot with different lines for different bins
+        Outputs: one plot per bin (or one plot of the sum)
 
         Returns: df of the CV
         """
 
-         # compute cov for each bin and plot on subplot
-        
-        cv_df = pd.DataFrame()
+        variation = self.variation_statistics(dict_of_data, bin_names, sum_headers=sum_headers)
 
         if sum_headers:
-            analysis_df = pd.DataFrame()
-            sites = []
-            for site, df in dict_of_data.items():
-                sites.append(site)
-                analysis_df[site] = df[bin_names].sum(axis=1, skipna=False) # if nan, result is nan
-            analysis_df['DateTime'] = df['DateTime']
-            analysis_df = analysis_df.set_index('DateTime')
-
-            # add to cv_df
-            cv_df['cov'] = cov.to_frame(name='cov')
+            cv_df = variation['cv'].rename(columns={'sum': 'cov'})
+            rolling_cov = rollingStatistics(window=rolling, min_periods=1).mean(cv_df) if rolling is not None else None
 
             # plot
-            plt.plot(cov)
-            plt.gca().xaxis.set_major_locator(ticker.AutoLocator())
-            plt.ylabel('Coefficient of Variation')
+            fig, ax = plt.subplots()
+            ax.plot(cv_df['cov'])
+            if rolling_cov is not None:
+                ax.plot(rolling_cov['cov'], linewidth=1.5, color='orange')
+            ax.xaxis.set_major_locator(ticker.AutoLocator())
+            ax.set_ylabel('Coefficient of Variation')
             plt.show()
 
         ### also normalizes data using min-max scaling ###
         else:
-            for bin in bin_names:
-                analysis_df = pd.DataFrame()
-                sites = []
-                for site, df in dict_of_data.items():
-                    sites.append(site)
-                    analysis_df[site] = df[bin]
-
-
-                analysis_df['DateTime'] = df['DateTime']
-                analysis_df = analysis_df.set_index('DateTime')
-
-                # monthly range
-                analysis_df.index = pd.to_datetime(analysis_df.index)
-                ranges = analysis_df.apply(self._row_range, axis=1)
-                monthly_range = ranges.resample('M').mean().shift(freq='-15D')
-                monthly_range.index = pd.to_datetime(monthly_range.index)
-
-                print(monthly_range)
+            cv_df = variation['scaled_cv']
+            rolling_cov = rollingStatistics(window=rolling, min_periods=1).mean(cv_df) if rolling is not None else None
 
-                # apply min_max scaling
-                site_mins = analysis_df.min(axis=1, skipna=True)
-                site_maxs = analysis_df.max(axis=1, skipna=True)
-
-                # scale rows (i.e. eaxh timestep) using (x-min)/(max-min)
-                scaled_data = (analysis_df.T - site_mins)/(site_maxs- site_mins)   
-                # transpose back
-                analysis_df = scaled_data.T
-
-
-                # compute cov
-                cov = analysis_df.std(axis=1)/analysis_df.mean(axis=1)
-                cov.index = pd.to_datetime(cov.index)
-
-                # add to column in df
-                cv_df[bin] = cov.to_frame(name=bin)
+            print(variation['monthly_range'])
+            print('Monthly values', variation['monthly_scaled_cv'])
 
+            for bin in bin_names:
                 sizes = bin.split('_')
+                monthly_avg = variation['monthly_scaled_cv'][bin]
+                monthly_range = variation['monthly_range'][bin]
 
                 # plot
                 fig, ax = plt.subplots(2, 1, sharex=True, figsize=(6.6,3), gridspec_kw={'height_ratios': [2, 1]}, dpi=300)
-                ax[0].plot(cov, linewidth=1.5, color='#377eb8', label=f"{sizes[1]} - {sizes[2]} nm", alpha=0.8)
-
-                # compute monthly COV
-                cv_df.index = pd.to_datetime(cv_df.index)
-                monthly_avg = cv_df.resample('M').mean().shift(freq='-15D')
-                monthly_avg.index = pd.to_datetime(monthly_avg.index)
-                
-                print('Monthly values', monthly_avg)
-
+                ax[0].plot(cv_df[bin], linewidth=1.5, color='#377eb8', label=f"{sizes[1]} - {sizes[2]} nm", alpha=0.8)
                 ax[0].plot(monthly_avg.index, monthly_avg, color='#a65628', marker='s', label='Monthly Average')
+                if rolling_cov is not None:
+                    ax[0].plot(rolling_cov[bin], linewidth=1.5, color='orange', label='rolling mean')
 
                 #ax[0].xaxis.set_major_locator(ticker.MaxNLocator(nbins=5))
                 # set min y-axis = 0
@@ -278,42 +293,13 @@ class spatialVariability:
                 ax[1].plot(monthly_range.index, monthly_range, marker='.', color='gray')
                 ax[1].set_ylabel('Range (cm$^{-3}$)')
                 ax[1].set_ylim(bottom=0, top=monthly_range.max() + 10)
-            
-                # Set x-axis major tick locator
-                #ax.set_xlabel('UTC')
-                
-                #plt.show()
-
-                
-                
 
-        if rolling is not None:
-            rolling_cov = cv_df.rolling(window=rolling, min_periods=1).mean()
-            print(rolling_cov)
-            if sum_headers:
-                # compute n rolling mean
-                ax.plot(rolling_cov, linewidth=1.5, color='orange')
-                #plt.gca().xaxis.set_major_locator(ticker.AutoLocator())
-                #plt.ylabel('Coefficient of Variation')
-                plt.show()
-            else:
-                for bin in bin_names:
-                    ax.plot(rolling_cov[bin], linewidth=1.5, color='orange', label='rolling mean')
-                    #plt.gca().xaxis.set_major_locator(ticker.AutoLocator())
-                    #plt.ylabel('Coefficient of Variation')
-                plt.legend()
-                plt.show()
-        else:
             plt.tight_layout()
             plt.show()
 
-
-
         # make datetime index an actual column
         cv_df = cv_df.reset_index()
 
-        
-    
         return cv_df
 
     def plot_maximum_range(self, dict_of_data, bin_name, window=None):
@@ -328,18 +314,8 @@ class spatialVariability:
         Returns: plot
         """
 
-        analysis_df = pd.DataFrame()
-        sites = []
-        for site, df in dict_of_data.items():
-            sites.append(site)
-            analysis_df[site] = df[bin_name]
-
-
-        analysis_df['DateTime'] = df['DateTime']
-        analysis_df = analysis_df.set_index('DateTime')
-
         # compute the range of each row
-        ranges = analysis_df.apply(self._row_range, axis=1)
+        ranges = self.variation_statistics(dict_of_data, [bin_name])['range'][bin_name]
 
         print(ranges)
 
@@ -348,7 +324,7 @@ class spatialVariability:
 
 
         if window is not None:
-            rolling_range = ranges.rolling(window=window, min_periods=1).mean()
+            rolling_range = rollingStatistics(window=window, min_periods=1).mean(ranges)
             plt.plot(rolling_range, label='Rolling Mean')
             plt.legend()
             plt.show()
@@ -358,10 +334,324 @@ class spatialVariability:
 
 
 
-    def _row_range(self, row):
-        return row.max() - row.min()
+    def _site_cv(self, values):
+        """
+        Coefficient of variation over the site axis (first axis) of a (site, time, bin) array, skipping nans.
+        """
+
+        valid = ~np.isnan(values)
+        counts = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(valid, values, 0).sum(axis=0)/counts
+            variances = np.where(valid, (values - means)**2, 0).sum(axis=0)/(counts - 1)
+            cv = np.sqrt(variances)/means
+        cv[counts < 2] = np.nan
+
+        return cv
+
+    def pairwise_differences(self, dict_of_data, bin_names, sum_headers=False, quantiles=(0.25, 0.75), return_differences=False):
+        """
+        Computes the absolute difference between every pair of sites, normalized by the pair's mean,
+        |a - b|/mean(a, b)*100, for all pairs, times, and bins at once, and regresses the summaries
+        against the horizontal, vertical, and euclidean distance of the pairs.
+
+        The (pair, time, bin) array is built with one broadcast over the site axis, so for long, high
+        resolution data its size (number of pairs x times x bins) should be kept in mind.
+
+        Inputs:
+        - dict_of_data: dictionary of site data
+        - bin_names: list of bin headers
+        - sum_headers: bool, default False, sum the columns provided in bin_names into one 'sum' bin
+        - quantiles: list of quantiles between 0 and 1 to summarize, defaults to (0.25, 0.75)
+        - return_differences: bool, default False, also return the (pair, time, bin) array
+
+        Returns: dict of
+        - 'summary': tidy df with one row per (pair, bin) and columns pair, bin, count, mean, median,
+            q<percent> for each quantile, and the horizontal, vertical, and euclidean distance
+        - 'regressions': tidy df with one row per (distance type, statistic, bin) and columns
+            slope, intercept, r_value, p_value, and std_err (same as scipy.stats.linregress)
+        - 'differences' (if return_differences): array of shape (number of pairs, number of times, number of bins)
+        """
 
-    def sudo_variogram(self, dict_of_data, bin_names, distance_type, sum_headers=True):
+        sites, datetimes, values = dataGroupings().stack_sites(dict_of_data, bin_names)
+        if sum_headers:
+            values = values.sum(axis=2, keepdims=True)
+            bin_names = ['sum']
+
+        # every pair (i < j) in the same order as the distance matrices
+        geometry = self.geometry.distance_matrices(sites)
+        first, second = geometry['first'], geometry['second']
+        pairs = [sites[i] + '_' + sites[j] for i, j in zip(first, second)]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            differences = np.abs(values[first] - values[second])/((values[first] + values[second])/2)*100
+
+        # summaries over the time axis, one (pair, bin) array each
+        statistics = {'count': np.sum(~np.isnan(differences), axis=1)}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            statistics['mean'] = np.nanmean(differences, axis=1)
+            statistics['median'] = np.nanmedian(differences, axis=1)
+            for q in quantiles:
+                statistics[f'q{q*100:g}'] = np.nanquantile(differences, q, axis=1)
+
+        summary = pd.DataFrame({'pair': np.repeat(pairs, len(bin_names)), 'bin': np.tile(bin_names, len(pairs))})
+        for name, result in statistics.items():
+            summary[name] = result.ravel()
+
+        regressions = []
+        for distance_type in ['horizontal', 'vertical', 'euclidean']:
+            x = geometry[distance_type][first, second]
+            summary[distance_type] = np.repeat(x, len(bin_names))
+            for statistic in ['mean', 'median']:
+                regression = pd.DataFrame(_linear_regressions(x, statistics[statistic]))
+                regression.insert(0, 'bin', bin_names)
+                regression.insert(0, 'statistic', statistic)
+                regression.insert(0, 'distance_type', distance_type)
+                regressions.append(regression)
+
+        result = {'summary': summary, 'regressions': pd.concat(regressions, ignore_index=True)}
+        if return_differences:
+            result['differences'] = differences
+
+        return result
+
+    def bootstrap_variogram(self, dict_of_data, bin_names, n_replicates=10000, block_length=7, confidence=0.95,
+                            sum_headers=False, seed=0, max_workers=None, chunk_size=500, return_replicates=False):
+        """
+        Moving block bootstrap confidence intervals for the mean pairwise differences and their
+        regressions against distance (see pairwise_differences).
+
+        Each replicate joins randomly chosen blocks of block_length consecutive times, keeping the
+        autocorrelation within each block. Sums and counts of every possible block are computed once,
+        so a batch of replicates is a matrix product of how often each block was chosen with those sums.
+        Batches run on a process pool, each with its own seed spawned from seed, so the results depend
+        only on seed and chunk_size, not on the number of workers.
+
+        Inputs:
+        - dict_of_data: dictionary of site data
+        - bin_names: list of bin headers
+        - n_replicates: number of bootstrap replicates, defaults to 10000
+        - block_length: number of consecutive times in each block, defaults to 7 (a week of daily data)
+        - confidence: confidence level of the intervals, defaults to 0.95
+        - sum_headers: bool, default False, sum the columns provided in bin_names into one 'sum' bin
+        - seed: random seed, defaults to 0
+        - max_workers: number of processes, defaults to None which uses the number of cores, 1 runs without a pool
+        - chunk_size: number of replicates in each batch, defaults to 500
+        - return_replicates: bool, default False, also return the replicates
+
+        Returns: dict of
+        - 'summary': df with one row per (pair, bin) and columns pair, bin, mean, mean_lower, mean_upper
+        - 'regressions': df with one row per (distance type, bin) and columns slope, slope_lower, slope_upper,
+            intercept, r_value, r_lower, r_upper
+        - 'replicates' (if return_replicates): dict of arrays, 'mean' (replicate, pair, bin) and
+            '<distance type>_slope' and '<distance type>_r_value' (replicate, bin)
+        """
+
+        pairwise = self.pairwise_differences(dict_of_data, bin_names, sum_headers=sum_headers, return_differences=True)
+        differences = pairwise['differences']
+        n_pairs, n_times, n_bins = differences.shape
+        sites = list(dict_of_data.keys())
+        geometry = self.geometry.distance_matrices(sites)
+        distances = {distance_type: geometry[distance_type][geometry['first'], geometry['second']]
+                     for distance_type in ['horizontal', 'vertical', 'euclidean']}
+
+        # sums and counts of every block of block_length times, (block start, pair*bin)
+        block_length = min(block_length, n_times)
+        n_blocks = int(np.ceil(n_times/block_length))
+        valid = ~np.isnan(differences)
+        block_sums = []
+        for values in [np.where(valid, differences, 0), valid.astype(float)]:
+            cumulative = np.concatenate([np.zeros((n_pairs, 1, n_bins)), np.cumsum(values, axis=1)], axis=1)
+            block_sums.append((cumulative[:, block_length:] - cumulative[:, :-block_length]).transpose(1, 0, 2).reshape(-1, n_pairs*n_bins))
+
+        sizes = [min(chunk_size, n_replicates - start) for start in range(0, n_replicates, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        jobs = (itertools.repeat(block_sums[0]), itertools.repeat(block_sums[1]), itertools.repeat(n_blocks),
+                sizes, seeds, itertools.repeat(distances), itertools.repeat((n_pairs, n_bins)))
+        if max_workers == 1:
+            results = list(map(_bootstrap_chunk, *jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_bootstrap_chunk, *jobs))
+        replicates = {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+
+        # percentile intervals
+        percentiles = [(1 - confidence)/2*100, (1 + confidence)/2*100]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            intervals = {name: np.nanpercentile(values, percentiles, axis=0) for name, values in replicates.items()}
+
+        summary = pairwise['summary'][['pair', 'bin', 'mean']].copy()
+        summary['mean_lower'] = intervals['mean'][0].ravel()
+        summary['mean_upper'] = intervals['mean'][1].ravel()
+
+        regressions = pairwise['regressions']
+        regressions = regressions[regressions['statistic'] == 'mean'].drop(columns=['statistic', 'p_value', 'std_err']).reset_index(drop=True)
+        for name, column in [('slope', 'slope'), ('r_value', 'r')]:
+            for side, bound in enumerate(['lower', 'upper']):
+                regressions[f'{column}_{bound}'] = np.concatenate([intervals[f'{distance_type}_{name}'][side] for distance_type in distances])
+        regressions = regressions[['distance_type', 'bin', 'slope', 'slope_lower', 'slope_upper', 'intercept', 'r_value', 'r_lower', 'r_upper']]
+
+        result = {'summary': summary, 'regressions': regressions}
+        if return_replicates:
+            result['replicates'] = replicates
+
+        return result
+
+    def lagged_correlation(self, dict_of_data, bin_names, max_lag, pairs=None, min_periods=10):
+        """
+        Pearson correlation between every pair of sites over a range of time lags, to look for
+        aerosol events moving from one site to another (i.e. from pumphouse up to cbtop).
+
+        At lag L the first site at time t is paired with the second site at time t+L, so a peak
+        at a positive lag means the second site follows the first. Only times where both sites have
+        data are used. All sums needed for every lag are cross-correlations of the data and their
+        validity masks, computed with FFTs, so the cost grows as T log T instead of T x lags.
+
+        The data should be on a regular time grid, i.e. from temporal_grouping.
+
+        Inputs:
+        - dict_of_data: dictionary of site data
+        - bin_names: list of bin headers
+        - max_lag: largest lag in timesteps, lags from -max_lag to max_lag are computed
+        - pairs: list of (site, site) tuples, defaults to None for every pair of sites
+        - min_periods: minimum number of overlapping values for a correlation, default 10
+
+        Returns: dict of
+        - 'pairs': list of pair names 'siteA_siteB'
+        - 'lags': array of lags in timesteps
+        - 'lag_times': lags as timedeltas, using the median time step of the data
+        - 'correlations': array of shape (number of pairs, number of bins, number of lags)
+        - 'peaks': df with one row per (pair, bin) and columns pair, bin, peak_lag, peak_lag_time, peak_r
+        """
+
+        sites, datetimes, values = dataGroupings().stack_sites(dict_of_data, bin_names)
+        n_sites, n_times, n_bins = values.shape
+        if pairs is None:
+            first, second = np.triu_indices(n_sites, k=1)
+        else:
+            first = np.array([sites.index(a) for a, b in pairs])
+            second = np.array([sites.index(b) for a, b in pairs])
+        pair_names = [sites[i] + '_' + sites[j] for i, j in zip(first, second)]
+
+        max_lag = min(max_lag, n_times - 1)
+        lags = np.arange(-max_lag, max_lag + 1)
+        n_fft = 1 << int(np.ceil(np.log2(2*n_times)))
+
+        # center each site so the sums don't lose precision
+        valid = ~np.isnan(values)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            values = values - np.nanmean(values, axis=1, keepdims=True)
+        values = np.where(valid, values, 0)
+        masks = valid.astype(float)
+
+        def cross(a, b):
+            # sum over t of a(t)*b(t+L) for every lag L
+            result = np.fft.irfft(np.conj(a)*b, n=n_fft, axis=-1)
+            return result[..., lags % n_fft]
+
+        correlations = np.empty((len(pair_names), n_bins, len(lags)))
+        for b in range(n_bins):
+            # FFT of every site's data, squared data, and mask once per bin, (site, frequency)
+            x = np.fft.rfft(values[:, :, b], n=n_fft, axis=1)
+            x2 = np.fft.rfft(values[:, :, b]**2, n=n_fft, axis=1)
+            m = np.fft.rfft(masks[:, :, b], n=n_fft, axis=1)
+
+            n = np.round(cross(m[first], m[second]))
+            sum_x = cross(x[first], m[second])
+            sum_y = cross(m[first], x[second])
+            sum_xx = cross(x2[first], m[second])
+            sum_yy = cross(m[first], x2[second])
+            sum_xy = cross(x[first], x[second])
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                covariance = n*sum_xy - sum_x*sum_y
+                variance = (n*sum_xx - sum_x**2).clip(min=0)*(n*sum_yy - sum_y**2).clip(min=0)
+                r = (covariance/np.sqrt(variance)).clip(-1, 1)
+            r[n < max(min_periods, 2)] = np.nan
+            correlations[:, b] = r
+
+        # lag of the largest correlation of each (pair, bin)
+        has_value = ~np.all(np.isnan(correlations), axis=2)
+        peak_index = np.argmax(np.where(np.isnan(correlations), -np.inf, correlations), axis=2)
+        time_step = pd.Series(datetimes).diff().median()
+
+        peaks = pd.DataFrame({
+            'pair': np.repeat(pair_names, n_bins),
+            'bin': np.tile(bin_names, len(pair_names)),
+            'peak_lag': np.where(has_value, lags[peak_index], np.nan).ravel(),
+            'peak_r': np.where(has_value, np.take_along_axis(correlations, peak_index[..., None], axis=2)[..., 0], np.nan).ravel()
+        })
+        peaks.insert(3, 'peak_lag_time', peaks['peak_lag']*time_step)
+
+        return {
+            'pairs': pair_names,
+            'lags': lags,
+            'lag_times': lags*time_step,
+            'correlations': correlations,
+            'peaks': peaks
+        }
+
+    def elevation_regression(self, dict_of_data, bin_names, weight_column=None, min_sites=3):
+        """
+        Fits concentration against site elevation at every time step, for all time steps and
+        bins at once with the closed form least squares solution. Sites without data at a time
+        are left out of that time's fit.
+
+        Inputs:
+        - dict_of_data: dictionary of site data, i.e. hourly averages
+        - bin_names: list of bin headers
+        - weight_column: column of each df used to weight the sites, i.e. 'count' from
+            temporal_grouping(include_counts=True), defaults to None for equal weights
+        - min_sites: minimum number of sites with data for a fit, default 3
+
+        Returns: dict of dfs with a DateTime index and one column per bin
+        - 'slope': change in concentration per m of elevation
+        - 'intercept': concentration at 0 m
+        - 'r_value': (weighted) Pearson correlation
+        - 'n_sites': number of sites in each fit
+        """
+
+        sites, datetimes, values = dataGroupings().stack_sites(dict_of_data, bin_names)
+        elevations = np.array([self.elevations[site] for site in sites], dtype=float)[:, None, None]
+
+        valid = ~np.isnan(values)
+        if weight_column is None:
+            weights = valid.astype(float)
+        else:
+            site_weights = dataGroupings().stack_sites(dict_of_data, [weight_column])[2]
+            weights = np.where(valid, np.nan_to_num(site_weights), 0)
+        values = np.where(valid, values, 0)
+        n_sites = valid.sum(axis=0)
+
+        # weighted sums over the site axis, (time, bin)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = weights.sum(axis=0)
+            x_mean = (weights*elevations).sum(axis=0)/total
+            y_mean = (weights*values).sum(axis=0)/total
+            x_centered = np.where(valid, elevations - x_mean, 0)
+            y_centered = np.where(valid, values - y_mean, 0)
+            sxx = (weights*x_centered**2).sum(axis=0)
+            syy = (weights*y_centered**2).sum(axis=0)
+            sxy = (weights*x_centered*y_centered).sum(axis=0)
+
+            slope = sxy/sxx
+            intercept = y_mean - slope*x_mean
+            r_value = (sxy/np.sqrt(sxx*syy)).clip(-1, 1)
+
+        too_few = (n_sites < min_sites) | (total <= 0)
+        index = pd.DatetimeIndex(datetimes, name='DateTime')
+        regression = {}
+        for name, result in [('slope', slope), ('intercept', intercept), ('r_value', r_value)]:
+            result[too_few] = np.nan
+            regression[name] = pd.DataFrame(result, index=index, columns=bin_names)
+        regression['n_sites'] = pd.DataFrame(n_sites, index=index, columns=bin_names)
+
+        return regression
+
+    def sudo_variogram(self, dict_of_data, bin_names, distance_type, sum_headers=True, n_bootstrap=None):
         """
         Plots the average percent difference between pairs of sites as a function
         of either their vertical difference, distance between them, or 
@@ -377,68 +667,51 @@ class spatialVariability:
             - 'vertical'
             - 'euclidean' 
         - sum_headers: bool, default True to sum the columns provided in bin_names
+        - n_bootstrap: number of block bootstrap replicates for a 95 % confidence interval of r
+            (see bootstrap_variogram), default None for no interval
         
         Output: figure
 
         Returns: none
         """
 
-        if sum_headers:
-            # create single df
-            data = pd.DataFrame()
-            sites = []
-            for site, df in dict_of_data.items():
-                sites.append(site)
-                data[site] = df[bin_names].sum(axis=1, skipna=False)
-            data['DateTime'] = df['DateTime']
-            data = data.set_index('DateTime')
-
-            # compute the necessary distance
-            if distance_type == 'horizontal':
-                distances = self._compute_horizontal_distance(sites)
-                distance_name = 'Distance (km)'
-            
-            if distance_type == 'vertical':
-                distances = self._compute_vertical_distance(sites)
-                distance_name = 'Elevation Difference (m)'
-            
-            if distance_type == 'euclidean':
-                distances = self._compute_euclidean_distance(sites)
-                distance_name = 'Normalized Euclidean Difference'
+        distance_names = {
+            'horizontal': 'Distance (km)',
+            'vertical': 'Elevation Difference (m)',
+            'euclidean': 'Normalized Euclidean Difference'
+        }
+        distance_name = distance_names[distance_type]
 
-            print('the distances:', distances)
-            
-            # compute the absolute differene between normalized by the mean values; ordering based on ordering of distances
-            diff_df = pd.DataFrame()
-            distances_list = []
-            for key, dist in distances.items():
-                distances_list.append(dist)
-                names = key.split('_') # get two names in dict key
-                diffs = (data[names[0]] - data[names[1]]).abs()
-                avg = data[[names[0], names[1]]].mean(axis=1)
-                diff_df[key] = (diffs/avg)*100
+        pairwise = self.pairwise_differences(dict_of_data, bin_names, sum_headers=sum_headers)
+        # ordering based on ordering of distances
+        summary = pairwise['summary'].sort_values(distance_type, kind='stable')
+        regressions = pairwise['regressions']
+        regressions = regressions[(regressions['distance_type'] == distance_type) & (regressions['statistic'] == 'mean')].set_index('bin')
 
+        print('the distances:', dict(zip(summary['pair'], summary[distance_type])))
 
-            
-            # compute average of all columns for avg distance
-            mean_diffs = diff_df.mean().tolist()
+        # confidence interval of r added to the titles
+        r_intervals = {bin: '' for bin in regressions.index}
+        if n_bootstrap is not None:
+            bootstrap = self.bootstrap_variogram(dict_of_data, bin_names, n_replicates=n_bootstrap, sum_headers=sum_headers)
+            bootstrap = bootstrap['regressions'][bootstrap['regressions']['distance_type'] == distance_type]
+            for row in bootstrap.itertuples():
+                r_intervals[row.bin] = f' [{round(row.r_lower, 2)}, {round(row.r_upper, 2)}]'
 
-            print('the differences:', mean_diffs)
+        if sum_headers:
+            bin_summary = summary[summary['bin'] == 'sum']
+            distances_list = bin_summary[distance_type].to_numpy()
+            mean_diffs = bin_summary['mean'].to_numpy()
+
+            print('the differences:', mean_diffs.tolist())
 
-            
-            # plot
-            # for i, row in diff_df.iterrows():
-            #     plt.plot(distances_list, row, marker='o', linestyle='None', color='gray', alpha=0.5)
-                
             # plot avg diffs
             plt.plot(distances_list, mean_diffs, marker='o', markersize='26', linestyle='None', color='green')
-            # do linear regressions
-            slope, intercept, r_value, p_value, std_err = stats.linregress(distances_list, mean_diffs)
-            #print('slope=',slope,'intercept=', intercept)
-            #print('mean diffs=', mean_diffs)
-            regression_line = [slope*x + intercept for x in distances_list]
+            # linear regression
+            slope, intercept, r_value = regressions.loc['sum', ['slope', 'intercept', 'r_value']]
+            regression_line = slope*distances_list + intercept
             plt.plot(distances_list, regression_line, color='black', linewidth=5)
-            plt.title('r-value ' + str(round(r_value, 2)))
+            plt.title('r-value ' + str(round(r_value, 2)) + r_intervals['sum'])
             plt.xlabel(distance_name)
             plt.ylabel('Percent Difference')
             plt.show()
@@ -446,89 +719,23 @@ class spatialVariability:
         else:
         
             fig, axs = plt.subplots(ncols=len(bin_names), sharey=True, figsize=(6.6,3), dpi=300)
-            colors=['b', 'g', 'r']
+            axs = np.atleast_1d(axs)
+            colors = ['#377eb8', '#ff7f00', '#4daf4a', '#f781bf', '#a65628', '#984ea3', '#dede00']
             for i, bin in enumerate(bin_names):
-                # create single df
-                data = pd.DataFrame()
-                sites = []
-                for site, df in dict_of_data.items():
-                    sites.append(site)
-                    data[site] = df[bin]
-                data['DateTime'] = df['DateTime']
-                data = data.set_index('DateTime')
-
-                # compute the necessary distance
-                if distance_type == 'horizontal':
-                    distances = self._compute_horizontal_distance(sites)
-                    distance_name = 'Distance (km)'
-                
-                if distance_type == 'vertical':
-                    distances = self._compute_vertical_distance(sites)
-                    distance_name = 'Elevation Difference (m)'
-                
-                if distance_type == 'euclidean':
-                    distances = self._compute_euclidean_distance(sites)
-                    distance_name = 'Normalized Euclidean Difference'
-
-                print('the distances:', distances)
-                
-                # compute the absolute differene between normalized by the mean values; ordering based on ordering of distances
-                diff_df = pd.DataFrame()
-                distances_list = []
-                for key, dist in distances.items():
-                    distances_list.append(dist)
-                    names = key.split('_') # get two names in dict key
-                    diffs = (data[names[0]] - data[names[1]]).abs()
-                    avg = data[[names[0], names[1]]].mean(axis=1)
-                    diff_df[key] = (diffs/avg)*100
-                
-                print(diff_df)
-                
-                
-                # compute average of all columns for avg distance
-                mean_diffs = diff_df.mean().tolist()
+                bin_summary = summary[summary['bin'] == bin]
+                distances_list = bin_summary[distance_type].to_numpy()
+                mean_diffs = bin_summary['mean'].to_numpy()
 
-                # plot avg 
-                colors = ['#377eb8', '#ff7f00', '#4daf4a', '#f781bf', '#a65628', '#984ea3', '#dede00']
                 # plot the mean values
                 axs[i].plot(distances_list, mean_diffs, marker='.', markersize='5', linestyle='None', color=colors[i])
 
-
-                # # plot differences for each site as a box plot
-                # differences = [diff_df[site].dropna().tolist() for site in distances.keys()]
-
-                # # Set the display width for the box plots (in inches)
-                # display_width = 0.9
-
-                # # Convert display width to data coordinates
-                # transform = axs[i].transData.transform
-                # inverse_transform = axs[i].transData.inverted().transform
-                # display_width_in_data = inverse_transform(transform([0, 0]) + [display_width * fig.dpi, 0])[0] - inverse_transform(transform([0, 0]))[0]
-
-                # axs[i].boxplot(differences, positions=distances_list, widths=display_width_in_data, sym='', showmeans=True, showcaps=False,
-                #                meanprops={'marker': 'o', 'markersize': '3', 'markerfacecolor': colors[i], 'markeredgecolor': colors[i]},
-                #                medianprops={'color':colors[i], 'alpha': 0.5},
-                #                boxprops={'color': 'gray', 'alpha': 0.5},
-                #                whiskerprops={'visible': False})
-                
-                # do linear regressions for means
-                slope, intercept, mean_r_value, p_value, std_err = stats.linregress(distances_list, mean_diffs)
-                #print('slope=',slope,'intercept=', intercept)
-                #print('mean diffs=', mean_diffs)
-                regression_line = [slope*x + intercept for x in distances_list]
+                # linear regression of means
+                slope, intercept, mean_r_value = regressions.loc[bin, ['slope', 'intercept', 'r_value']]
+                regression_line = slope*distances_list + intercept
                 axs[i].plot(distances_list, regression_line, color='black', linewidth=2)#, label=f"R = {round(r_value,2)}")
 
-                # # linear regression of medians
-                # slope, intercept, median_r_value, p_value, std_err = stats.linregress(distances_list, median)
-                # regression_line = [slope*x + intercept for x in distances_list]
-                # axs[i].plot(distances_list, regression_line, color='gray', alpha=0.8, linestyle='--', linewidth=2)#, label=f"R = {round(r_value,2)}")
-
-                
-    
                 split_bin = bin.split('_')
-                axs[i].set_title(f"{split_bin[1]} - {split_bin[2]} nm \n Pearson R = {round(mean_r_value, 2)}")# \n Medians, R = {round(median_r_value, 2)}")
-                # if i==np.floor(len(bin_names)/2):
-                #     axs[i].set_xlabel(distance_name)
+                axs[i].set_title(f"{split_bin[1]} - {split_bin[2]} nm \n Pearson R = {round(mean_r_value, 2)}{r_intervals[bin]}")
                 if i==0:
                     axs[i].set_ylabel('Percent Difference')
             
@@ -601,6 +808,63 @@ class spatialVariability:
                 
         plt.show()
     
+    def count_max_min_sites(self, dict_of_data, bin_name, timezone=None):
+        """
+        Counts, for the given bin, the number of times each site has the maximum and the minimum
+        concentration of all of the sites, in total, by season, and by hour.
+
+        Sites without data at a time are skipped, and times where no site has data are not counted.
+        Ties go to the first site in the dict.
+
+        Inputs:
+        - dict_of_data: dict of pops data
+        - bin_name: name of bin
+        - timezone: timezone used for the seasons and hours, i.e. 'MST', defaults to None which uses
+            DateTime as is (UTC)
+
+        Returns: dict of dfs
+        - 'total': max and min counts (columns) of each site (rows)
+        - 'season': max and min counts of each site for each season, columns Season, site, max, min
+        - 'hour': max and min counts of each site for each hour, columns Hour, site, max, min
+        - 'empty': number of times where no site has data (int)
+        """
+
+        sites, datetimes, values = dataGroupings().stack_sites(dict_of_data, [bin_name])
+        values = values[:, :, 0]
+        n_sites = len(sites)
+
+        # times where at least one site has data
+        has_data = ~np.all(np.isnan(values), axis=0)
+        values = values[:, has_data]
+        datetimes = datetimes[has_data]
+        if timezone is not None:
+            datetimes = datetimes.dt.tz_localize('UTC').dt.tz_convert(timezone)
+
+        # site with the max and min of each time, nans are skipped
+        max_sites = np.argmax(np.where(np.isnan(values), -np.inf, values), axis=0)
+        min_sites = np.argmin(np.where(np.isnan(values), np.inf, values), axis=0)
+
+        counts = {'total': pd.DataFrame({
+            'max': np.bincount(max_sites, minlength=n_sites),
+            'min': np.bincount(min_sites, minlength=n_sites)
+        }, index=pd.Index(sites, name='site'))}
+
+        # one bincount over (group, site) for each breakdown
+        for name, column, groups in [('season', 'Season', self.seasons[datetimes.dt.month.to_numpy()]),
+                                     ('hour', 'Hour', datetimes.dt.hour.to_numpy())]:
+            group_codes, group_names = pd.factorize(groups, sort=True)
+            size = len(group_names)*n_sites
+            counts[name] = pd.DataFrame({
+                column: np.repeat(group_names, n_sites),
+                'site': np.tile(sites, len(group_names)),
+                'max': np.bincount(group_codes*n_sites + max_sites, minlength=size),
+                'min': np.bincount(group_codes*n_sites + min_sites, minlength=size)
+            })
+
+        counts['empty'] = int(np.count_nonzero(~has_data))
+
+        return counts
+
     def compute_number_max_min_concentrations(self, dict_of_data, bin_name):
         """
         For the given bin, counts the number of times that each site experiences the maximum and minimum concentrations
@@ -615,32 +879,10 @@ class spatialVariability:
         Returns: none
         """
 
-        # make df of only the data needed
-        analysis_df = pd.DataFrame()
-        sites = []
-        for site, df in dict_of_data.items():
-            sites.append(site)
-            analysis_df[site] = df[bin_name]        
-        analysis_df['DateTime'] = df['DateTime']
-        analysis_df = analysis_df.set_index('DateTime')
-
-        # initialize counters for max and min occurrences
-        max_count = {}
-        min_count = {}
-        for site in sites:
-            max_count[site] = 0
-            min_count[site] = 0
-        
-        # iterate over each time step
-        for time in analysis_df.index:
-            # find which site has the max and min conc
-            max_site = analysis_df.loc[time].idxmax()
-            min_site = analysis_df.loc[time].idxmin()
-
-
-            # incrment the counters
-            max_count[max_site] += 1
-            min_count[min_site] += 1
+        counts = self.count_max_min_sites(dict_of_data, bin_name)
+        sites = list(counts['total'].index)
+        max_count = counts['total']['max'].to_dict()
+        min_count = counts['total']['min'].to_dict()
         
         print('The final counts are:')
         print(f'Max count: {max_count}')
@@ -670,58 +912,264 @@ class spatialVariability:
 
 
     def _compute_horizontal_distance(self, sites):
-        distances = {}
-        # compute the difference between all sites
-        for i in range(len(sites)):
-            for j in range(i+1, len(sites)):
-                distances[sites[i]+'_'+sites[j]] = round(geodesic(self.locations[sites[i]], self.locations[sites[j]]).kilometers, 2)
-        
-        # sort dict from smallest to largest
-        distances = dict(sorted(distances.items(), key=lambda item: item[1]))
-        return distances
+        return self.geometry.pair_distances(sites, 'horizontal')
 
     def _compute_vertical_distance(self, sites):
-        distances = {}
-        # compute the elevation differences
-        for i in range(len(sites)):
-            for j in range(i+1, len(sites)):
-                distances[sites[i]+'_'+sites[j]] = round(abs(self.elevations[sites[i]] - self.elevations[sites[j]]))
-        
-        # sort dict from smallest to largest
-        distances = dict(sorted(distances.items(), key=lambda item: item[1]))
-        return distances
+        return self.geometry.pair_distances(sites, 'vertical')
 
     def _compute_euclidean_distance(self, sites):
-        # compute elevation diffs and normalize
-        distances = {}
-        for i in range(len(sites)):
-            for j in range(i+1, len(sites)):
-                distances[sites[i]+'_'+sites[j]] = round(geodesic(self.locations[sites[i]], self.locations[sites[j]]).kilometers, 2)
-        max_dist = max(distances.values())
-        normalized_distances = {}
-        for key, value in distances.items():
-            normalized_distances[key] = value/max_dist
-        
-        
-        # compute the elevation differences
-        elevation_diffs = {}
-        for i in range(len(sites)):
-            for j in range(i+1, len(sites)):
-                elevation_diffs[sites[i]+'_'+sites[j]] = round(abs(self.elevations[sites[i]] - self.elevations[sites[j]]))
-        max_elevation_diff = max(elevation_diffs.values())
-        normalized_elevation_diffs = {}
-        for key, value in elevation_diffs.items():
-            normalized_elevation_diffs[key] = value/max_elevation_diff
-        
-        distances = {}
-        for key in normalized_distances:
-            distances[key] = np.sqrt(normalized_distances[key]**2 + normalized_elevation_diffs[key]**2)
+        return self.geometry.pair_distances(sites, 'euclidean')
 
-        # sort dict from smallest to largest
-        distances = dict(sorted(distances.items(), key=lambda item: item[1]))
-        
-        return distances
-    
+
+def _linear_regressions(x, y):
+    """
+    Least squares fits of every column of y against x at once, same results as scipy.stats.linregress.
+
+    Inputs:
+    - x: array of shape (n,)
+    - y: array of shape (n, number of fits)
+
+    Returns: dict of arrays slope, intercept, r_value, p_value, std_err
+    """
+
+    n = len(x)
+    x_centered = x - x.mean()
+    y_centered = y - y.mean(axis=0)
+    ssx = np.sum(x_centered**2)
+    ssy = np.sum(y_centered**2, axis=0)
+    sxy = x_centered @ y_centered
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = sxy/ssx
+        r_value = (sxy/np.sqrt(ssx*ssy)).clip(-1, 1)
+        dof = n - 2
+        t = r_value*np.sqrt(dof/((1 - r_value)*(1 + r_value)))
+        p_value = 2*stats.t.sf(np.abs(t), dof)
+        std_err = np.sqrt((1 - r_value**2)*ssy/ssx/dof)
+
+    return {
+        'slope': slope,
+        'intercept': y.mean(axis=0) - slope*x.mean(),
+        'r_value': r_value,
+        'p_value': p_value,
+        'std_err': std_err
+    }
+
+
+def _bootstrap_chunk(block_sums, block_counts, n_blocks, n_replicates, seed, distances, shape):
+    """
+    Worker for spatialVariability.bootstrap_variogram: mean pairwise differences and their regressions
+    for a batch of block bootstrap replicates.
+    """
+
+    rng = np.random.default_rng(seed)
+    n_starts = len(block_sums)
+
+    # number of times each block is chosen in each replicate, (replicate, block start)
+    starts = rng.integers(0, n_starts, size=(n_replicates, n_blocks))
+    selections = np.bincount((np.arange(n_replicates)[:, None]*n_starts + starts).ravel(),
+                             minlength=n_replicates*n_starts).reshape(n_replicates, n_starts).astype(float)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = ((selections @ block_sums)/(selections @ block_counts)).reshape(n_replicates, *shape)
+
+    # regress every (replicate, bin) at once, pairs along the first axis
+    result = {'mean': means}
+    y = means.transpose(1, 0, 2).reshape(shape[0], -1)
+    for distance_type, x in distances.items():
+        regression = _linear_regressions(x, y)
+        result[f'{distance_type}_slope'] = regression['slope'].reshape(n_replicates, shape[1])
+        result[f'{distance_type}_r_value'] = regression['r_value'].reshape(n_replicates, shape[1])
+
+    return result
+
+
+def _subset_errors(indicators, sums, counts, network_means, n_bins):
+    """
+    Worker for networkDesign.select_subsets: mean absolute relative error of a batch of subsets for each bin.
+    """
+
+    # in place, so only the two (subset, time*bin) products are held at once
+    errors = indicators @ sums
+    subset_counts = indicators @ counts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        errors /= subset_counts
+        errors -= network_means
+        np.abs(errors, out=errors)
+        errors /= network_means
+    del subset_counts
+
+    errors = errors.reshape(len(indicators), -1, n_bins)
+    n_valid = np.sum(~np.isnan(errors), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nansum(errors, axis=1)/n_valid
+
+
+class eofAnalysis:
+    """
+    Class for the empirical orthogonal function (EOF/PCA) decomposition of the (time, site) data
+    of each bin, to separate network wide variability (usually the first mode, all sites together)
+    from site local variability (the later modes).
+
+    Gaps are filled with an EM style iteration (as in DINEOF): missing values start at the site mean,
+    then are replaced by the site means plus a low rank reconstruction, both re-estimated every iteration,
+    until the reconstruction error of the observed values stops improving. The
+    decomposition uses a randomized SVD, so only n_modes (plus oversampling) directions are ever computed.
+    """
+
+    def __init__(self, n_modes=3, imputation_modes=None, standardize=False, max_iterations=100, tolerance=1e-5, oversampling=10, power_iterations=2, seed=0):
+        """
+        Inputs:
+        - n_modes: number of modes to keep, default 3
+        - imputation_modes: number of modes used to fill the gaps, defaults to None which picks it
+            (up to n_modes) by cross-validation on held out data, since filling with too many modes fits noise
+        - standardize: (bool) divide each site by its std (EOFs of the correlation instead of the covariance), default False
+        - max_iterations: maximum number of gap filling iterations, default 100
+        - tolerance: stop when the reconstruction error of the observed values improves by less than this fraction, default 1e-5
+        - oversampling: extra random directions of the randomized SVD, default 10
+        - power_iterations: power iterations of the randomized SVD, default 2
+        - seed: random seed of the randomized SVD, default 0
+        """
+        self.n_modes = n_modes
+        self.imputation_modes = imputation_modes
+        self.standardize = standardize
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.oversampling = oversampling
+        self.power_iterations = power_iterations
+        self.seed = seed
+
+    def fit(self, dict_of_data, bin_names):
+        """
+        Decomposes each bin, i.e. of the hourly averaged and bin grouped site data.
+
+        Times where no site has data are left out of the fit and get nan principal components,
+        a bin without any data gets nan modes.
+
+        Inputs:
+        - dict_of_data: dictionary of site data
+        - bin_names: list of bin headers
+
+        Returns: dict of bin -> dict of
+        - 'modes': df of the EOF loadings of each site (rows) for each mode (columns)
+        - 'pcs': df of the principal component time series, DateTime index, one column per mode
+        - 'explained_variance': array of the fraction of the variance explained by each mode
+        - 'iterations': number of gap filling iterations used
+        """
+
+        sites, datetimes, values = dataGroupings().stack_sites(dict_of_data, bin_names)
+        index = pd.DatetimeIndex(datetimes, name='DateTime')
+        modes = ['mode_' + str(i + 1) for i in range(min(self.n_modes, len(sites)))]
+
+        results = {}
+        for b, bin in enumerate(bin_names):
+            data = values[:, :, b].T
+            has_data = ~np.all(np.isnan(data), axis=1)
+
+            loadings, pcs, explained_variance, iterations = self._decompose(data[has_data])
+
+            all_pcs = np.full((len(index), len(modes)), np.nan)
+            all_pcs[has_data] = pcs
+            results[bin] = {
+                'modes': pd.DataFrame(loadings, index=pd.Index(sites, name='site'), columns=modes),
+                'pcs': pd.DataFrame(all_pcs, index=index, columns=modes),
+                'explained_variance': explained_variance,
+                'iterations': iterations
+            }
+
+        return results
+
+    def _decompose(self, data):
+        """
+        Gap filled EOFs of a (time, site) array.
+        """
+
+        missing = np.isnan(data)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            scales = np.nan_to_num(np.nanstd(data, axis=0), nan=1) if self.standardize else np.ones(data.shape[1])
+        scales[scales == 0] = 1
+        n_modes = min(self.n_modes, data.shape[1])
+        max_rank = min(n_modes, data.shape[0])
+        if max_rank == 0:
+            # no times (or sites) with data: nan modes
+            return np.full((data.shape[1], n_modes), np.nan), np.zeros((0, n_modes)), np.full(n_modes, np.nan), 0
+
+        iterations = 0
+        filled = data
+        if missing.any():
+            rank = self.imputation_modes
+            if rank is None:
+                # pick the rank that best predicts a random 5 % of the data held out as extra gaps
+                rng = np.random.default_rng(self.seed)
+                held_out = ~missing & (rng.random(missing.shape) < 0.05)
+                errors = []
+                for candidate in range(1, max_rank + 1):
+                    estimate, _ = self._fill_gaps(np.where(held_out, np.nan, data), missing | held_out, candidate, scales)
+                    errors.append(np.mean(((estimate[held_out] - data[held_out])/np.broadcast_to(scales, data.shape)[held_out])**2))
+                rank = int(np.argmin(errors)) + 1
+            filled, iterations = self._fill_gaps(data, missing, min(rank, max_rank), scales)
+
+        # anomalies from the means (and stds) of the filled data, so they are centred even when a site's gaps are not at its typical level
+        if self.standardize:
+            scales = filled.std(axis=0)
+            scales[scales == 0] = 1
+        anomalies = (filled - filled.mean(axis=0))/scales
+        u, singular_values, vt = self._randomized_svd(anomalies, max_rank)
+
+        total_variance = np.sum(anomalies**2)
+        explained_variance = singular_values**2/total_variance if total_variance > 0 else np.full(len(singular_values), np.nan)
+
+        # nan modes past the rank when there are fewer times than modes
+        padding = n_modes - max_rank
+        return (np.pad(vt.T, ((0, 0), (0, padding)), constant_values=np.nan), np.pad(u*singular_values, ((0, 0), (0, padding)), constant_values=np.nan),
+                np.pad(explained_variance, (0, padding), constant_values=np.nan), iterations)
+
+    def _fill_gaps(self, data, missing, rank, scales):
+        """
+        Fills the gaps with the mean plus rank reconstruction of the filled data, re-estimating the
+        site means every iteration, until the reconstruction error of the observed values stops improving.
+
+        Returns: filled array, number of iterations
+        """
+
+        # gaps start at the observed site mean (0 for a site without data)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            filled = np.where(missing, np.nan_to_num(np.nanmean(data, axis=0)), data)
+
+        previous_error = np.inf
+        for iteration in range(1, self.max_iterations + 1):
+            means = filled.mean(axis=0)
+            u, singular_values, vt = self._randomized_svd((filled - means)/scales, rank)
+            reconstruction = means + ((u*singular_values) @ vt)*scales
+
+            error = np.sqrt(np.mean(((reconstruction - filled)[~missing]/np.broadcast_to(scales, filled.shape)[~missing])**2))
+            filled[missing] = reconstruction[missing]
+            if np.isfinite(previous_error) and previous_error - error <= self.tolerance*previous_error:
+                break
+            previous_error = error
+
+        return filled, iteration
+
+    def _randomized_svd(self, matrix, rank):
+        """
+        Randomized SVD (Halko et al. 2011) of the leading rank singular values and vectors.
+        """
+
+        rng = np.random.default_rng(self.seed)
+        n_directions = min(rank + self.oversampling, min(matrix.shape))
+
+        # orthonormal basis of the range of the matrix, refined with power iterations
+        basis, _ = np.linalg.qr(matrix @ rng.standard_normal((matrix.shape[1], n_directions)))
+        for _ in range(self.power_iterations):
+            basis, _ = np.linalg.qr(matrix.T @ basis)
+            basis, _ = np.linalg.qr(matrix @ basis)
+
+        u, singular_values, vt = np.linalg.svd(basis.T @ matrix, full_matrices=False)
+        u = basis @ u
+
+        return u[:, :rank], singular_values[:rank], vt[:rank]
 
 
 class networkDesign:
@@ -730,14 +1178,31 @@ class networkDesign:
     - representation error and analysis
     """
 
-    def __init__(self, dict_of_data, bin_headers):
+    def __init__(self, dict_of_data, bin_headers, leave_one_out=False):
         """
         Calls function that computed the representation error.
 
-        Creates list of sites, array of datetimes, and dict of rep error
-        to be used by other functions.
+        Creates list of sites, array of datetimes, the (site, time, bin) array of rep error,
+        and the per season summary of it to be used by other functions.
+
+        Inputs:
+        - dict_of_data: dictionary of all POPS data
+        - bin_headers: headers for bins to use in analysis
+        - leave_one_out: (bool) compare each site to the mean of the other sites instead of
+            the mean of all sites, default False
         """
-        self.sites, self.datetimes, self.representation_dict = self._compute_representation_error(dict_of_data, bin_headers)
+        self.bin_headers = list(bin_headers)
+        self.seasons = np.array([None, 'Winter', 'Winter', 'Spring', 'Spring', 'Spring', 'Summer',
+                                 'Summer', 'Summer', 'Fall', 'Fall', 'Fall', 'Winter'], dtype=object)
+
+        self.sites, self.datetimes, self.values, self.representation_errors, self.network_means = self._compute_representation_error(dict_of_data, self.bin_headers, leave_one_out=leave_one_out)
+        self.summary = self._summarize_representation_error()
+
+        # one df of rep error per bin, columns are sites and the network 'average'
+        self.representation_dict = {}
+        for b, bin in enumerate(self.bin_headers):
+            self.representation_dict[bin] = pd.DataFrame(self.representation_errors[:, :, b].T, columns=self.sites)
+            self.representation_dict[bin]['average'] = self.network_means[:, b]
 
         # self.colors = ['#377eb8', '#ff7f00', '#4daf4a',
         #           '#f781bf', '#a65628', '#984ea3',
@@ -756,29 +1221,31 @@ class networkDesign:
         """
 
         # plot representation error timeseries
-        fig, axs = plt.subplots(len(self.representation_dict), sharey=True, sharex=True, figsize=(6.6,4), dpi=300)
+        fig, axs = plt.subplots(len(self.bin_headers), sharey=True, sharex=True, figsize=(6.6,4), dpi=300)
+        axs = np.atleast_1d(axs)
 
-        for i, (bin, df) in enumerate(self.representation_dict.items()):
+        for i, bin in enumerate(self.bin_headers):
             for idx, site in enumerate(self.sites):
-                axs[i].plot(self.datetimes, df[site], linewidth=1.5, color=self.colors[idx], label=site)
+                axs[i].plot(self.datetimes, self.representation_errors[idx, :, i], linewidth=1.5, color=self.colors[idx], label=site)
             # add label in subplot for the bin
             axs[i].text(0.02, 0.95, bin, transform=axs[i].transAxes, fontsize=10, va='top', ha='left')
         axs[0].legend(loc='upper right', ncol=3)
         axs[i].xaxis.set_major_locator(ticker.MaxNLocator(nbins=5))
         axs[-1].set_xlabel('UTC')
-        axs[1].set_ylabel('Representation Error')
+        axs[min(1, len(axs) - 1)].set_ylabel('Representation Error')
         plt.show()
 
 
 
     def plot_representation_boxes(self):
         """
-        Plots the representation error seasonally as box plots
+        Plots the representation error seasonally as box plots (5-95 % whiskers, no fliers),
+        drawn from the precomputed summary.
         """
 
-        n_rows = len(self.representation_dict.keys())
+        n_rows = len(self.bin_headers)
 
-        fix, axes = plt.subplots(nrows=n_rows, ncols=4, sharey=True, sharex=True, figsize=(6.6, 1.75*(n_rows+1)), gridspec_kw={'height_ratios': [2] + [1] * (n_rows-1)}, dpi=300)
+        fix, axes = plt.subplots(nrows=n_rows, ncols=4, sharey=True, sharex=True, figsize=(6.6, 1.75*(n_rows+1)), gridspec_kw={'height_ratios': [2] + [1] * (n_rows-1)}, dpi=300, squeeze=False)
 
         colors = {
             'gothic': '#ff7f00',
@@ -789,100 +1256,40 @@ class networkDesign:
             'cbtop': '#984ea3',
         }
 
+        summary = self.summary.set_index(['bin', 'Season', 'site'])
+        seasons = ['Spring', 'Summer', 'Fall', 'Winter']
 
-        for i, (bin, df) in enumerate(self.representation_dict.items()):
+        for i, bin in enumerate(self.bin_headers):
             
             bin_name = bin.split('_')
 
-            # group the data seasonally
-            df['DateTime'] = pd.to_datetime(self.datetimes)
-            df['Season'] = df['DateTime'].dt.month.apply(self._sort_season)
-            for pos, site in enumerate(self.sites):
-                # plot box plot for each season
-             
-                # spring
-                spring_df = df[(df['Season'] == 'Spring')]
-                # remove any rows where df[site] is nan and convert to list
-                spring = spring_df.copy().dropna(subset=[site])
-                axes[i, 0].boxplot(spring[site], positions=[pos], showfliers=False, whis=(5, 95),
-                                   widths=0.75,
-                                   boxprops={'color': colors[site]},
-                                   whiskerprops={'color': colors[site]},
-                                   capprops={'color': colors[site]},
-                                   medianprops={'color': colors[site]},
-                                   )
-                
-                axes[i,0].set_ylabel(f"{bin_name[1]} - {bin_name[2]} nm")
-                # set xticks
-                axes[i,0].set_xticks(range(len(self.sites)))
-                axes[i,0].set_xticklabels(self.sites, rotation=90)
-                # set y-axis gridlines
-                axes[i,0].yaxis.grid(True, which='both', linestyle='--', alpha=0.7)
-                
-
-                # compute the median and IQR
-                self._display_stats(data=spring, site=site, bin=bin, season='spring')
+            for j, season in enumerate(seasons):
+                for pos, site in enumerate(self.sites):
+                    if (bin, season, site) not in summary.index or summary.loc[(bin, season, site), 'count'] == 0:
+                        continue
+                    stats = summary.loc[(bin, season, site)]
 
-                # summer
-                summer_df = df[(df['Season'] == 'Summer')]
-                # remove rows where df[site] is nan
-                summer = summer_df.copy().dropna(subset=[site])
-                axes[i, 1].boxplot(summer[site], positions=[pos], showfliers=False, whis=(5, 95),
+                    # plot box plot for each season
+                    box = {'med': stats['median'], 'q1': stats['q25'], 'q3': stats['q75'],
+                           'whislo': stats['whislo'], 'whishi': stats['whishi'], 'fliers': []}
+                    axes[i, j].bxp([box], positions=[pos], showfliers=False,
                                    widths=0.75,
-                                   boxprops={'color': colors[site]},
-                                   whiskerprops={'color': colors[site]},
-                                   capprops={'color': colors[site]},
-                                   medianprops={'color': colors[site]},
+                                   boxprops={'color': colors.get(site, 'black')},
+                                   whiskerprops={'color': colors.get(site, 'black')},
+                                   capprops={'color': colors.get(site, 'black')},
+                                   medianprops={'color': colors.get(site, 'black')},
                                    )
-                # set xticks
-                axes[i,1].set_xticks(range(len(self.sites)))
-                axes[i,1].set_xticklabels(self.sites, rotation=90)
-                # set y-axis gridlines
-                axes[i,1].yaxis.grid(True, linestyle='--', alpha=0.7)
-
-                # compute the median and IQR
-                self._display_stats(data=summer, site=site, bin=bin, season='summer')
-
-                # fall
-                fall_df = df[(df['Season'] == 'Fall')]
-                # remove rows where df[site] is nan
-                fall = fall_df.copy().dropna(subset=[site])
-                axes[i, 2].boxplot(fall[site], positions=[pos], showfliers=False, whis=(5, 95),
-                                   widths=0.75,
-                                   boxprops={'color': colors[site]},
-                                   whiskerprops={'color': colors[site]},
-                                   capprops={'color': colors[site]},
-                                   medianprops={'color': colors[site]},
-                                   )
-                # set xticks
-                axes[i,2].set_xticks(range(len(self.sites)))
-                axes[i,2].set_xticklabels(self.sites, rotation=90)
-                # set y-axis gridlines
-                axes[i,2].yaxis.grid(True, linestyle='--', alpha=0.7)
 
-                # compute the median and IQR
-                self._display_stats(data=fall, site=site, bin=bin, season='fall')
+                    # display the median and 5-95 % range
+                    print(f"{bin} {season.lower()} {site}: \n sum: {abs(round(stats['median'],3)) + round(stats['q95'] - stats['q5'],3)}")
 
-                # winter
-                winter_df = df[(df['Season'] == 'Winter')]
-                # remove rows where df[site] is nan
-                winter = winter_df.copy().dropna(subset=[site])
-                axes[i, 3].boxplot(winter[site], positions=[pos], showfliers=False, whis=(5, 95),
-                                   widths=0.75,
-                                   boxprops={'color': colors[site]},
-                                   whiskerprops={'color': colors[site]},
-                                   capprops={'color': colors[site]},
-                                   medianprops={'color': colors[site]},
-                                   )
                 # set xticks
-                axes[i,3].set_xticks(range(len(self.sites)))
-                axes[i,3].set_xticklabels(self.sites, rotation=90)
+                axes[i,j].set_xticks(range(len(self.sites)))
+                axes[i,j].set_xticklabels(self.sites, rotation=90)
                 # set y-axis gridlines
-                axes[i,3].yaxis.grid(True, linestyle='--', alpha=0.7)
-
-                # compute the median and IQR
-                self._display_stats(data=winter, site=site, bin=bin, season='winter')
+                axes[i,j].yaxis.grid(True, which='both', linestyle='--', alpha=0.7)
 
+            axes[i,0].set_ylabel(f"{bin_name[1]} - {bin_name[2]} nm")
       
       
         # label seasons
@@ -911,25 +1318,23 @@ class networkDesign:
         Returns: none
         """
 
-        # compute average and range of representation errors for plotting
+        # average and range of representation errors for plotting
         fig, axs = plt.subplots(ncols=len(self.sites), sharey=True, figsize=(6.6,2.5), dpi=300)
+        axs = np.atleast_1d(axs)
 
-        named_colors = ['blue', 'green', 'red', 'black', 'magenta',
-                            'yellow', 'cyan', 'gray', 'orange',
-                            'purple', 'pink', 'brown']
-        
-        
+        summary = self.summary[self.summary['Season'] == 'All'].set_index(['bin', 'site'])
 
-        for i, (bin, df) in enumerate(self.representation_dict.items()):
+        for i, bin in enumerate(self.bin_headers):
             print(bin)
             for j, site in enumerate(self.sites):
                 print(site)
+                stats = summary.loc[(bin, site)]
                 # make line for range
-                axs[j].vlines(i+1, df[site].min(), df[site].max(), color=self.colors[i*2], linewidth=1.5, label=bin)
-                print('range', abs(df[site].min() - df[site].max()))
+                axs[j].vlines(i+1, stats['q0'], stats['q100'], color=self.colors[i*2], linewidth=1.5, label=bin)
+                print('range', abs(stats['q0'] - stats['q100']))
                 # plot dot for average
-                axs[j].plot(i+1, df[site].mean(), color=self.colors[i*2], marker='^', markersize=3)
-                print('mean', df[site].mean())
+                axs[j].plot(i+1, stats['mean'], color=self.colors[i*2], marker='^', markersize=3)
+                print('mean', stats['mean'])
                 # don't show x-ticks
                 axs[j].set_xticks([])
 
@@ -940,55 +1345,160 @@ class networkDesign:
         plt.show()
 
 
-    def _compute_representation_error(self, dict_of_data, bin_headers):
+    def select_subsets(self, k, method='auto', max_exhaustive=100000, top=10, max_workers=None):
+        """
+        Finds which k sites best reproduce the full network mean.
+
+        A subset is scored by the mean absolute relative error between its mean and the full network
+        mean, |subset mean - network mean|/network mean, over all times, for each bin; the score is the
+        average over the bins. Sites without data at a time are skipped in both means.
+
+        Subsets are evaluated in batches as indicator matrices, so each batch is one matrix product
+        with the (site, time*bin) data, and batches run on a process pool.
+
+        Inputs:
+        - k: number of sites in each subset
+        - method: 'exhaustive' (every subset), 'greedy' (add the best site one at a time), or 'auto'
+            which is exhaustive when there are at most max_exhaustive subsets, default 'auto'
+        - max_exhaustive: largest number of subsets searched exhaustively with method 'auto', default 100000
+        - top: number of subsets to return, default 10
+        - max_workers: number of processes, defaults to None which uses the number of cores, 1 runs without a pool
+
+        Returns: df of the best subsets ranked by score, columns rank, sites, score, and error_<bin> for each bin
+        (for greedy, the candidates of the last step)
+        """
+
+        n_sites = len(self.sites)
+        if method == 'auto':
+            method = 'exhaustive' if math.comb(n_sites, k) <= max_exhaustive else 'greedy'
+
+        if method == 'exhaustive':
+            indicators = np.zeros((math.comb(n_sites, k), n_sites), dtype=bool)
+            for row, subset in enumerate(itertools.combinations(range(n_sites), k)):
+                indicators[row, list(subset)] = True
+            errors = self._score_subsets(indicators, max_workers)
+
+        elif method == 'greedy':
+            chosen = np.zeros(n_sites, dtype=bool)
+            for step in range(k):
+                # every remaining site added to the current subset
+                candidates = np.flatnonzero(~chosen)
+                indicators = np.repeat(chosen[None], len(candidates), axis=0)
+                indicators[np.arange(len(candidates)), candidates] = True
+                errors = self._score_subsets(indicators, max_workers)
+                chosen = indicators[np.nanargmin(np.nanmean(errors, axis=1))]
+
+        else:
+            raise ValueError("method must be 'auto', 'exhaustive', or 'greedy'")
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            scores = np.nanmean(errors, axis=1)
+        order = np.argsort(scores, kind='stable')[:top]
+
+        ranked = pd.DataFrame({
+            'rank': np.arange(1, len(order) + 1),
+            'sites': [tuple(np.array(self.sites)[indicators[i]]) for i in order],
+            'score': scores[order]
+        })
+        for b, bin in enumerate(self.bin_headers):
+            ranked['error_' + bin] = errors[order, b]
+
+        return ranked
+
+    def _score_subsets(self, indicators, max_workers):
+        """
+        Mean absolute relative error of each subset (rows of indicators) for each bin, batched over a process pool.
+        """
+
+        n_sites, n_times, n_bins = self.values.shape
+        valid = ~np.isnan(self.values)
+        sums = np.where(valid, self.values, 0).reshape(n_sites, -1)
+        counts = valid.reshape(n_sites, -1).astype(float)
+
+        # keep each batch's (subset, time*bin) products to about 2**22 values (32 MB each) per worker
+        chunk = max(1, 2**22 // max(1, n_times*n_bins))
+        batches = [indicators[start:start + chunk].astype(float) for start in range(0, len(indicators), chunk)]
+        jobs = (batches, itertools.repeat(sums), itertools.repeat(counts), itertools.repeat(self.network_means.ravel()), itertools.repeat(n_bins))
+
+        if max_workers == 1 or len(batches) == 1:
+            results = list(map(_subset_errors, *jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_subset_errors, *jobs))
+
+        return np.concatenate(results)
+
+    def _compute_representation_error(self, dict_of_data, bin_headers, leave_one_out=False):
         """
         Computes the actual representation error: the normalized difference
         between a site observation and the network mean:
 
         e = (observation - mean) / mean
 
-        This function computes the representation error for every point in the iven data set for the specified bin_headers.    
+        This function computes the representation error for every point in the given data set for the
+        specified bin_headers, for all sites and bins in one broadcast over a (site, time, bin) array.
+        Sites without data are skipped in the mean.
 
         Inputs:
-        - dict_of_data: dictionary of all POPS data
+        - dictionary of all POPS data
         - bin_headers: headers for bins to use in analysis
+        - leave_one_out: (bool) use the mean of the other sites for each site, default False
 
-        Returns: list of site names, array of datetimes, 
-        dict of representation error for each site
+        Returns: list of site names, series of datetimes, (site, time, bin) array of the data,
+        (site, time, bin) array of representation error, and (time, bin) array of the network mean
         """
 
-        representation_dict = {}
-        sites = list(dict_of_data.keys())
-        for bin in bin_headers:
-            # sort data by bins
-            representation_dict[bin] = pd.DataFrame()
-            for site, df in dict_of_data.items():
-                representation_dict[bin][site] = df[bin]
-        datetimes = df['DateTime']
-        
-        # compute rep error
-        for bin, df in representation_dict.items():
-            # compute avg column
-            df['average'] = df.mean(axis=1, skipna=True) # change to False so do analysis when all sites have data 
-            for site in sites:
-                df[site] = (df[site] - df['average'])/df['average']
-        
-        
+        sites, datetimes, values = dataGroupings().stack_sites(dict_of_data, bin_headers)
 
-        return sites, datetimes, representation_dict
-
-    def _sort_season(self, month):
-        if month in [12, 1, 2]:
-            return 'Winter'
-        elif month in [3, 4, 5]:
-            return 'Spring'
-        elif month in [6, 7, 8]:
-            return 'Summer'
-        elif month in [9, 10, 11]:
-            return 'Fall'
-    
-    def _display_stats(self, data, site, bin, season):
-        # compute the median and IQR
-            med = data[site].median()
-            middle_90 = data[site].quantile(0.95) - data[site].quantile(0.05)
-            print(f"{bin} {season} {site}: \n sum: {abs(round(med,3)) + round(middle_90,3)}")
\ No newline at end of file
+        valid = ~np.isnan(values)
+        sums = np.where(valid, values, 0).sum(axis=0)
+        counts = valid.sum(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            network_means = sums/counts
+            if leave_one_out:
+                # mean of the other sites: remove each site from the sum and count
+                means = (sums - np.where(valid, values, 0))/(counts - valid)
+            else:
+                means = network_means[None]
+            representation_errors = (values - means)/means
+
+        return sites, datetimes, values, representation_errors, network_means
+
+    def _summarize_representation_error(self):
+        """
+        Count, mean, median, 0, 5, 25, 75, 95, 100 % quantiles, and box plot whiskers (the most extreme
+        values inside the 5-95 % range) of the representation error of every (bin, season, site),
+        with season 'All' for the whole period.
+        """
+
+        season_dfs = {}
+        for s, site in enumerate(self.sites):
+            season_dfs[site] = pd.DataFrame(self.representation_errors[s], columns=self.bin_headers)
+            season_dfs[site]['Season'] = self.seasons[pd.to_datetime(self.datetimes).dt.month.to_numpy()]
+
+        groupings = dataGroupings()
+        quantiles = [0, 0.05, 0.25, 0.75, 0.95, 1]
+        summary = pd.concat([
+            groupings.grouped_statistics(season_dfs, self.bin_headers, ['Season'], quantiles=quantiles),
+            groupings.grouped_statistics({site: df.assign(Season='All') for site, df in season_dfs.items()}, self.bin_headers, ['Season'], quantiles=quantiles)
+        ], ignore_index=True)
+
+        # whiskers end at the most extreme values inside the 5-95 % range (same as boxplot(whis=(5, 95)))
+        summary['whislo'] = np.nan
+        summary['whishi'] = np.nan
+        rows = summary.reset_index().set_index(['site', 'Season', 'bin'])['index']
+        for s, site in enumerate(self.sites):
+            for season in np.unique(season_dfs[site]['Season'].dropna().tolist() + ['All']):
+                in_season = np.ones(len(self.datetimes), dtype=bool) if season == 'All' else (season_dfs[site]['Season'] == season).to_numpy()
+                errors = self.representation_errors[s][in_season]
+                cells = rows.loc[[(site, season, bin) for bin in self.bin_headers]].to_numpy()
+                with np.errstate(invalid='ignore'):
+                    inside_low = errors >= summary.loc[cells, 'q5'].to_numpy()
+                    inside_high = errors <= summary.loc[cells, 'q95'].to_numpy()
+                summary.loc[cells, 'whislo'] = np.min(np.where(inside_low, errors, np.inf), axis=0, initial=np.inf)
+                summary.loc[cells, 'whishi'] = np.max(np.where(inside_high, errors, -np.inf), axis=0, initial=-np.inf)
+        summary.loc[summary['count'] == 0, ['whislo', 'whishi']] = np.nan
+
+        return summary[['bin', 'Season', 'site', 'count', 'mean', 'median', 'q0', 'q5', 'q25', 'q75', 'q95', 'q100', 'whislo', 'whishi']]